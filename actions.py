@@ -0,0 +1,77 @@
+import abc
+import importlib.util
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+from typing import Mapping
+
+EXIT_OK = 0
+
+class Action(abc.ABC):
+    """
+    Switches the heating of a room on or off. set_state returns the exit code
+    the action script would have returned (EXIT_OK on success).
+    """
+
+    @abc.abstractmethod
+    def set_state(self, on: bool) -> int:
+        pass
+
+class ScriptAction(Action):
+    """Runs an action script as a child process for each switch."""
+
+    def __init__(self, path: str, env: Mapping[str, str], wrapper: textwrap.TextWrapper) -> None:
+        self.path = path
+        self.env = dict(env)
+        self.wrapper = wrapper
+
+    def set_state(self, on: bool) -> int:
+        result = subprocess.run([self.path, 'on' if on else 'off'], stdout=subprocess.PIPE, env=self.env)
+        print(self.wrapper.fill(result.stdout.decode()))
+        return result.returncode
+
+def load_module(path: str):
+    name = os.path.splitext(os.path.basename(path))[0]
+    if (module := sys.modules.get(name)) is not None and getattr(module, '__file__', None) == path:
+        return module
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[name] = module
+    return module
+
+def load_action(path: str, env: Mapping[str, str], wrapper: textwrap.TextWrapper) -> Action:
+    # Python action scripts providing create_action(env, wrapper) are loaded as modules, such
+    # that their client stays connected between switches. Any other script is run as before.
+    if path.endswith('.py'):
+        try:
+            module = load_module(path)
+        except ImportError as e:
+            print(wrapper.fill("Cannot load %s in-process (%s), running it as script" % (path, e)))
+        else:
+            if hasattr(module, 'create_action'):
+                return module.create_action(env, wrapper)
+    return ScriptAction(path, env, wrapper)
+
+class LazyAction(Action):
+    """
+    Loads its action (see load_action) on the first switch only: most checks
+    leave the state unchanged, and need not import the script and its client.
+    """
+
+    # rooms switched in parallel may share the script
+    lock = threading.Lock()
+
+    def __init__(self, path: str, env: Mapping[str, str], wrapper: textwrap.TextWrapper) -> None:
+        self.path = path
+        self.env = env
+        self.wrapper = wrapper
+        self.action = None
+
+    def set_state(self, on: bool) -> int:
+        with self.lock:
+            if self.action is None:
+                self.action = load_action(self.path, self.env, self.wrapper)
+        return self.action.set_state(on)
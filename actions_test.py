@@ -0,0 +1,64 @@
+import os
+import sys
+import textwrap
+
+import pytest
+
+from actions import LazyAction, ScriptAction, load_action
+
+WRAPPER = textwrap.TextWrapper()
+
+def test_python_action_is_loaded_in_process(tmp_path):
+    path = tmp_path / 'switch_action.py'
+    path.write_text(
+        'from actions import Action\n'
+        'class SwitchAction(Action):\n'
+        '    def __init__(self, env):\n'
+        '        self.states = []\n'
+        '        self.room = env["room"]\n'
+        '    def set_state(self, on):\n'
+        '        self.states.append(on)\n'
+        '        return 0\n'
+        'def create_action(env, wrapper):\n'
+        '    return SwitchAction(env)\n')
+    first = load_action(str(path), { 'room': 'first' }, WRAPPER)
+    second = load_action(str(path), { 'room': 'second' }, WRAPPER)
+    assert first.set_state(True) == 0
+    assert second.set_state(False) == 0
+    assert (first.room, first.states) == ('first', [True])
+    assert (second.room, second.states) == ('second', [False])
+
+def test_other_actions_run_as_script(tmp_path, capsys):
+    path = tmp_path / 'switch.sh'
+    path.write_text('#!/bin/sh\necho "$room $1"\nexit 3\n')
+    os.chmod(path, 0o755)
+    action = load_action(str(path), dict(os.environ, room='first'), WRAPPER)
+    assert isinstance(action, ScriptAction)
+    assert action.set_state(True) == 3
+    assert capsys.readouterr().out == 'first on\n'
+
+def test_lazy_action_loads_on_first_switch(tmp_path):
+    path = tmp_path / 'lazy_action.py'
+    path.write_text(
+        'from actions import Action\n'
+        'class SwitchAction(Action):\n'
+        '    def set_state(self, on):\n'
+        '        return 0 if on else 5\n'
+        'def create_action(env, wrapper):\n'
+        '    return SwitchAction()\n')
+    action = LazyAction(str(path), {}, WRAPPER)
+    assert action.action is None and 'lazy_action' not in sys.modules
+    assert action.set_state(True) == 0
+    assert action.set_state(False) == 5
+    assert 'lazy_action' in sys.modules
+
+def test_action_without_set_state_fails_on_load(tmp_path):
+    path = tmp_path / 'incomplete_action.py'
+    path.write_text(
+        'from actions import Action\n'
+        'class IncompleteAction(Action):\n'
+        '    pass\n'
+        'def create_action(env, wrapper):\n'
+        '    return IncompleteAction()\n')
+    with pytest.raises(TypeError):
+        load_action(str(path), {}, WRAPPER)
@@ -0,0 +1,135 @@
+import asyncio
+import datetime
+import json
+import logging
+import math
+from typing import Awaitable, Callable
+
+from fastapi.encoders import jsonable_encoder
+
+from logic import EventStore
+from metrics import CACHE_HIT, CACHE_MISS, CACHE_UNCOVERED, WINDOW_EVENTS
+
+logger = logging.getLogger('uvicorn.error')
+
+# Windows start a bit in the past such that they cover requests received while fetching
+WINDOW_LEAD = datetime.timedelta(minutes=1)
+
+class EventWindow:
+    """Events needing heating at some time from `start` until `end`, as fetched at `fetched_at`."""
+
+    def __init__(self, start: datetime.datetime, end: datetime.datetime, store: EventStore, fetched_at: float) -> None:
+        self.start = start
+        self.end = end
+        self.store = store
+        self.fetched_at = fetched_at
+        # JSON responses by the indices of the events they contain
+        self.serialized = {}
+
+    def covers(self, now: datetime.datetime, preheat_minutes: int) -> bool:
+        return self.start <= now and now + datetime.timedelta(minutes=preheat_minutes) <= self.end
+
+    def to_json(self, indices: tuple[int, ...]) -> bytes:
+        if indices not in self.serialized:
+            content = jsonable_encoder(self.store.events(indices))
+            self.serialized[indices] = json.dumps(content, ensure_ascii=False, allow_nan=False,
+                                                  indent=None, separators=(",", ":")).encode("utf-8")
+        return self.serialized[indices]
+
+class EventWindowCache:
+    """
+    Shares one fetch of the events of the next `horizon_minutes` between all
+    requests. Concurrent requests wait for the same fetch (single-flight) and
+    the window is refreshed in the background once it is `refresh_ahead` of
+    its `ttl_seconds` old, so requests normally do not wait for CalDAV.
+    Fetched windows are passed to `save`; `restore` provides a window
+    fetched earlier, served right at startup and when fetching fails.
+    """
+
+    def __init__(self, fetch: Callable[[datetime.datetime, datetime.datetime], Awaitable[EventStore]],
+                 ttl_seconds: float, horizon_minutes: int, refresh_ahead: float = 0.8,
+                 save: Callable[[EventWindow], None] | None = None,
+                 restore: Callable[[], EventWindow | None] | None = None) -> None:
+        self.fetch = fetch
+        self.ttl_seconds = ttl_seconds
+        self.horizon = datetime.timedelta(minutes=horizon_minutes)
+        self.refresh_ahead = refresh_ahead
+        self.save = save
+        self.restore = restore
+        self.window = None
+        self.inflight = None
+        # whether restore was tried for the first request
+        self.started = False
+
+    async def get(self, now: datetime.datetime, preheat_minutes: int) -> EventWindow | None:
+        # The cached window, None if it does not cover the request
+        if not self.started:
+            self.started = True
+            if self.restore is not None:
+                # served while the first fetch runs in the background
+                self.window = self.window or await self.restored(self.ttl_seconds * self.refresh_ahead)
+        window = self.window
+        age = None if window is None else asyncio.get_running_loop().time() - window.fetched_at
+        if age is None or age >= self.ttl_seconds:
+            window = await self.refresh()
+            result = CACHE_MISS
+        else:
+            if age >= self.ttl_seconds * self.refresh_ahead:
+                self.start_refresh()
+            result = CACHE_HIT
+        if not window.covers(now, preheat_minutes):
+            CACHE_UNCOVERED.inc()
+            return None
+        result.inc()
+        return window
+
+    async def invalidate(self) -> EventWindow:
+        # Fetch again right away, e.g. once the calendar changed; requests wait for the new window
+        if self.window is not None:
+            self.window.fetched_at = -math.inf
+        if self.inflight is not None:
+            # may have been sent before the change
+            await asyncio.wait([self.inflight])
+        return await self.refresh()
+
+    def start_refresh(self) -> asyncio.Future:
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self.load())
+            self.inflight.add_done_callback(self.refresh_done)
+        return self.inflight
+
+    async def refresh(self) -> EventWindow:
+        return await asyncio.shield(self.start_refresh())
+
+    async def load(self) -> EventWindow:
+        start = datetime.datetime.now().astimezone() - WINDOW_LEAD
+        end = start + self.horizon
+        try:
+            store = await self.fetch(start, end)
+        except Exception as e:
+            if self.restore is None or (window := await self.restored(0)) is None:
+                raise
+            # fetched again once the restored window is ttl_seconds old
+            logger.warning("Refreshing events failed, using the saved events until %s: %s", window.end, e)
+            self.window = window
+            return window
+        self.window = EventWindow(start, end, store, asyncio.get_running_loop().time())
+        WINDOW_EVENTS.observe(len(store))
+        if self.save is not None:
+            try:
+                await asyncio.to_thread(self.save, self.window)
+            except Exception as e:
+                logger.warning("Saving events failed: %s", e)
+        return self.window
+
+    async def restored(self, age: float) -> EventWindow | None:
+        # The window from restore, as if fetched `age` seconds ago
+        window = await asyncio.to_thread(self.restore)
+        if window is not None:
+            window.fetched_at = asyncio.get_running_loop().time() - age
+        return window
+
+    def refresh_done(self, future: asyncio.Future) -> None:
+        self.inflight = None
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("Refreshing events failed: %s", future.exception())
@@ -0,0 +1,143 @@
+import asyncio
+import datetime
+import json
+
+from prometheus_client import REGISTRY
+
+from api_cache import EventWindow, EventWindowCache
+from logic import EventStore
+
+def make_events(*hours: int) -> EventStore:
+    store = EventStore()
+    now = datetime.datetime.now().timestamp()
+    for hour in hours:
+        store.append('Event in %i hours' % hour, None, now + hour * 3600, now + (hour + 1) * 3600)
+    return store
+
+def test_single_flight():
+    fetches = []
+
+    async def fetch(start: datetime.datetime, end: datetime.datetime) -> EventStore:
+        fetches.append((start, end))
+        await asyncio.sleep(0.01)
+        return make_events(1, 2)
+
+    async def run():
+        cache = EventWindowCache(fetch, ttl_seconds=60, horizon_minutes=24 * 60)
+        now = datetime.datetime.now().astimezone()
+        windows = await asyncio.gather(*[cache.get(now, 60) for _ in range(10)])
+        assert len(fetches) == 1
+        assert all(window is windows[0] for window in windows)
+        assert len(windows[0].store) == 2
+
+        # not covered: preheat beyond the horizon
+        assert await cache.get(now, 48 * 60) is None
+        assert len(fetches) == 1
+
+    asyncio.run(run())
+
+def test_refresh_ahead():
+    fetches = []
+
+    async def fetch(start: datetime.datetime, end: datetime.datetime) -> EventStore:
+        fetches.append((start, end))
+        return make_events(len(fetches))
+
+    async def run():
+        cache = EventWindowCache(fetch, ttl_seconds=0.1, horizon_minutes=24 * 60, refresh_ahead=0.5)
+        now = datetime.datetime.now().astimezone()
+        first = await cache.get(now, 0)
+        await asyncio.sleep(0.06)
+        # stale, but not expired: answered from the old window, refreshed in the background
+        assert await cache.get(now, 0) is first
+        await asyncio.sleep(0)
+        assert len(fetches) == 2
+        assert cache.window is not first
+
+    asyncio.run(run())
+
+def test_serialized_responses_are_reused():
+    events = make_events(1, 2)
+
+    async def fetch(start: datetime.datetime, end: datetime.datetime) -> EventStore:
+        return events
+
+    async def run():
+        cache = EventWindowCache(fetch, ttl_seconds=60, horizon_minutes=24 * 60)
+        window = await cache.get(datetime.datetime.now().astimezone(), 0)
+        content = window.to_json((1,))
+        assert window.to_json((1,)) is content
+        assert json.loads(content)[0]['summary'] == events.summaries[1]
+
+    asyncio.run(run())
+
+def test_restore_and_save():
+    saved = []
+    failing = [False]
+
+    async def fetch(start: datetime.datetime, end: datetime.datetime) -> EventStore:
+        await asyncio.sleep(0.01)
+        if failing[0]:
+            raise ConnectionError('CalDAV server unavailable')
+        return make_events(1)
+
+    def restore() -> EventWindow:
+        now = datetime.datetime.now().astimezone()
+        return EventWindow(now - datetime.timedelta(hours=1), now + datetime.timedelta(hours=23), make_events(2), 0)
+
+    async def run():
+        cache = EventWindowCache(fetch, ttl_seconds=0.1, horizon_minutes=24 * 60, save=saved.append,
+                                 restore=restore)
+        now = datetime.datetime.now().astimezone()
+        # answered right away from the restored window, fetched in the background
+        window = await cache.get(now, 0)
+        assert window.store.summaries == ['Event in 2 hours']
+        await cache.inflight
+        assert cache.window.store.summaries == ['Event in 1 hours']
+        assert saved == [cache.window]
+
+        failing[0] = True
+        await asyncio.sleep(0.1)
+        window = await cache.get(now, 0)
+        assert window.store.summaries == ['Event in 2 hours']
+        assert len(saved) == 1
+
+    asyncio.run(run())
+
+def test_hits_and_misses_counted():
+    async def fetch(start: datetime.datetime, end: datetime.datetime) -> EventStore:
+        return make_events(1, 2)
+
+    def count(result: str) -> float:
+        return REGISTRY.get_sample_value('event_cache_requests_total', {'result': result}) or 0
+
+    async def run():
+        cache = EventWindowCache(fetch, ttl_seconds=60, horizon_minutes=24 * 60)
+        now = datetime.datetime.now().astimezone()
+        before = {result: count(result) for result in ['hit', 'miss', 'uncovered']}
+        await cache.get(now, 0)
+        await cache.get(now, 0)
+        await cache.get(now, 48 * 60)
+        assert {result: count(result) - before[result] for result in before} == {'hit': 1, 'miss': 1, 'uncovered': 1}
+
+    asyncio.run(run())
+
+def test_invalidate():
+    fetches = []
+
+    async def fetch(start: datetime.datetime, end: datetime.datetime) -> EventStore:
+        fetches.append((start, end))
+        await asyncio.sleep(0.01)
+        return make_events(len(fetches))
+
+    async def run():
+        cache = EventWindowCache(fetch, ttl_seconds=60, horizon_minutes=24 * 60)
+        now = datetime.datetime.now().astimezone()
+        cache.start_refresh()
+        # the fetch in flight may have missed the change: fetched again after it
+        window = await cache.invalidate()
+        assert len(fetches) == 2
+        assert window.store.summaries == ['Event in 2 hours']
+        assert await cache.get(now, 0) is window
+
+    asyncio.run(run())
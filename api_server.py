@@ -3,26 +3,42 @@
 
 import textwrap
 from typing import Annotated
-from fastapi import FastAPI, Depends, HTTPException, Query
+from fastapi import FastAPI, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_500_INTERNAL_SERVER_ERROR
-from logic import HeatNeededIndicator, Event
+from pydantic import BaseModel, Field
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_500_INTERNAL_SERVER_ERROR
+from api_cache import EventWindow, EventWindowCache
+from async_caldav import AsyncCalendar
+from caldav_filters import candidate_filters
+from logic import HeatNeededIndicator, Event, EventStore
+from metrics import CALDAV_CLIENT_RESETS, REQUEST_SECONDS, metrics_response
+from snapshot import EventSnapshot, Snapshot
+from transitions import TransitionHub
+import asyncio
 import caldav
 import datetime
+import httpx
 import os
+import requests
+import signal
 import json
+import logging
 import dotenv
 
 dotenv.load_dotenv()
 
 app = FastAPI()
+logger = logging.getLogger("uvicorn.error")
 security = HTTPBasic(realm=os.getenv("api_realm"))
 
 users_db = json.loads(os.getenv("api_users"))
 
+# preheat/cooloff are passed per call; without them, the indicator finds all events
+# needing heating in a window for any preheat/cooloff
 indicator = HeatNeededIndicator(
-    preheat_minutes=0,  # Placeholder, will be set dynamically
-    cooloff_minutes=0,  # Placeholder, will be set dynamically
+    preheat_minutes=0,
+    cooloff_minutes=0,
     no_heat_tag=os.getenv("no_heat_tag")
 )
 
@@ -37,50 +53,236 @@ def create_caldav_client():
         timeout=float(os.getenv("caldav_timeout", 0)) or None
     )
 
-client = create_caldav_client()
-principal = client.principal()
+# Events last fetched, shared with caldav-trigger.py
+snapshot_file = os.getenv("snapshot_file")
+snapshot = None
+if snapshot_file:
+    snapshot = EventSnapshot(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), snapshot_file),
+        max_age=datetime.timedelta(minutes=float(os.getenv("snapshot_max_age_minutes", 24 * 60)))
+    )
+
+# Discover the calendar once, searches then go through the pooled async client
 calendar_id = os.getenv("calendar_id")
-calendar = principal.calendar(cal_id=calendar_id)
+try:
+    with create_caldav_client() as client:
+        principal = client.principal()
+        calendar_url = str(principal.calendar(cal_id=calendar_id).url)
+except (caldav.error.DAVError, requests.RequestException):
+    # start with the calendar of the snapshot while the CalDAV server is unavailable
+    saved = None if snapshot is None else snapshot.load(calendar_id, indicator.no_heat_tag)
+    if saved is None or saved.url is None:
+        raise
+    calendar_url = saved.url
+
+def create_async_calendar():
+    return AsyncCalendar(
+        calendar_url,
+        username=os.getenv("caldav_user"),
+        password=os.getenv("caldav_password"),
+        timeout=float(os.getenv("caldav_timeout", 0)) or None,
+        max_connections=int(os.getenv("api_caldav_max_connections", 20)),
+        filter_sets=candidate_filters(indicator.no_heat_tag) if os.getenv("caldav_server_filters", "1") != "0" else None,
+        parser=os.getenv("ical_parser", "vobject")
+    )
+
+async_calendar = create_async_calendar()
 
 def authenticate_user(username: str, password: str):
     if username in users_db and users_db[username] == password:
         return True
     return False
 
-def get_calendar_events(now: datetime.datetime):
-    global client, principal, calendar
+async def get_calendar_events(now: datetime.datetime, until: datetime.datetime | None = None,
+                              preheat_minutes: int = 0, cooloff_minutes: int = 0) -> EventStore:
+    global async_calendar
     try:
-        return indicator.get_next_events(calendar, now.astimezone())
-    except caldav.error.DAVError:
-        # Reset client on timeout or other CalDAV errors
-        client = create_caldav_client()
-        principal = client.principal()
-        calendar = principal.calendar(cal_id=calendar_id)
+        return await indicator.get_event_store_async(async_calendar, now.astimezone(), until,
+                                                     preheat_minutes, cooloff_minutes)
+    except (caldav.error.DAVError, httpx.HTTPError):
+        # Reset connections on timeout or other CalDAV errors
+        CALDAV_CLIENT_RESETS.inc()
+        old_calendar = async_calendar
+        async_calendar = create_async_calendar()
+        asyncio.ensure_future(old_calendar.aclose())
         raise HTTPException(
             status_code=HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to retrieve events from CalDAV server. Please try again later."
         )
 
-@app.get("/next-events")
-def read_next_events(
-    credentials: Annotated[HTTPBasicCredentials, Depends(security)],
-    preheat_minutes: Annotated[int, Query(..., ge=0, description="Preheat duration in minutes")],
-    cooloff_minutes: Annotated[int, Query(..., ge=0, description="Cooloff duration in minutes")],
-    now: datetime.datetime = Query(default_factory=datetime.datetime.now, description="Current date-time")
-) -> list[Event]:
-    username = credentials.username
-    password = credentials.password
-    if not authenticate_user(username, password):
+def save_snapshot(window: EventWindow) -> None:
+    snapshot.save(calendar_id, indicator.no_heat_tag, Snapshot(window.store, window.start, window.end,
+                                                               datetime.datetime.now().astimezone(), calendar_url))
+
+def restore_snapshot() -> EventWindow | None:
+    # The saved events if recent enough, served until the CalDAV server answers again
+    saved = snapshot.load_fresh(calendar_id, indicator.no_heat_tag, datetime.datetime.now().astimezone())
+    return None if saved is None else EventWindow(saved.start, saved.end, saved.store, 0)
+
+events_cache = EventWindowCache(
+    get_calendar_events,
+    ttl_seconds=float(os.getenv("api_cache_ttl_seconds", 60)),
+    horizon_minutes=int(os.getenv("api_cache_horizon_minutes", 24 * 60)),
+    save=save_snapshot if snapshot is not None else None,
+    restore=restore_snapshot if snapshot is not None else None
+)
+
+def check_credentials(credentials: HTTPBasicCredentials) -> None:
+    if not authenticate_user(credentials.username, credentials.password):
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": f'Basic realm="{security.realm}"'},
         )
 
-    indicator.preheat_minutes = preheat_minutes
-    indicator.cooloff_minutes = cooloff_minutes
-    events = get_calendar_events(now)
-    return events
+next_events_seconds = REQUEST_SECONDS.labels("/next-events")
+
+@app.get("/next-events", response_model=list[Event])
+async def read_next_events(
+    credentials: Annotated[HTTPBasicCredentials, Depends(security)],
+    preheat_minutes: Annotated[int, Query(..., ge=0, description="Preheat duration in minutes")],
+    cooloff_minutes: Annotated[int, Query(..., ge=0, description="Cooloff duration in minutes")],
+    now: datetime.datetime = Query(default_factory=datetime.datetime.now, description="Current date-time")
+) -> Response:
+    with next_events_seconds.time():
+        return await next_events(credentials, preheat_minutes, cooloff_minutes, now)
+
+async def next_events(credentials: HTTPBasicCredentials, preheat_minutes: int, cooloff_minutes: int,
+                      now: datetime.datetime) -> Response:
+    check_credentials(credentials)
+
+    now = now.astimezone()
+    if events_cache.ttl_seconds > 0 and (window := await events_cache.get(now, preheat_minutes)) is not None:
+        indices = window.store.needed_at(now.timestamp(), preheat_minutes * 60, cooloff_minutes * 60,
+                                         exclude=window.store.mask(indicator.no_heat_tag))
+        return Response(content=window.to_json(indices), media_type="application/json")
+
+    # Outside of the cached window, e.g. for a `now` in the past
+    store = await get_calendar_events(now, None, preheat_minutes, cooloff_minutes)
+    return indicator.heating_events(store)
+
+class Valve(BaseModel):
+    id: str
+    preheat_minutes: int = Field(ge=0, description="Preheat duration in minutes")
+    cooloff_minutes: int = Field(ge=0, description="Cooloff duration in minutes")
+    now: datetime.datetime | None = Field(default=None, description="Current date-time")
+
+batch_seconds = REQUEST_SECONDS.labels("/next-events/batch")
+
+@app.post("/next-events/batch", response_model=dict[str, list[Event]])
+async def read_next_events_batch(
+    credentials: Annotated[HTTPBasicCredentials, Depends(security)],
+    valves: list[Valve]
+) -> Response:
+    with batch_seconds.time():
+        return await next_events_batch(credentials, valves)
+
+async def next_events_batch(credentials: HTTPBasicCredentials, valves: list[Valve]) -> Response:
+    # /next-events for each valve by its id, all from the cached window or one search
+    check_credentials(credentials)
+
+    now = datetime.datetime.now().astimezone()
+    # a valve listed twice is answered once, for its last entry
+    unique = {valve.id: valve for valve in valves}
+    queries = [(valve.id, (valve.now or now).astimezone(), valve.preheat_minutes, valve.cooloff_minutes)
+               for valve in unique.values()]
+    windows = {}
+    uncovered = []
+    for query in queries:
+        (_, valve_now, preheat_minutes, _) = query
+        if events_cache.ttl_seconds > 0 and (window := await events_cache.get(valve_now, preheat_minutes)) is not None:
+            windows[query] = window
+        else:
+            uncovered.append(query)
+
+    if uncovered:
+        # the window of all of them, without preheat/cooloff such that it holds the events of any valve
+        start = min(valve_now for (_, valve_now, _, _) in uncovered)
+        end = max(valve_now + datetime.timedelta(minutes=preheat_minutes)
+                  for (_, valve_now, preheat_minutes, _) in uncovered)
+        window = EventWindow(start, end, await get_calendar_events(start, end), 0)
+        windows.update((query, window) for query in uncovered)
+
+    content = []
+    for query in queries:
+        (valve_id, valve_now, preheat_minutes, cooloff_minutes) = query
+        window = windows[query]
+        indices = window.store.needed_at(valve_now.timestamp(), preheat_minutes * 60, cooloff_minutes * 60,
+                                         exclude=window.store.mask(indicator.no_heat_tag))
+        content.append(json.dumps(valve_id).encode("utf-8") + b":" + window.to_json(indices))
+    return Response(content=b"{" + b",".join(content) + b"}", media_type="application/json")
+
+# Transitions are evaluated once for all subscribers with the same preheat/cooloff
+transition_hub = TransitionHub(events_cache, indicator.no_heat_tag,
+                               recheck_seconds=events_cache.ttl_seconds if events_cache.ttl_seconds > 0 else 60)
+
+# comment sent to idle streams, such that proxies keep them open
+KEEPALIVE_SECONDS = 30
+
+@app.get("/transitions")
+async def stream_transitions(
+    credentials: Annotated[HTTPBasicCredentials, Depends(security)],
+    preheat_minutes: Annotated[int, Query(..., ge=0, description="Preheat duration in minutes")],
+    cooloff_minutes: Annotated[int, Query(..., ge=0, description="Cooloff duration in minutes")]
+) -> StreamingResponse:
+    check_credentials(credentials)
+    if datetime.timedelta(minutes=preheat_minutes) >= events_cache.horizon:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
+                            detail="Preheat must be less than api_cache_horizon_minutes")
+
+    subscription = transition_hub.subscribe(preheat_minutes, cooloff_minutes)
+
+    async def stream():
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscription.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+        finally:
+            transition_hub.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def is_daemon(pid: int) -> bool:
+    # Whether the process is caldav-trigger.py: a PID file left over by a daemon that was killed may name
+    # another process by now, which SIGUSR1 would terminate
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as file:
+            return b"caldav-trigger" in file.read()
+    except FileNotFoundError:
+        return False
+
+def notify_daemon() -> None:
+    # Let `caldav-trigger.py --daemon` check its rooms right away
+    pid_file = os.getenv("daemon_pid_file")
+    if not pid_file:
+        return
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), pid_file)) as file:
+            pid = int(file.read())
+        if not is_daemon(pid):
+            logger.warning("Cannot notify daemon: process %i is not caldav-trigger.py", pid)
+            return
+        os.kill(pid, signal.SIGUSR1)
+    except (OSError, ValueError) as e:
+        logger.warning("Cannot notify daemon: %s", e)
+
+@app.post("/notify")
+async def notify(credentials: Annotated[HTTPBasicCredentials, Depends(security)]) -> dict:
+    # Hook for calendar changes, e.g. from a Nextcloud webhook: events are fetched again at once
+    check_credentials(credentials)
+    notify_daemon()
+    window = None
+    if events_cache.ttl_seconds > 0:
+        window = await events_cache.invalidate()
+    transition_hub.wake()
+    return {"events": None if window is None else len(window.store)}
+
+@app.get("/metrics")
+async def read_metrics(credentials: Annotated[HTTPBasicCredentials, Depends(security)]) -> Response:
+    check_credentials(credentials)
+    return metrics_response()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,92 @@
+import datetime
+import importlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+from api_cache import EventWindowCache
+from benchmark import CALENDAR_PATH, CalDAVServer, generate_calendar
+
+NOW = datetime.datetime.now().astimezone().replace(microsecond=0)
+AUTH = ('user', 'secret')
+
+@pytest.fixture(scope='module')
+def api():
+    # api_server.py discovers the calendar on import
+    resources = generate_calendar(NOW, events=300, series=5, overrides=5, days=6)
+    with CalDAVServer(resources) as server, pytest.MonkeyPatch.context() as monkeypatch:
+        for (key, value) in { 'caldav_url': server.calendar_url, 'calendar_id': CALENDAR_PATH.rstrip('/'),
+                              'api_users': '{"user": "secret"}', 'no_heat_tag': '!cold!',
+                              'api_cache_horizon_minutes': str(2 * 24 * 60) }.items():
+            monkeypatch.setenv(key, value)
+        monkeypatch.delenv('snapshot_file', raising=False)
+        api_server = importlib.import_module('api_server')
+        with TestClient(api_server.app) as client:
+            yield (api_server, client, sorted(resource.start for resource in resources.values()))
+
+@pytest.fixture
+def searches(api, monkeypatch):
+    # (start, end, preheat, cooloff) of each CalDAV search, with a cache of its own
+    (api_server, _, _) = api
+    calls = []
+    get_calendar_events = api_server.get_calendar_events
+
+    async def counted(now, until=None, preheat_minutes=0, cooloff_minutes=0):
+        calls.append((now, until, preheat_minutes, cooloff_minutes))
+        return await get_calendar_events(now, until, preheat_minutes, cooloff_minutes)
+
+    monkeypatch.setattr(api_server, 'get_calendar_events', counted)
+    monkeypatch.setattr(api_server, 'events_cache', EventWindowCache(
+        counted, ttl_seconds=60, horizon_minutes=2 * 24 * 60))
+    return calls
+
+def valves(starts: list[datetime.datetime]) -> list[dict]:
+    # At event starts: two covered by the cached window, two in the past
+    future = [start for start in starts if NOW < start < NOW + datetime.timedelta(days=1)]
+    past = [start for start in starts if NOW - datetime.timedelta(days=2) < start < NOW - datetime.timedelta(hours=2)]
+    return [
+        { 'id': 'hall', 'preheat_minutes': 60, 'cooloff_minutes': 15, 'now': future[0].isoformat() },
+        { 'id': 'office', 'preheat_minutes': 120, 'cooloff_minutes': 0, 'now': future[-1].isoformat() },
+        { 'id': 'kitchen', 'preheat_minutes': 30, 'cooloff_minutes': 30, 'now': past[0].isoformat() },
+        { 'id': 'cellar', 'preheat_minutes': 90, 'cooloff_minutes': 10, 'now': past[-1].isoformat() },
+        ]
+
+def parsed(events: list[dict]) -> list[tuple]:
+    return [(event['summary'], event['description'], datetime.datetime.fromisoformat(event['dtstart']),
+             datetime.datetime.fromisoformat(event['dtend'])) for event in events]
+
+def test_batch_matches_next_events(api, searches):
+    (_, client, starts) = api
+    batch = valves(starts)
+    response = client.post('/next-events/batch', json=batch, auth=AUTH)
+    assert response.status_code == 200
+    content = response.json()
+    assert list(content) == [valve['id'] for valve in batch]
+    assert any(content.values())
+    for valve in batch:
+        expected = client.get('/next-events', auth=AUTH, params={ key: valve[key] for key in
+                                                                  ['preheat_minutes', 'cooloff_minutes', 'now'] })
+        assert parsed(content[valve['id']]) == parsed(expected.json()), valve['id']
+
+def test_uncovered_valves_share_one_search(api, searches):
+    (_, client, starts) = api
+    batch = valves(starts)
+    assert client.post('/next-events/batch', json=batch, auth=AUTH).status_code == 200
+    # the cached window, and one search for both past valves without margins
+    assert len(searches) == 2
+    (start, end, preheat_minutes, cooloff_minutes) = searches[1]
+    (kitchen, cellar) = (datetime.datetime.fromisoformat(valve['now']) for valve in batch[2:])
+    assert (start, end, preheat_minutes, cooloff_minutes) == (
+        kitchen, cellar + datetime.timedelta(minutes=90), 0, 0)
+
+def test_valve_listed_twice_answered_once(api, searches):
+    (_, client, starts) = api
+    (hall, office, _, _) = valves(starts)
+    repeated = dict(office, id='hall')
+    response = client.post('/next-events/batch', json=[hall, repeated], auth=AUTH)
+    assert list(response.json()) == ['hall']
+    assert response.json() == client.post('/next-events/batch', json=[repeated], auth=AUTH).json()
+
+def test_batch_needs_credentials(api):
+    (_, client, starts) = api
+    assert client.post('/next-events/batch', json=valves(starts), auth=('user', 'wrong')).status_code == 401
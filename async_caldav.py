@@ -0,0 +1,90 @@
+import asyncio
+import datetime
+import logging
+
+import caldav
+import httpx
+from caldav.elements import cdav, dav
+from lxml import etree
+
+from metrics import CALDAV_REPORT_SECONDS, EVENT_PARSE_SECONDS
+from recurrence import RecurrenceExpander
+
+logger = logging.getLogger(__name__)
+
+class AsyncCalendar:
+    """
+    Read-only searches in a CalDAV calendar via httpx, such that concurrent
+    searches share a pool of keep-alive connections instead of each blocking
+    a thread. date_search mirrors caldav.Calendar.date_search as a coroutine;
+    with filter_sets (see caldav_filters.candidate_filters) it sends one
+    filtered REPORT per set, unless the server rejects them. Recurring events
+    are expanded locally (see recurrence.RecurrenceExpander), parsed by
+    `parser` (see ical_parser.PARSERS).
+    """
+
+    def __init__(self, url: str, username: str | None, password: str | None,
+                 timeout: float | None = None, max_connections: int = 20,
+                 filter_sets: list[list] | None = None, parser: str = 'vobject') -> None:
+        self.calendar = caldav.Calendar(url=url)
+        self.filter_sets = filter_sets
+        self.expander = RecurrenceExpander(parser=parser)
+        self.client = httpx.AsyncClient(
+            auth=httpx.BasicAuth(username, password) if username else None,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            headers={ 'Content-Type': 'application/xml; charset="utf-8"', 'Depth': '1' })
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def report(self, query: bytes) -> list[tuple[str, tuple[str | None, str]]]:
+        # (href, (ETag, calendar-data)) of all resources found
+        with CALDAV_REPORT_SECONDS.time():
+            response = await self.client.request('REPORT', str(self.calendar.url), content=query)
+        if response.status_code == 401:
+            raise caldav.error.AuthorizationError('%i %s' % (response.status_code, response.reason_phrase))
+        if response.status_code >= 400:
+            raise caldav.error.ReportError('%i %s' % (response.status_code, response.reason_phrase))
+        results = []
+        for element in etree.fromstring(response.content).iter(dav.Response.tag):
+            href = element.findtext(dav.Href.tag)
+            etag = element.findtext('.//' + dav.GetEtag.tag)
+            data = element.findtext('.//' + cdav.CalendarData.tag)
+            if href and data:
+                results.append((href, (etag, data)))
+        return results
+
+    async def date_search(self, start: datetime.datetime, end: datetime.datetime | None = None) -> list[caldav.Event]:
+        if self.filter_sets:
+            try:
+                reports = await asyncio.gather(*[self.search_report(start, end, filters)
+                                                 for filters in self.filter_sets])
+            except caldav.error.ReportError as e:
+                logger.warning("Server rejected filtered search, searching unfiltered (%s)", e)
+                self.filter_sets = None
+            else:
+                # an event may be found by several reports
+                return self.make_events(dict(resource for report in reports for resource in report), start, end)
+        return self.make_events(dict(await self.search_report(start, end)), start, end)
+
+    async def search_report(self, start: datetime.datetime, end: datetime.datetime | None,
+                            filters: list | None = None) -> list[tuple[str, tuple[str | None, str]]]:
+        (root, _) = self.calendar.build_search_xml_query(
+            comp_class=caldav.Event, start=start, end=end, props=[dav.GetEtag()],
+            filters=None if filters is None else list(filters))
+        query = etree.tostring(root.xmlelement(), encoding='utf-8', xml_declaration=True)
+        return await self.report(query)
+
+    def make_events(self, resources: dict[str, tuple[str | None, str]], start: datetime.datetime,
+                    end: datetime.datetime | None) -> list[caldav.Event]:
+        events = []
+        with EVENT_PARSE_SECONDS.time():
+            for (href, (etag, data)) in resources.items():
+                url = str(self.calendar.url.join(href))
+                resource = self.expander.parse((url, etag or data), data)
+                if end is None:
+                    events.append(self.expander.make_event(self.calendar, url, resource.vobj))
+                else:
+                    events += self.expander.make_events(self.calendar, url, resource.expand(start, end))
+        return events
@@ -0,0 +1,61 @@
+import asyncio
+import datetime
+
+import httpx
+
+from async_caldav import AsyncCalendar
+from logic import HeatNeededIndicator
+
+CALENDAR_URL = 'https://caldav.example.com/calendars/room/'
+
+def make_ics(uid: str, lines: str) -> str:
+    return ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//test//test//EN\r\nBEGIN:VEVENT\r\nUID:%s\r\n'
+            'DTSTAMP:19800101T000000Z\r\n%s\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n' % (uid, lines.replace('\n', '\r\n')))
+
+def make_multistatus(resources: dict[str, str]) -> str:
+    responses = ''.join(
+        '<D:response><D:href>/calendars/room/%s</D:href><D:propstat><D:prop>'
+        '<C:calendar-data>%s</C:calendar-data></D:prop><D:status>HTTP/1.1 200 OK</D:status>'
+        '</D:propstat></D:response>' % (name, data) for (name, data) in resources.items())
+    return ('<?xml version="1.0" encoding="utf-8"?><D:multistatus xmlns:D="DAV:" '
+            'xmlns:C="urn:ietf:params:xml:ns:caldav">%s</D:multistatus>' % responses)
+
+def make_datetime(hour: int, minute: int = 0) -> datetime.datetime:
+    return datetime.datetime(1980, 1, 1, hour, minute, tzinfo=datetime.timezone.utc)
+
+def make_calendar(handler) -> AsyncCalendar:
+    calendar = AsyncCalendar(CALENDAR_URL, 'user', 'password')
+    calendar.client = httpx.AsyncClient(transport=httpx.MockTransport(handler), headers=calendar.client.headers,
+                                        auth=calendar.client.auth)
+    return calendar
+
+def test_date_search_and_per_call_margins():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(207, text=make_multistatus({
+            'noon.ics': make_ics('noon', 'DTSTART:19800101T120000Z\nDTEND:19800101T140000Z\nSUMMARY:Noon'),
+            'cold.ics': make_ics('cold', 'DTSTART:19800101T120000Z\nDTEND:19800101T140000Z\nSUMMARY:Cold\n'
+                                         'DESCRIPTION:!cold!'),
+            'daily.ics': make_ics('daily', 'DTSTART:19791230T110000Z\nDTEND:19791230T123000Z\nSUMMARY:Daily\n'
+                                           'RRULE:FREQ=DAILY'),
+            }), headers={ 'Content-Type': 'application/xml' })
+
+    async def run():
+        calendar = make_calendar(handler)
+        indicator = HeatNeededIndicator(preheat_minutes=0, cooloff_minutes=0, no_heat_tag='!cold!')
+        (early, late) = await asyncio.gather(
+            indicator.get_next_events_async(calendar, make_datetime(11, 0), preheat_minutes=60, cooloff_minutes=0),
+            indicator.get_next_events_async(calendar, make_datetime(12, 15), preheat_minutes=0, cooloff_minutes=30))
+        await calendar.aclose()
+        return early, late
+
+    (early, late) = asyncio.run(run())
+    assert len(requests) == 2
+    assert all(request.method == 'REPORT' and request.headers['Depth'] == '1' for request in requests)
+    # recurring events are expanded locally
+    assert b'<C:expand' not in requests[0].content
+    assert sorted(event.summary for event in early) == ['Daily', 'Noon']
+    assert [event.dtstart for event in early if event.summary == 'Daily'] == [make_datetime(11, 0)]
+    assert sorted(event.summary for event in late) == ['Noon']
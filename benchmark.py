@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import asyncio
+import datetime
+import functools
+import gc
+import hashlib
+import http.server
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable
+from xml.sax.saxutils import escape
+
+import caldav
+from lxml import etree
+
+import ical_parser
+from async_caldav import AsyncCalendar
+from caldav_filters import FilteringCalendar, candidate_filters
+from calendar_cache import CachedCalendar
+from logic import HeatNeededIndicator
+
+CALENDAR_PATH = '/calendars/benchmark/'
+NO_HEAT_TAG = '!cold!'
+
+NS_DAV = 'DAV:'
+NS_CALDAV = 'urn:ietf:params:xml:ns:caldav'
+
+@dataclass
+class Resource:
+    data: str
+    etag: str
+    start: datetime.datetime
+    # None for recurring events
+    end: datetime.datetime | None
+
+    @functools.cached_property
+    def vevent_properties(self) -> list[dict[str, tuple[str, str]]]:
+        # name -> (parameters, value) of the properties of each VEVENT
+        vevents = []
+        for block in self.data.split('BEGIN:VEVENT\r\n')[1:]:
+            properties = {}
+            for line in block.split('END:VEVENT')[0].splitlines():
+                (name_and_parameters, _, value) = line.partition(':')
+                (name, _, parameters) = name_and_parameters.partition(';')
+                properties[name] = (parameters, value)
+            vevents.append(properties)
+        return vevents
+
+def prop_filter_matches(prop_filter: etree._Element, properties: dict[str, tuple[str, str]]) -> bool:
+    # is-not-defined, param-filter with is-not-defined and text-match; anything else is ignored
+    prop = properties.get(prop_filter.get('name'))
+    for condition in prop_filter:
+        if condition.tag == '{%s}is-not-defined' % NS_CALDAV:
+            return prop is None
+        if prop is None:
+            return False
+        if condition.tag == '{%s}param-filter' % NS_CALDAV:
+            defined = (condition.get('name') + '=') in prop[0]
+            if condition.find('{%s}is-not-defined' % NS_CALDAV) is not None and defined:
+                return False
+        elif condition.tag == '{%s}text-match' % NS_CALDAV:
+            negate = condition.get('negate-condition') == 'yes'
+            if (condition.text in prop[1]) == negate:
+                return False
+    return True
+
+def ical_datetime(value: datetime.datetime) -> str:
+    return value.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def make_resource(vevents: list[str]) -> str:
+    return ('BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//caldav-trigger//benchmark//EN\r\n%s'
+            'END:VCALENDAR\r\n' % ''.join('BEGIN:VEVENT\r\n%sEND:VEVENT\r\n' % vevent for vevent in vevents))
+
+def make_vevent(uid: str, summary: str, start: datetime.datetime, end: datetime.datetime,
+                description: str | None = None, extra: str = '') -> str:
+    lines = 'UID:%s\r\nDTSTAMP:20240101T000000Z\r\nSUMMARY:%s\r\nDTSTART:%s\r\nDTEND:%s\r\n' % (
+        uid, summary, ical_datetime(start), ical_datetime(end))
+    if description is not None:
+        lines += 'DESCRIPTION:%s\r\n' % description
+    return lines + extra
+
+def random_slot(rng: random.Random, day: datetime.datetime) -> tuple[datetime.datetime, datetime.datetime]:
+    start = day.replace(hour=rng.randint(7, 19), minute=rng.choice([0, 15, 30, 45]), second=0, microsecond=0)
+    return start, start + datetime.timedelta(minutes=rng.choice([30, 45, 60, 90, 120, 180]))
+
+def random_description(rng: random.Random, no_heat_share: float) -> str | None:
+    choice = rng.random()
+    if choice < no_heat_share:
+        return 'Windows open %s' % NO_HEAT_TAG
+    if choice < no_heat_share + 0.5:
+        return 'Booked by group %i' % rng.randint(1, 50)
+    return None
+
+def generate_calendar(now: datetime.datetime, events: int, series: int, overrides: int, days: int = 60,
+                      whole_day_share: float = 0.03, no_heat_share: float = 0.05,
+                      seed: int = 0) -> dict[str, Resource]:
+    # Single events spread over `days` around `now`, weekly or daily series started before and
+    # overrides moving single occurrences of them. Shares of the single events are whole-day or
+    # tagged not to heat.
+    rng = random.Random(seed)
+    first_day = (now - datetime.timedelta(days=days // 2)).astimezone(datetime.timezone.utc)
+    resources = {}
+
+    def add(name: str, vevents: list[str], start: datetime.datetime, end: datetime.datetime | None) -> None:
+        data = make_resource(vevents)
+        resources[CALENDAR_PATH + name + '.ics'] = Resource(data, '"%s"' % hashlib.md5(data.encode()).hexdigest(),
+                                                            start, end)
+
+    for i in range(events):
+        day = first_day + datetime.timedelta(days=rng.randrange(days))
+        (start, end) = random_slot(rng, day)
+        if rng.random() < whole_day_share:
+            vevent = ('UID:event-%i\r\nDTSTAMP:20240101T000000Z\r\nSUMMARY:Holiday %i\r\n'
+                      'DTSTART;VALUE=DATE:%s\r\nDTEND;VALUE=DATE:%s\r\n' % (
+                          i, i, day.strftime('%Y%m%d'), (day + datetime.timedelta(days=1)).strftime('%Y%m%d')))
+            start = day.replace(hour=0, minute=0)
+            end = start + datetime.timedelta(days=1)
+        else:
+            vevent = make_vevent('event-%i' % i, 'Event %i' % i, start, end, random_description(rng, no_heat_share))
+        add('event-%i' % i, [vevent], start, end)
+
+    overrides_left = overrides
+    for i in range(series):
+        # started up to 8 weeks ago, running for a year
+        day = first_day - datetime.timedelta(days=rng.randrange(56))
+        (start, end) = random_slot(rng, day)
+        if rng.random() < 0.2:
+            (step, rule) = (datetime.timedelta(days=1), 'FREQ=DAILY;COUNT=365')
+        else:
+            (step, rule) = (datetime.timedelta(weeks=1), 'FREQ=WEEKLY;COUNT=52')
+        vevents = [make_vevent('series-%i' % i, 'Series %i' % i, start, end, random_description(rng, 0),
+                               'RRULE:%s\r\n' % rule)]
+        # spread the overrides evenly over the series
+        for _ in range(overrides_left // (series - i)):
+            occurrence = start + step * rng.randrange(1, (now - start + datetime.timedelta(days=days)) // step)
+            moved = occurrence + datetime.timedelta(hours=rng.choice([-2, -1, 1, 2]))
+            vevents.append(make_vevent('series-%i' % i, 'Series %i (moved)' % i, moved, moved + (end - start),
+                                       None, 'RECURRENCE-ID:%s\r\n' % ical_datetime(occurrence)))
+            overrides_left -= 1
+        add('series-%i' % i, vevents, start, None)
+
+    return resources
+
+class CalDAVHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Just enough of a read-only CalDAV server for the searches done by caldav,
+    AsyncCalendar and CachedCalendar: PROPFIND for ctag and ETags, and the
+    calendar-query, calendar-multiget and sync-collection REPORTs. Recurring
+    events are never expanded by the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body in one segment, otherwise delayed ACKs add 40 ms to each response
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    resources: dict[str, Resource] = {}
+    sync_token = 'benchmark-1'
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_multistatus(self, responses: list[str], extra: str = '') -> None:
+        body = ('<?xml version="1.0" encoding="utf-8"?>\n<D:multistatus xmlns:D="DAV:" '
+                'xmlns:C="urn:ietf:params:xml:ns:caldav" xmlns:CS="http://calendarserver.org/ns/">%s%s'
+                '</D:multistatus>' % (''.join(responses), extra)).encode()
+        self.send_response(207)
+        self.send_header('Content-Type', 'application/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def response(href: str, props: str) -> str:
+        return ('<D:response><D:href>%s</D:href><D:propstat><D:prop>%s</D:prop>'
+                '<D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>' % (href, props))
+
+    def resource_response(self, href: str, with_data: bool) -> str:
+        resource = self.resources[href]
+        props = '<D:getetag>%s</D:getetag>' % escape(resource.etag)
+        if with_data:
+            props += '<C:calendar-data>%s</C:calendar-data>' % escape(resource.data)
+        return self.response(href, props)
+
+    def read_body(self) -> etree._Element | None:
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        return etree.fromstring(body) if body else None
+
+    def do_GET(self) -> None:
+        if (resource := self.resources.get(self.path)) is None:
+            self.send_error(404)
+            return
+        body = resource.data.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/calendar; charset=utf-8')
+        self.send_header('ETag', resource.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PROPFIND(self) -> None:
+        self.read_body()
+        responses = [self.response(CALENDAR_PATH, '<D:resourcetype><D:collection/><C:calendar/></D:resourcetype>'
+                                                  '<D:displayname>Benchmark</D:displayname>'
+                                                  '<CS:getctag>%s</CS:getctag>' % self.sync_token)]
+        if self.headers.get('Depth', '0') != '0':
+            responses += [self.resource_response(href, False) for href in self.resources]
+        self.send_multistatus(responses)
+
+    def do_REPORT(self) -> None:
+        query = self.read_body()
+        if query.tag == '{%s}calendar-multiget' % NS_CALDAV:
+            hrefs = [element.text for element in query.iter('{%s}href' % NS_DAV)]
+            self.send_multistatus([self.resource_response(href, True) for href in hrefs if href in self.resources])
+        elif query.tag == '{%s}sync-collection' % NS_DAV:
+            token = query.findtext('{%s}sync-token' % NS_DAV)
+            hrefs = [] if token == self.sync_token else list(self.resources)
+            self.send_multistatus([self.resource_response(href, False) for href in hrefs],
+                                  '<D:sync-token>%s</D:sync-token>' % self.sync_token)
+        else:
+            time_range = next(query.iter('{%s}time-range' % NS_CALDAV), None)
+            (start, end) = (None, None)
+            if time_range is not None:
+                parse = lambda value: None if value is None else datetime.datetime.strptime(
+                    value, '%Y%m%dT%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
+                (start, end) = (parse(time_range.get('start')), parse(time_range.get('end')))
+            prop_filters = list(query.iter('{%s}prop-filter' % NS_CALDAV))
+            self.send_multistatus([self.resource_response(href, True) for (href, resource) in self.resources.items()
+                                   if (end is None or resource.start < end)
+                                   and (start is None or resource.end is None or resource.end > start)
+                                   and (not prop_filters or any(
+                                       all(prop_filter_matches(prop_filter, properties) for prop_filter in prop_filters)
+                                       for properties in resource.vevent_properties))])
+
+class ThreadingHTTPServer(http.server.ThreadingHTTPServer):
+    # concurrent API requests open more connections at once than the default backlog of 5
+    request_queue_size = 128
+    daemon_threads = True
+
+class CalDAVServer:
+    """In-process CalDAV server for `resources`, serving in a background thread."""
+
+    def __init__(self, resources: dict[str, Resource]) -> None:
+        handler = type('Handler', (CalDAVHandler,), { 'resources': resources })
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def calendar_url(self) -> str:
+        return 'http://127.0.0.1:%i%s' % (self.server.server_port, CALENDAR_PATH)
+
+    def __enter__(self) -> 'CalDAVServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+@dataclass
+class Measurement:
+    name: str
+    seconds: list[float]
+    peak_bytes: int
+    count: int
+
+def measure(name: str, run: Callable[[], int], repeat: int) -> Measurement:
+    # Latencies without tracing, then the peak of memory allocated by one more run
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        count = run()
+        seconds.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return Measurement(name, seconds, peak_bytes, count)
+
+def run_benchmarks(resources: dict[str, Resource], now: datetime.datetime, horizon_minutes: int,
+                   concurrency: int, repeat: int, parser: str = 'vobject') -> list[Measurement]:
+    (read, _) = ical_parser.PARSERS[parser]
+    indicator = HeatNeededIndicator(preheat_minutes=60, cooloff_minutes=15, no_heat_tag=NO_HEAT_TAG)
+    until = now + datetime.timedelta(minutes=horizon_minutes)
+    measurements = []
+
+    with CalDAVServer(resources) as server:
+        client = caldav.DAVClient(url=server.calendar_url)
+        calendar = caldav.Calendar(client=client, url=server.calendar_url)
+
+        # caldav-trigger.py: one check, and the horizon of a daemon or API window, with and
+        # without server-side filters
+        filter_sets = candidate_filters(NO_HEAT_TAG)
+        filtering_calendar = FilteringCalendar(calendar, filter_sets, parser)
+        for (label, end, search_calendar) in [('check', None, filtering_calendar),
+                                              ('horizon', until, filtering_calendar),
+                                              ('horizon unfiltered', until, calendar)]:
+            (begin_search, end_search, cooloff_timestamp) = indicator.search_window(now, end)
+            objects = []
+            data = []
+
+            def fetch() -> int:
+                objects[:] = search_calendar.date_search(start=begin_search, end=end_search)
+                data[:] = [obj.data for obj in objects]
+                return len(objects)
+
+            def parse() -> int:
+                # from the received data again in each run
+                return len([read(obj_data) for obj_data in data])
+
+            measurements.append(measure('trigger %s: fetch' % label, fetch, repeat))
+            measurements.append(measure('trigger %s: parse' % label, parse, repeat))
+            measurements.append(measure('trigger %s: filter' % label, lambda: len(indicator.filter_events(
+                objects, cooloff_timestamp, begin_search, end_search)), repeat))
+
+        # caldav-trigger.py with calendar_cache_file or --daemon
+        cached = [None]
+
+        def initial_sync() -> int:
+            cached[0] = CachedCalendar(calendar, parser=parser)
+            cached[0].refresh()
+            return len(cached[0].objects)
+
+        measurements.append(measure('cache: initial sync', initial_sync, repeat))
+        measurements.append(measure('cache: unchanged sync', lambda: cached[0].refresh() or len(cached[0].objects),
+                                    repeat))
+        measurements.append(measure('cache: horizon', lambda: len(indicator.get_next_events(cached[0], now, until)),
+                                    repeat))
+
+        # api_server.py: one request, and concurrent requests with different margins
+        async def api_requests(count: int) -> int:
+            async_calendar = AsyncCalendar(server.calendar_url, None, None, max_connections=concurrency,
+                                           filter_sets=filter_sets, parser=parser)
+            try:
+                results = await asyncio.gather(*[
+                    indicator.get_next_events_async(async_calendar, now, until, preheat_minutes=i % 120,
+                                                    cooloff_minutes=i % 30) for i in range(count)])
+            finally:
+                await async_calendar.aclose()
+            return sum(len(result) for result in results)
+
+        measurements.append(measure('api: request', lambda: asyncio.run(api_requests(1)), repeat))
+        measurements.append(measure('api: %i concurrent' % concurrency,
+                                    lambda: asyncio.run(api_requests(concurrency)), repeat))
+        client.close()
+
+    # the calendar data of a large REPORT response, by each parser
+    for (name, (read_data, _)) in ical_parser.PARSERS.items():
+        def parse_all(read_data=read_data) -> int:
+            # all parsed at once, as the response of an unfiltered search
+            parsed = [read_data(resource.data) for resource in resources.values()]
+            return sum(len(vobj.contents.get('vevent', [])) for vobj in parsed)
+
+        measurements.append(measure('parse all: %s' % name, parse_all, repeat))
+
+    return measurements
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Measure fetching, parsing and filtering events of a synthetic calendar served locally.')
+    parser.add_argument('--events', type=int, default=2000, help='single events (default: %(default)s)')
+    parser.add_argument('--series', type=int, default=100, help='recurring series (default: %(default)s)')
+    parser.add_argument('--overrides', type=int, default=200,
+                        help='moved occurrences of the series (default: %(default)s)')
+    parser.add_argument('--days', type=int, default=60,
+                        help='days around now the single events are spread over (default: %(default)s)')
+    parser.add_argument('--whole-day', type=float, default=0.03,
+                        help='share of whole-day single events (default: %(default)s)')
+    parser.add_argument('--no-heat', type=float, default=0.05,
+                        help='share of single events tagged not to heat (default: %(default)s)')
+    parser.add_argument('--horizon-minutes', type=int, default=24 * 60,
+                        help='search window of daemon and API requests (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=20,
+                        help='concurrent API requests (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each step (default: %(default)s)')
+    parser.add_argument('--parser', choices=ical_parser.PARSERS, default='vobject',
+                        help='iCalendar parser of the trigger, cache and api steps (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    now = datetime.datetime.now().astimezone().replace(hour=12, minute=0, second=0, microsecond=0)
+    resources = generate_calendar(now, args.events, args.series, args.overrides, args.days,
+                                  args.whole_day, args.no_heat, args.seed)
+    print('%i events, %i series with %i overrides over %i days, %i kB of iCalendar data' % (
+        args.events, args.series, args.overrides, args.days,
+        sum(len(resource.data) for resource in resources.values()) // 1024))
+    print('%-34s %8s %10s %10s %10s' % ('', 'items', 'median ms', 'min ms', 'peak KiB'))
+    for measurement in run_benchmarks(resources, now, args.horizon_minutes, args.concurrency, args.repeat,
+                                      args.parser):
+        print('%-34s %8i %10.1f %10.1f %10i' % (
+            measurement.name, measurement.count, statistics.median(measurement.seconds) * 1000,
+            min(measurement.seconds) * 1000, measurement.peak_bytes // 1024))
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,46 @@
+import asyncio
+import datetime
+
+import caldav
+
+from async_caldav import AsyncCalendar
+from benchmark import CalDAVServer, generate_calendar, run_benchmarks
+from calendar_cache import CachedCalendar
+from logic import HeatNeededIndicator
+
+NOW = datetime.datetime(2024, 3, 6, 12, tzinfo=datetime.timezone.utc)
+
+def test_generated_calendar_is_served_consistently():
+    resources = generate_calendar(NOW, events=40, series=3, overrides=3, days=14)
+    assert len(resources) == 43
+    indicator = HeatNeededIndicator(preheat_minutes=60, cooloff_minutes=15)
+    until = NOW + datetime.timedelta(days=3)
+
+    with CalDAVServer(resources) as server:
+        calendar = caldav.Calendar(client=caldav.DAVClient(url=server.calendar_url), url=server.calendar_url)
+        cached = CachedCalendar(calendar)
+        cached.refresh()
+        assert len(cached.objects) == len(resources)
+        from_cache = indicator.get_next_events(cached, NOW, until)
+        parsed_fast = CachedCalendar(calendar, parser='fast')
+        parsed_fast.refresh()
+        from_fast_parser = indicator.get_next_events(parsed_fast, NOW, until)
+
+        async def search() -> list:
+            async_calendar = AsyncCalendar(server.calendar_url, None, None)
+            try:
+                return await indicator.get_next_events_async(async_calendar, NOW, until)
+            finally:
+                await async_calendar.aclose()
+
+        from_server = asyncio.run(search())
+
+    key = lambda events: sorted((event.summary, event.dtstart) for event in events)
+    assert any(not event.summary.startswith('Event') for event in from_cache)
+    assert key(from_cache) == key(from_server)
+    assert key(from_cache) == key(from_fast_parser)
+
+def test_benchmarks_run():
+    resources = generate_calendar(NOW, events=20, series=2, overrides=2, days=14)
+    measurements = run_benchmarks(resources, NOW, horizon_minutes=60, concurrency=2, repeat=1)
+    assert all(measurement.seconds and measurement.peak_bytes > 0 for measurement in measurements)
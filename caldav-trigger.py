@@ -1,62 +1,419 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+from __future__ import annotations
+
+import argparse
+import atexit
+import concurrent.futures
 import datetime
+import json
 import os
+import select
+import signal
+import socket
 import sys
 import textwrap
+import time
 
-import caldav
 import dotenv
-import subprocess
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+from actions import Action, LazyAction
+from dispatch import DeadlineExceeded, Dispatcher, start_daemon
+from logic import HeatingTimeline
+from rooms import Room, load_rooms
+from snapshot import EventSnapshot, Snapshot
+from state_store import StateStore
 
-from logic import HeatNeededIndicator
+if TYPE_CHECKING:
+    import caldav
+    from caldav_filters import FilteringCalendar
+    from calendar_cache import CachedCalendar
 
 EXIT_OK                = 0
 EXIT_ACTION_FAILED     = 1
+EXIT_ROOM_TIMEOUT      = 2
 
 def float_or_none(value):
     return None if value is None else float(value)
 
+# Imported by connect(): part of every start-up but in daemon mode from a snapshot, see --profile-startup
+CONNECT_IMPORTS = ('caldav', 'requests')
+
+def connect(caldav_url: str, caldav_user: str, caldav_password: str, caldav_timeout: float | None,
+            pool_size: int) -> tuple[caldav.DAVClient, caldav.Principal]:
+    # caldav and requests are imported on first use: rooms are switched from the snapshot meanwhile
+    import caldav
+    import requests
+
+    client = caldav.DAVClient(url=caldav_url, username=caldav_user, password=caldav_password, timeout=caldav_timeout)
+    # one connection per room that is evaluated in parallel
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    client.session.mount('https://', adapter)
+    client.session.mount('http://', adapter)
+    principal = client.principal()
+    return client, principal
+
+def room_cache_file(cache_file: str | None, room: Room, rooms: list[Room]) -> str | None:
+    if cache_file is None or len(rooms) == 1:
+        return cache_file
+    (root, ext) = os.path.splitext(cache_file)
+    return '%s.%s%s' % (root, room.calendar_id, ext)
+
+def run_action(action: Action, need_heating: bool, wrapper: textwrap.TextWrapper) -> int:
+    try:
+        action_result = action.set_state(need_heating)
+    except Exception as e:
+        print(wrapper.fill("Action failed (%s)" % e))
+        return EXIT_ACTION_FAILED
+    return EXIT_OK if action_result == 0 else EXIT_ACTION_FAILED
+
+def apply_state(room: Room, action: Action, need_heating: bool, now: datetime.datetime, state_store: StateStore,
+                reassert_interval: datetime.timedelta, wrapper: textwrap.TextWrapper) -> int:
+    # Run the action only if the state changed or was last applied reassert_interval ago
+    state = state_store.get(room.name)
+    if state is not None and state['heating'] == need_heating:
+        applied_at = datetime.datetime.fromisoformat(state['applied_at'])
+        if now < applied_at + reassert_interval:
+            print(wrapper.fill("Unchanged since %s" % applied_at))
+            return EXIT_OK
+
+    result = run_action(action, need_heating, wrapper)
+    if result == EXIT_OK:
+        state_store.set(room.name, { 'heating': need_heating, 'applied_at': now.isoformat() })
+    return result
+
+def switched(future: concurrent.futures.Future, wrapper: textwrap.TextWrapper) -> int:
+    try:
+        return future.result()
+    except DeadlineExceeded as e:
+        print(wrapper.fill("Not switched (%s)" % e))
+        return EXIT_ROOM_TIMEOUT
+
+def switch(room: Room, action: Action, need_heating: bool, now: datetime.datetime, dispatcher: Dispatcher,
+           state_store: StateStore, reassert_interval: datetime.timedelta, wrapper: textwrap.TextWrapper,
+           timeout: float | None = None) -> int:
+    # apply_state through the dispatch queue of the action's backend, waiting at most `timeout` seconds:
+    # e.g. behind an action of the room that hangs. Switches taking longer are reported once done.
+    future = dispatcher.submit(room.name, os.path.basename(room.action), lambda: apply_state(
+        room, action, need_heating, now, state_store, reassert_interval, wrapper))
+    (done, _) = concurrent.futures.wait([future], timeout)
+    if not done:
+        future.add_done_callback(lambda future: switched(future, wrapper))
+        if timeout:
+            print(wrapper.fill("Still switching after %s seconds" % timeout))
+        return EXIT_ROOM_TIMEOUT
+    return switched(future, wrapper)
+
+def fetch_timeline(room: Room, calendar: FilteringCalendar | CachedCalendar, now: datetime.datetime,
+                   until: datetime.datetime, snapshot: EventSnapshot) -> HeatingTimeline:
+    # Heating up to `until` from the events of the next snapshot.horizon at least, which are
+    # saved to the snapshot without preheat/cooloff applied
+    end = max(until + datetime.timedelta(minutes=room.indicator.preheat_minutes), now + snapshot.horizon)
+    fetched = Snapshot(room.indicator.get_event_store(calendar, now, end, 0, 0), now, end, now)
+    snapshot.save(room.calendar_id, room.indicator.no_heat_tag, fetched)
+    return fetched.timeline(room.indicator, now)
+
+def check_room_snapshot(room: Room, action: Action, now: datetime.datetime, snapshot: EventSnapshot | None,
+                        dispatcher: Dispatcher, state_store: StateStore, reassert_interval: datetime.timedelta,
+                        wrapper: textwrap.TextWrapper, timeout: float | None = None
+                        ) -> tuple[int, datetime.datetime | None]:
+    # Switch according to the events last fetched (see switch for `timeout`), returns the result and
+    # the next transition
+    saved = None if snapshot is None else snapshot.load_fresh(
+        room.calendar_id, room.indicator.no_heat_tag, now, room.indicator.preheat_minutes)
+    if saved is None:
+        if snapshot is not None:
+            print(wrapper.fill("No recent snapshot of the calendar, not switching"))
+        return (EXIT_ACTION_FAILED, None)
+    timeline = saved.timeline(room.indicator, now)
+    need_heating = timeline.is_needed(now)
+    print(wrapper.fill("%s according to the snapshot of %s" % (
+        "Heating needed" if need_heating else "No heating needed", saved.fetched_at)))
+    result = switch(room, action, need_heating, now, dispatcher, state_store, reassert_interval, wrapper, timeout)
+    return (result, timeline.next_transition(now))
+
+def check_room(room: Room, action: Action, calendar: FilteringCalendar | CachedCalendar,
+               now: datetime.datetime, deadline: float | None, snapshot: EventSnapshot | None,
+               dispatcher: Dispatcher, state_store: StateStore, reassert_interval: datetime.timedelta,
+               wrapper: textwrap.TextWrapper) -> int:
+    from calendar_cache import CachedCalendar
+
+    if isinstance(calendar, CachedCalendar):
+        calendar.refresh()
+    if snapshot is not None:
+        need_heating = fetch_timeline(room, calendar, now, now, snapshot).is_needed(now)
+    else:
+        need_heating = room.indicator.is_needed(calendar, now)
+    print(wrapper.fill("Heating needed" if need_heating else "No heating needed"))
+    if deadline is not None and time.monotonic() > deadline:
+        print(wrapper.fill("Deadline exceeded, not switching"))
+        return EXIT_ROOM_TIMEOUT
+    return switch(room, action, need_heating, now, dispatcher, state_store, reassert_interval, wrapper)
+
+def run_once(connect_args: tuple, rooms: list[Room], actions: dict[str, Action],
+             wrappers: dict[str, textwrap.TextWrapper], deadline_seconds: float | None, cache_file: str | None,
+             server_filters: bool, event_parser: str, snapshot: EventSnapshot | None, dispatcher: Dispatcher,
+             state_store: StateStore, reassert_interval: datetime.timedelta) -> int:
+    now = datetime.datetime.now().astimezone()
+    print("Checking at %s" % now)
+
+    deadline = None if deadline_seconds is None else time.monotonic() + deadline_seconds
+    try:
+        client, principal = connect(*connect_args, len(rooms))
+    except Exception as e:
+        if snapshot is None:
+            raise
+        print("Cannot access CalDAV server (%s)" % e)
+        # the outage is still reported by the exit code
+        return max(EXIT_ACTION_FAILED, *(check_room_snapshot(room, actions[room.name], now, snapshot, dispatcher,
+                                                             state_store, reassert_interval, wrappers[room.name],
+                                                             deadline_seconds)[0]
+                                         for room in rooms))
+    from caldav_filters import FilteringCalendar, candidate_filters
+    from calendar_cache import CachedCalendar
+
+    with client:
+        futures = {}
+        for room in rooms:
+            calendar = principal.calendar(cal_id=room.calendar_id)
+            if cache_file is not None:
+                calendar = CachedCalendar(calendar, room_cache_file(cache_file, room, rooms), event_parser)
+            else:
+                # only events that may need heating are downloaded
+                calendar = FilteringCalendar(calendar,
+                                             candidate_filters(room.indicator.no_heat_tag) if server_filters else [],
+                                             event_parser)
+            # one daemon thread per room: a room past the deadline does not hold up the exit
+            futures[start_daemon(check_room, room, actions[room.name], calendar, now, deadline, snapshot,
+                                 dispatcher, state_store, reassert_interval, wrappers[room.name])] = room
+        (done, not_done) = concurrent.futures.wait(futures, timeout=deadline_seconds)
+
+    result = EXIT_OK
+    for future in done:
+        try:
+            result = max(result, future.result())
+        except Exception as e:
+            room = futures[future]
+            print(wrappers[room.name].fill("Cannot access calendar (%s)" % e))
+            result = max(result, EXIT_ACTION_FAILED,
+                         check_room_snapshot(room, actions[room.name], now, snapshot, dispatcher, state_store,
+                                             reassert_interval, wrappers[room.name], deadline_seconds)[0])
+    for future in not_done:
+        room = futures[future]
+        # the room does not switch anymore once past the deadline, the snapshot decides instead (waiting
+        # once more at most as long: the room's action may be what hangs)
+        print(wrappers[room.name].fill("Deadline exceeded, not switching" if snapshot is None else "Deadline exceeded"))
+        result = max(result, EXIT_ROOM_TIMEOUT)
+        if snapshot is not None:
+            result = max(result, check_room_snapshot(room, actions[room.name], now, snapshot, dispatcher, state_store,
+                                                     reassert_interval, wrappers[room.name], deadline_seconds)[0])
+    return result
+
+def write_pid_file(pid_file: str) -> None:
+    # For api_server.py to notify the daemon, removed again on exit
+    pid = os.getpid()
+    with open(pid_file, 'w') as file:
+        file.write('%i\n' % pid)
+
+    def remove() -> None:
+        try:
+            with open(pid_file) as file:
+                # unless written by another daemon meanwhile
+                if int(file.read()) == pid:
+                    os.remove(pid_file)
+        except (OSError, ValueError):
+            pass
+
+    atexit.register(remove)
+
+def check_room_daemon(room: Room, action: Action, calendar: CachedCalendar,
+                      now: datetime.datetime, until: datetime.datetime, snapshot: EventSnapshot | None,
+                      dispatcher: Dispatcher, state_store: StateStore, reassert_interval: datetime.timedelta,
+                      wrapper: textwrap.TextWrapper) -> datetime.datetime | None:
+    # Returns the next transition up to `until`
+    calendar.refresh()
+    if snapshot is not None:
+        timeline = fetch_timeline(room, calendar, now, until, snapshot)
+    else:
+        timeline = room.indicator.get_timeline(calendar, now, until)
+    need_heating = timeline.is_needed(now)
+    print(wrapper.fill("Heating needed" if need_heating else "No heating needed"))
+    switch(room, action, need_heating, now, dispatcher, state_store, reassert_interval, wrapper)
+
+    next_transition = timeline.next_transition(now)
+    if next_transition is not None:
+        print(wrapper.fill("Next transition at %s" % next_transition))
+    return next_transition
+
+def run_daemon(connect_args: tuple, rooms: list[Room], actions: dict[str, Action],
+               wrappers: dict[str, textwrap.TextWrapper], deadline_seconds: float | None, cache_file: str | None,
+               event_parser: str, snapshot: EventSnapshot | None, dispatcher: Dispatcher, state_store: StateStore,
+               reassert_interval: datetime.timedelta, recheck_seconds: float, pid_file: str | None = None) -> int:
+    # Keep the CalDAV connection open and sleep until the next transition, but re-check the
+    # calendars at least every recheck_seconds such that edits are picked up, or right away on
+    # SIGUSR1 (see api_server.py /notify). With a snapshot, rooms are switched according to it
+    # right away and whenever their calendar cannot be accessed.
+    sys.stdout.reconfigure(line_buffering=True)
+    # the signal only wakes up select() below, such that it can arrive at any time
+    (notifications, notify) = socket.socketpair()
+    notify.setblocking(False)
+    signal.set_wakeup_fd(notify.fileno())
+    signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+    # stopped by SIGTERM, the PID file is removed as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    if pid_file:
+        # only once SIGUSR1 does not terminate the process anymore
+        write_pid_file(pid_file)
+    recheck_interval = datetime.timedelta(seconds=recheck_seconds)
+    client = None
+    cached_calendars = { room.name: None for room in rooms }
+    rooms_by_name = { room.name: room for room in rooms }
+    pending = {}
+
+    # switches from the snapshot are not waited for: one behind a hanging action would stall the loop
+    def from_snapshot(room: Room, now: datetime.datetime, wake_up: datetime.datetime) -> datetime.datetime:
+        (_, next_transition) = check_room_snapshot(room, actions[room.name], now, snapshot, dispatcher, state_store,
+                                                   reassert_interval, wrappers[room.name], timeout=0)
+        return wake_up if next_transition is None else min(wake_up, next_transition)
+
+    if snapshot is not None:
+        now = datetime.datetime.now().astimezone()
+        print("Starting from snapshot at %s" % now)
+        for room in rooms:
+            check_room_snapshot(room, actions[room.name], now, snapshot, dispatcher, state_store, reassert_interval,
+                                wrappers[room.name], timeout=0)
+
+    while True:
+        now = datetime.datetime.now().astimezone()
+        print("Checking at %s" % now)
+        wake_up = now + recheck_interval
+
+        try:
+            if client is None:
+                client, principal = connect(*connect_args, len(rooms))
+                from calendar_cache import CachedCalendar
+
+                for room in rooms:
+                    calendar = principal.calendar(cal_id=room.calendar_id)
+                    if cached_calendars[room.name] is None:
+                        cached_calendars[room.name] = CachedCalendar(calendar, room_cache_file(cache_file, room, rooms),
+                                                                     event_parser)
+                    else:
+                        cached_calendars[room.name].calendar = calendar
+        except Exception as e:
+            print("Cannot access CalDAV server (%s), retrying at %s" % (e, wake_up))
+            client = None
+            for room in rooms:
+                wake_up = from_snapshot(room, now, wake_up)
+        else:
+            for room in rooms:
+                # a room still busy since an earlier check is not checked again
+                if room.name not in pending.values():
+                    pending[start_daemon(check_room_daemon, room, actions[room.name], cached_calendars[room.name],
+                                         now, now + recheck_interval, snapshot, dispatcher, state_store,
+                                         reassert_interval, wrappers[room.name])] = room.name
+            (done, not_done) = concurrent.futures.wait(pending, timeout=deadline_seconds)
+
+            reconnect = False
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    next_transition = future.result()
+                except Exception as e:
+                    print(wrappers[name].fill("Cannot access calendar (%s), retrying at %s" % (e, wake_up)))
+                    reconnect = True
+                    wake_up = from_snapshot(rooms_by_name[name], now, wake_up)
+                    continue
+                if next_transition is not None and next_transition < wake_up:
+                    wake_up = next_transition
+            for future in not_done:
+                print(wrappers[pending[future]].fill("Deadline exceeded, still waiting for calendar"))
+                wake_up = from_snapshot(rooms_by_name[pending[future]], now, wake_up)
+            if reconnect:
+                client.close()
+                client = None
+
+        (readable, _, _) = select.select([notifications], [], [],
+                                         max(0, (wake_up - datetime.datetime.now().astimezone()).total_seconds()))
+        if readable:
+            notifications.recv(256)
+            print("Calendar change notified")
+
 def main() -> int:
+    parser = argparse.ArgumentParser(description='Switch heating according to CalDAV room occupation.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and switch exactly at transition times instead of checking once')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='report the time up to the first CalDAV request by import and fail if above '
+                             'startup_target_ms')
+    args = parser.parse_args()
+
     dotenv.load_dotenv()
 
+    if args.profile_startup:
+        import startup
+        return startup.profile(__file__, float(os.getenv('startup_target_ms', startup.TARGET_MS)), CONNECT_IMPORTS)
+
     caldav_url = os.getenv('caldav_url')
     caldav_user = os.getenv('caldav_user')
     caldav_password = os.getenv('caldav_password')
     caldav_timeout = float_or_none(os.getenv('caldav_timeout'))
 
-    calendar_id = os.getenv('calendar_id')
-    no_heat_tag = os.getenv('no_heat_tag')
-    action = os.getenv('action')
+    rooms = load_rooms()
+    source_dir = Path(__file__).resolve().parent
+    wrappers = {}
+    actions = {}
+    for room in rooms:
+        if not os.path.isabs(room.action):
+            room.action = os.path.join(source_dir, room.action)
 
-    if not os.path.isabs(action):
-        source_path = Path(__file__).resolve()
-        source_dir = source_path.parent
-        action = os.path.join(source_dir, action)
+        prefix = '' if len(rooms) == 1 else '%s: ' % room.name
+        wrapper = textwrap.TextWrapper(initial_indent=' ' * 4 + prefix, width=80, subsequent_indent=' ' * 8)
+        room.indicator.set_wrapper(wrapper) # for diagnostic output
+        wrappers[room.name] = wrapper
+        actions[room.name] = LazyAction(room.action, dict(os.environ, **room.action_env), wrapper)
 
-    preheat_minutes = int(os.getenv('preheat_minutes'))
-    cooloff_minutes = int(os.getenv('cooloff_minutes'))
+    connect_args = (caldav_url, caldav_user, caldav_password, caldav_timeout)
+    cache_file = os.getenv('calendar_cache_file')
+    deadline_seconds = float_or_none(os.getenv('room_deadline_seconds'))
+    server_filters = os.getenv('caldav_server_filters', '1') != '0'
+    event_parser = os.getenv('ical_parser', 'vobject')
 
-    now = datetime.datetime.now().astimezone()
-    print("Checking at %s" % now)
+    state_file = os.getenv('state_file', 'caldav-trigger-state.json')
+    if not os.path.isabs(state_file):
+        state_file = os.path.join(source_dir, state_file)
+    state_store = StateStore(state_file)
+    reassert_interval = datetime.timedelta(minutes=float(os.getenv('reassert_minutes', 60)))
 
-    wrapper = textwrap.TextWrapper(initial_indent=' ' * 4, width=80, subsequent_indent=' ' * 8)
+    # actions of the same script run at most dispatch_limits[<script>] (default: dispatch_default_limit) at once
+    dispatcher = Dispatcher(json.loads(os.getenv('dispatch_limits', '{}')),
+                            default_limit=int(os.getenv('dispatch_default_limit', 4)),
+                            deadline_seconds=float_or_none(os.getenv('dispatch_deadline_seconds')),
+                            retries=int(os.getenv('dispatch_retries', 2)),
+                            backoff_seconds=float(os.getenv('dispatch_backoff_seconds', 2)))
 
-    heat_needed_indicator = HeatNeededIndicator(preheat_minutes, cooloff_minutes, no_heat_tag)
-    heat_needed_indicator.set_wrapper(wrapper) # for diagnostic output
+    snapshot = None
+    snapshot_file = os.getenv('snapshot_file')
+    if snapshot_file:
+        if not os.path.isabs(snapshot_file):
+            snapshot_file = os.path.join(source_dir, snapshot_file)
+        max_age = datetime.timedelta(minutes=float(os.getenv('snapshot_max_age_minutes', 24 * 60)))
+        horizon = datetime.timedelta(minutes=float(os.getenv('snapshot_horizon_minutes', 24 * 60)))
+        snapshot = EventSnapshot(snapshot_file, max_age, horizon)
 
-    with caldav.DAVClient(url=caldav_url, username=caldav_user, password=caldav_password, timeout=caldav_timeout) as client:
-        principal = client.principal()
-        calendar = principal.calendar(cal_id=calendar_id)
-        need_heating = heat_needed_indicator.is_needed(calendar, now)
-
-    print(wrapper.fill("Heating needed" if need_heating else "No heating needed"))
+    if args.daemon:
+        recheck_seconds = float(os.getenv('daemon_recheck_seconds', 300))
+        pid_file = os.getenv('daemon_pid_file')
+        if pid_file:
+            pid_file = os.path.join(source_dir, pid_file)
+        return run_daemon(connect_args, rooms, actions, wrappers, deadline_seconds, cache_file, event_parser,
+                          snapshot, dispatcher, state_store, reassert_interval, recheck_seconds, pid_file)
 
-    action_result = subprocess.run([action, 'on' if need_heating else 'off' ], stdout=subprocess.PIPE)
-    print(wrapper.fill(action_result.stdout.decode()))
-    return EXIT_OK if action_result.returncode == 0 else EXIT_ACTION_FAILED
+    return run_once(connect_args, rooms, actions, wrappers, deadline_seconds, cache_file, server_filters,
+                    event_parser, snapshot, dispatcher, state_store, reassert_interval)
 
 if __name__ == '__main__':
     sys.exit(main())
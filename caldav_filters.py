@@ -0,0 +1,76 @@
+import datetime
+import logging
+
+import caldav
+from caldav.elements import cdav, dav
+
+from recurrence import RecurrenceExpander
+
+logger = logging.getLogger(__name__)
+
+def candidate_filters(no_heat_tag: str | None) -> list[list]:
+    # Filters for calendar-query REPORTs, the union of whose results are the events that may need
+    # heating: events with a time (DTSTART without VALUE=DATE) and no no_heat_tag in their
+    # DESCRIPTION. A negated text-match does not match events without DESCRIPTION, which are
+    # searched by a REPORT of their own.
+    def timed():
+        return cdav.PropFilter('DTSTART') + (cdav.ParamFilter('VALUE') + cdav.NotDefined())
+
+    if no_heat_tag is None:
+        return [[timed()]]
+    return [
+        [timed(), cdav.PropFilter('DESCRIPTION') + cdav.NotDefined()],
+        [timed(), cdav.PropFilter('DESCRIPTION') + cdav.TextMatch(no_heat_tag, negate=True)],
+    ]
+
+class FilteringCalendar:
+    """
+    caldav.Calendar whose date_search only asks the server for candidate events
+    (see candidate_filters). If the server rejects the filters, it searches
+    unfiltered; the events are filtered by HeatNeededIndicator in any case, so
+    servers ignoring the filters return correct results as well. Recurring
+    events are expanded locally (see recurrence.RecurrenceExpander), so
+    servers need not support expand. `parser` selects the iCalendar parser
+    (see ical_parser.PARSERS).
+    """
+
+    def __init__(self, calendar: caldav.Calendar, filter_sets: list[list], parser: str = 'vobject') -> None:
+        self.calendar = calendar
+        self.filter_sets = filter_sets
+        self.supports_filters = True
+        self.expander = RecurrenceExpander(parser=parser)
+
+    def date_search(self, start: datetime.datetime, end: datetime.datetime | None = None) -> list[caldav.Event]:
+        if self.filter_sets and self.supports_filters:
+            try:
+                return self.expand(self.search(start, end, self.filter_sets), start, end)
+            except caldav.error.AuthorizationError:
+                raise
+            except caldav.error.DAVError as e:
+                logger.warning("Server rejected filtered search, searching unfiltered (%s)", e)
+                self.supports_filters = False
+        return self.expand(self.search(start, end, [None]), start, end)
+
+    def search(self, start: datetime.datetime, end: datetime.datetime | None,
+               filter_sets: list[list | None]) -> list[caldav.Event]:
+        # Unexpanded resources found by any of the filter sets, by href
+        events = {}
+        for filters in filter_sets:
+            for event in self.calendar.search(event=True, start=start, end=end, expand=False,
+                                              split_expanded=False, props=[dav.GetEtag()],
+                                              filters=None if filters is None else list(filters)):
+                events.setdefault(str(event.url), event)
+        return list(events.values())
+
+    def expand(self, events: list[caldav.Event], start: datetime.datetime,
+               end: datetime.datetime | None) -> list[caldav.Event]:
+        result = []
+        for event in events:
+            href = str(event.url)
+            # a resource is parsed again only once it changed
+            resource = self.expander.parse((href, event.props.get(dav.GetEtag.tag) or event.data), lambda: event.data)
+            if end is None:
+                result.append(self.expander.make_event(self.calendar, href, resource.vobj))
+            else:
+                result += self.expander.make_events(self.calendar, href, resource.expand(start, end))
+        return result
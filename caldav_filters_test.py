@@ -0,0 +1,46 @@
+import datetime
+
+import caldav
+
+from benchmark import NO_HEAT_TAG, CalDAVServer, generate_calendar
+from caldav_filters import FilteringCalendar, candidate_filters
+from logic import HeatNeededIndicator
+
+NOW = datetime.datetime(2024, 3, 6, 12, tzinfo=datetime.timezone.utc)
+
+def test_only_candidates_are_downloaded():
+    resources = generate_calendar(NOW, events=200, series=0, overrides=0, days=4,
+                                  whole_day_share=0.3, no_heat_share=0.3)
+    indicator = HeatNeededIndicator(preheat_minutes=60, cooloff_minutes=15, no_heat_tag=NO_HEAT_TAG)
+    until = NOW + datetime.timedelta(days=1)
+
+    with CalDAVServer(resources) as server:
+        calendar = caldav.Calendar(client=caldav.DAVClient(url=server.calendar_url), url=server.calendar_url)
+        filtering_calendar = FilteringCalendar(calendar, candidate_filters(NO_HEAT_TAG))
+        (begin, end, _) = indicator.search_window(NOW, until)
+        candidates = filtering_calendar.date_search(begin, end)
+        everything = calendar.date_search(begin, end)
+        filtered = indicator.get_next_events(filtering_calendar, NOW, until)
+        unfiltered = indicator.get_next_events(calendar, NOW, until)
+
+    assert filtering_calendar.supports_filters
+    assert len(candidates) < len(everything)
+    assert all(NO_HEAT_TAG not in event.data and 'VALUE=DATE' not in event.data for event in candidates)
+    assert len(filtered) > 0
+    assert sorted(event.summary for event in filtered) == sorted(event.summary for event in unfiltered)
+
+def test_fallback_if_filters_are_rejected(mocker):
+    def search(filters, **kwargs):
+        if filters is not None:
+            raise caldav.error.ReportError('501 Not Implemented')
+        return []
+
+    calendar = mocker.Mock()
+    calendar.search.side_effect = search
+    filtering_calendar = FilteringCalendar(calendar, candidate_filters(NO_HEAT_TAG))
+
+    assert filtering_calendar.date_search(NOW, NOW + datetime.timedelta(hours=1)) == []
+    assert filtering_calendar.date_search(NOW, NOW + datetime.timedelta(hours=1)) == []
+    assert not filtering_calendar.supports_filters
+    assert calendar.search.call_count == 3
+    assert not calendar.date_search.called
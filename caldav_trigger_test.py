@@ -0,0 +1,119 @@
+import datetime
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+from actions import load_module
+from dispatch import Dispatcher
+from logic import HeatNeededIndicator
+from rooms import Room
+from state_store import StateStore
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+trigger = load_module(os.path.join(SOURCE_DIR, 'caldav-trigger.py'))
+
+class FakeClient:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+class FakePrincipal:
+    def calendar(self, cal_id: str) -> str:
+        return cal_id
+
+def run_once(rooms: list[Room], deadline_seconds: float | None, tmp_path) -> int:
+    wrappers = { room.name: textwrap.TextWrapper() for room in rooms }
+    return trigger.run_once(('https://caldav.example.com/', None, None, None), rooms,
+                            { room.name: None for room in rooms }, wrappers, deadline_seconds, None, False, 'vobject',
+                            None, Dispatcher({}), StateStore(str(tmp_path / 'state.json')), datetime.timedelta())
+
+def make_rooms(count: int) -> list[Room]:
+    return [Room('room %i' % i, 'calendar-%i' % i, HeatNeededIndicator(60, 15), 'switch.sh') for i in range(count)]
+
+def test_rooms_are_checked_in_parallel(monkeypatch, tmp_path):
+    checked = []
+
+    def check_room(room, *args) -> int:
+        time.sleep(0.2)
+        checked.append(room.name)
+        return trigger.EXIT_OK
+
+    monkeypatch.setattr(trigger, 'connect', lambda *args: (FakeClient(), FakePrincipal()))
+    monkeypatch.setattr(trigger, 'check_room', check_room)
+    started = time.monotonic()
+    assert run_once(make_rooms(4), None, tmp_path) == trigger.EXIT_OK
+    assert time.monotonic() - started < 0.6
+    assert sorted(checked) == ['room 0', 'room 1', 'room 2', 'room 3']
+
+def test_slow_room_exceeds_deadline(monkeypatch, tmp_path, capsys):
+    release = threading.Event()
+
+    def check_room(room, *args) -> int:
+        if room.name == 'room 1':
+            release.wait(5)
+        return trigger.EXIT_OK
+
+    monkeypatch.setattr(trigger, 'connect', lambda *args: (FakeClient(), FakePrincipal()))
+    monkeypatch.setattr(trigger, 'check_room', check_room)
+    started = time.monotonic()
+    try:
+        assert run_once(make_rooms(2), 0.2, tmp_path) == trigger.EXIT_ROOM_TIMEOUT
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+    assert capsys.readouterr().out.endswith("Deadline exceeded, not switching\n")
+
+def test_process_exits_at_deadline(tmp_path):
+    # a room stuck for good does not keep the process running
+    script = textwrap.dedent('''
+        import pathlib, sys, threading
+        import caldav_trigger_test as test
+        test.trigger.connect = lambda *args: (test.FakeClient(), test.FakePrincipal())
+        test.trigger.check_room = lambda *args: threading.Event().wait()
+        sys.exit(test.run_once(test.make_rooms(2), 0.2, pathlib.Path(sys.argv[1])))
+        ''')
+    result = subprocess.run([sys.executable, '-c', script, str(tmp_path)], cwd=SOURCE_DIR, timeout=10)
+    assert result.returncode == trigger.EXIT_ROOM_TIMEOUT
+
+def test_pid_file_removed_at_exit(tmp_path):
+    pid_file = tmp_path / 'caldav-trigger.pid'
+    script = textwrap.dedent('''
+        import os, sys
+        import caldav_trigger_test as test
+        test.trigger.write_pid_file(sys.argv[1])
+        assert int(open(sys.argv[1]).read()) == os.getpid()
+        ''')
+    subprocess.run([sys.executable, '-c', script, str(pid_file)], cwd=SOURCE_DIR, timeout=10, check=True)
+    assert not pid_file.exists()
+
+def test_switch_not_waiting_behind_hanging_action(monkeypatch, tmp_path, capsys):
+    room = make_rooms(1)[0]
+    dispatcher = Dispatcher({})
+    release = threading.Event()
+    applied = []
+    monkeypatch.setattr(trigger, 'apply_state', lambda room, action, need_heating, *args: applied.append(need_heating)
+                        or trigger.EXIT_OK)
+    # the room's previous switch hangs
+    stuck = dispatcher.submit(room.name, 'switch.sh', lambda: release.wait(5) and trigger.EXIT_OK)
+    try:
+        switch = lambda need_heating, timeout: trigger.switch(
+            room, None, need_heating, datetime.datetime.now().astimezone(), dispatcher,
+            StateStore(str(tmp_path / 'state.json')), datetime.timedelta(), textwrap.TextWrapper(), timeout)
+        started = time.monotonic()
+        assert switch(True, 0) == trigger.EXIT_ROOM_TIMEOUT
+        assert switch(False, 0.2) == trigger.EXIT_ROOM_TIMEOUT
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+    assert stuck.result(timeout=5) == trigger.EXIT_OK
+    assert capsys.readouterr().out == "Still switching after 0.2 seconds\n"
+    # switched in the background once the action returned, to the latest state
+    deadline = time.monotonic() + 5
+    while not applied and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert applied == [False]
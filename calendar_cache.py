@@ -0,0 +1,161 @@
+import datetime
+import json
+import os
+
+import caldav
+from caldav.elements import dav
+from caldav.elements.base import ValuedBaseElement
+from caldav.lib.url import URL
+
+from recurrence import RecurrenceExpander, aware, is_recurring, vevent_end
+
+MULTIGET_CHUNK_SIZE = 100
+
+class GetCtag(ValuedBaseElement):
+    tag = '{http://calendarserver.org/ns/}getctag'
+
+class CachedCalendar:
+    """
+    Local copy of the events of a CalDAV calendar, keyed by href and ETag.
+
+    refresh() asks the server for changes using an RFC 6578 sync-collection
+    REPORT or - if the server does not support it - the collection ctag and
+    only downloads (calendar-multiget) and re-parses changed resources.
+    date_search() answers from the local copy like caldav.Calendar.date_search
+    and expands recurring events itself (see recurrence.RecurrenceExpander).
+    `parser` selects the iCalendar parser (see ical_parser.PARSERS).
+    """
+
+    def __init__(self, calendar: caldav.Calendar, cache_file: str | None = None, parser: str = 'vobject') -> None:
+        self.calendar = calendar
+        self.cache_file = cache_file
+        self.sync_token = None
+        self.ctag = None
+        self.supports_sync = True
+        # href -> { 'etag', 'data', 'start', 'end' }, start/end as unix time, end None if recurring
+        self.objects = {}
+        self.expander = RecurrenceExpander(parser=parser)
+        if cache_file is not None:
+            self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.cache_file) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return
+        if state.get('calendar') != str(self.calendar.url):
+            return
+        self.sync_token = state.get('sync_token')
+        self.ctag = state.get('ctag')
+        self.objects = state.get('objects', {})
+
+    def save(self) -> None:
+        state = {
+            'calendar': str(self.calendar.url),
+            'sync_token': self.sync_token,
+            'ctag': self.ctag,
+            'objects': self.objects
+        }
+        temp_file = self.cache_file + '.tmp'
+        with open(temp_file, 'w') as file:
+            json.dump(state, file)
+        os.replace(temp_file, self.cache_file)
+
+    def refresh(self) -> None:
+        if self.supports_sync and self.sync():
+            return
+        self.sync_by_ctag()
+
+    def sync(self) -> bool:
+        try:
+            changes = self.calendar.objects_by_sync_token(self.sync_token, load_objects=False)
+        except caldav.error.DAVError:
+            if self.sync_token is not None:
+                # Sync-token expired or unknown to the server: start over
+                self.sync_token = None
+                return self.sync()
+            self.supports_sync = False
+            return False
+
+        etags = { str(obj.url.canonical()): obj.props.get(dav.GetEtag.tag) for obj in changes }
+        if self.sync_token is None:
+            # Full listing: everything not listed has been deleted
+            deleted = [href for href in self.objects if href not in etags]
+        else:
+            deleted = [href for (href, etag) in etags.items() if etag is None]
+        if self.update(etags, deleted) or changes.sync_token != self.sync_token:
+            self.sync_token = changes.sync_token
+            self.save_if_configured()
+        return True
+
+    def sync_by_ctag(self) -> None:
+        ctag = self.calendar.get_property(GetCtag())
+        if ctag is not None and ctag == self.ctag:
+            return
+        response = self.calendar._query_properties([dav.GetEtag()], depth=1)
+        listing = response.expand_simple_props([dav.GetEtag()])
+        calendar_url = self.calendar.url.canonical()
+        etags = {}
+        for (href, props) in listing.items():
+            url = self.calendar.url.join(href).canonical()
+            if url != calendar_url:
+                etags[str(url)] = props.get(dav.GetEtag.tag)
+        deleted = [href for href in self.objects if href not in etags]
+        self.update(etags, deleted)
+        self.ctag = ctag
+        self.save_if_configured()
+
+    def update(self, etags: dict[str, str | None], deleted: list[str]) -> bool:
+        # Download and parse changed resources, drop deleted ones. Returns whether anything changed.
+        for href in deleted:
+            self.objects.pop(href, None)
+
+        changed = [href for (href, etag) in etags.items()
+                   if etag is not None and self.objects.get(href, {}).get('etag') != etag]
+        for i in range(0, len(changed), MULTIGET_CHUNK_SIZE):
+            urls = [URL.objectify(href) for href in changed[i:i + MULTIGET_CHUNK_SIZE]]
+            received = set()
+            for obj in self.calendar.calendar_multiget(urls):
+                href = str(obj.url.canonical())
+                received.add(href)
+                self.store(href, etags.get(href), obj.data)
+            for url in urls:
+                # not returned by multiget: deleted in the meantime
+                if str(url) not in received:
+                    self.objects.pop(str(url), None)
+        return len(deleted) > 0 or len(changed) > 0
+
+    def store(self, href: str, etag: str | None, data: str) -> None:
+        vevents = self.expander.parse((href, etag or data), data).vevents()
+        if not vevents:
+            self.objects.pop(href, None)
+            return
+        start = min(aware(vevent.dtstart.value) for vevent in vevents)
+        if any(is_recurring(vevent) for vevent in vevents):
+            end = None
+        else:
+            end = max(aware(vevent_end(vevent)) for vevent in vevents).timestamp()
+        self.objects[href] = { 'etag': etag, 'data': data, 'start': start.timestamp(), 'end': end }
+
+    def save_if_configured(self) -> None:
+        if self.cache_file is not None:
+            self.save()
+
+    def date_search(self, start: datetime.datetime, end: datetime.datetime | None = None,
+                    compfilter: str = "VEVENT", expand: bool | str = "maybe",
+                    verify_expand: bool = False) -> list[caldav.Event]:
+        result = []
+        start_unix = start.timestamp()
+        end_unix = None if end is None else end.timestamp()
+        for (href, entry) in self.objects.items():
+            if end_unix is not None and entry['start'] >= end_unix:
+                continue
+            if entry['end'] is not None and entry['end'] <= start_unix:
+                continue
+            resource = self.expander.parse((href, entry['etag'] or entry['data']), entry['data'])
+            if entry['end'] is None and end is not None:
+                result += self.expander.make_events(self.calendar, href, resource.expand(start, end))
+            else:
+                result.append(self.expander.make_event(self.calendar, href, resource.vobj))
+        return result
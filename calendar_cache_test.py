@@ -0,0 +1,110 @@
+import datetime
+
+import caldav
+from caldav.elements import dav
+from caldav.lib.url import URL
+
+from calendar_cache import CachedCalendar
+
+CALENDAR_URL = 'https://caldav.example.com/calendars/room/'
+
+def make_ics(uid: str, vevents: list[str]) -> str:
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//test//test//EN']
+    for vevent in vevents:
+        lines += ['BEGIN:VEVENT', 'UID:' + uid, 'DTSTAMP:19800101T000000Z'] + vevent.split('\n') + ['END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
+
+SINGLE = make_ics('single', [
+    'DTSTART:19800101T120000Z\nDTEND:19800101T140000Z\nSUMMARY:Single event'])
+WEEKLY = make_ics('weekly', [
+    'DTSTART:19800102T100000Z\nDTEND:19800102T110000Z\nRRULE:FREQ=WEEKLY;COUNT=4\nSUMMARY:Weekly event',
+    'RECURRENCE-ID:19800109T100000Z\nDTSTART:19800109T150000Z\nDTEND:19800109T160000Z\nSUMMARY:Moved instance'])
+SINGLE_MOVED = make_ics('single', [
+    'DTSTART:19800101T160000Z\nDTEND:19800101T170000Z\nSUMMARY:Single event'])
+
+def make_datetime(day: int, hour: int) -> datetime.datetime:
+    return datetime.datetime(1980, 1, day, hour, tzinfo=datetime.timezone.utc)
+
+class Changes(list):
+    def __init__(self, etags: dict[str, str | None], sync_token: str) -> None:
+        super().__init__()
+        self.sync_token = sync_token
+        for (name, etag) in etags.items():
+            props = {} if etag is None else { dav.GetEtag.tag: etag }
+            self.append(caldav.CalendarObjectResource(url=CALENDAR_URL + name, props=props))
+
+def make_calendar(mocker, server: dict[str, str]) -> caldav.Calendar:
+    calendar = mocker.create_autospec(caldav.Calendar, instance = True)
+    calendar.url = URL.objectify(CALENDAR_URL)
+    calendar.calendar_multiget.side_effect = lambda urls: [
+        caldav.Event(url=url, data=server[url.path.rsplit('/', 1)[-1]])
+        for url in urls if url.path.rsplit('/', 1)[-1] in server ]
+    return calendar
+
+def summaries(cached_calendar: CachedCalendar, start: datetime.datetime, end: datetime.datetime) -> list[tuple]:
+    return sorted((event.vobject_instance.vevent.summary.value, event.vobject_instance.vevent.dtstart.value)
+                  for event in cached_calendar.date_search(start, end))
+
+def test_sync_downloads_only_changes(mocker):
+    server = { 'single.ics': SINGLE, 'weekly.ics': WEEKLY }
+    calendar = make_calendar(mocker, server)
+    cached_calendar = CachedCalendar(calendar)
+
+    calendar.objects_by_sync_token.return_value = Changes({ 'single.ics': '"1"', 'weekly.ics': '"1"' }, 'token-1')
+    cached_calendar.refresh()
+    assert calendar.calendar_multiget.call_count == 1
+    assert summaries(cached_calendar, make_datetime(1, 0), make_datetime(1, 23)) == [
+        ('Single event', make_datetime(1, 12)) ]
+
+    # nothing changed: no download at all
+    calendar.objects_by_sync_token.return_value = Changes({}, 'token-1')
+    cached_calendar.refresh()
+    calendar.objects_by_sync_token.assert_called_with('token-1', load_objects=False)
+    assert calendar.calendar_multiget.call_count == 1
+
+    # one change, one deletion
+    server['single.ics'] = SINGLE_MOVED
+    del server['weekly.ics']
+    calendar.objects_by_sync_token.return_value = Changes({ 'single.ics': '"2"', 'weekly.ics': None }, 'token-2')
+    cached_calendar.refresh()
+    assert calendar.calendar_multiget.call_count == 2
+    assert [url.path for url in calendar.calendar_multiget.call_args.args[0]] == ['/calendars/room/single.ics']
+    assert summaries(cached_calendar, make_datetime(1, 0), make_datetime(31, 0)) == [
+        ('Single event', make_datetime(1, 16)) ]
+
+def test_date_search_expands_recurrences(mocker):
+    server = { 'weekly.ics': WEEKLY }
+    calendar = make_calendar(mocker, server)
+    calendar.objects_by_sync_token.return_value = Changes({ 'weekly.ics': '"1"' }, 'token-1')
+    cached_calendar = CachedCalendar(calendar)
+    cached_calendar.refresh()
+
+    assert summaries(cached_calendar, make_datetime(1, 0), make_datetime(31, 0)) == [
+          ('Moved instance', make_datetime(9, 15))
+        , ('Weekly event', make_datetime(2, 10))
+        , ('Weekly event', make_datetime(16, 10))
+        , ('Weekly event', make_datetime(23, 10))
+        ]
+    assert summaries(cached_calendar, make_datetime(9, 10), make_datetime(9, 11)) == []
+    assert summaries(cached_calendar, make_datetime(16, 10), make_datetime(16, 11)) == [
+        ('Weekly event', make_datetime(16, 10)) ]
+
+def test_falls_back_to_ctag(mocker):
+    calendar = make_calendar(mocker, { 'single.ics': SINGLE })
+    calendar.objects_by_sync_token.side_effect = caldav.error.ReportError('sync-collection not supported')
+    calendar.get_property.return_value = 'ctag-1'
+    listing = mocker.Mock()
+    listing.expand_simple_props.return_value = {
+        '/calendars/room/': {},
+        '/calendars/room/single.ics': { dav.GetEtag.tag: '"1"' } }
+    calendar._query_properties.return_value = listing
+    cached_calendar = CachedCalendar(calendar)
+
+    cached_calendar.refresh()
+    cached_calendar.refresh()
+    assert calendar.objects_by_sync_token.call_count == 1
+    assert calendar._query_properties.call_count == 1
+    assert calendar.calendar_multiget.call_count == 1
+    assert summaries(cached_calendar, make_datetime(1, 0), make_datetime(1, 23)) == [
+        ('Single event', make_datetime(1, 12)) ]
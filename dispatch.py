@@ -0,0 +1,135 @@
+import concurrent.futures
+import threading
+import time
+from typing import Callable
+
+class DeadlineExceeded(Exception):
+    pass
+
+def start_daemon(function: Callable, *args) -> concurrent.futures.Future:
+    # Runs function(*args) in a daemon thread: unlike the workers of a ThreadPoolExecutor, it is not
+    # joined at exit, so a call stuck past its deadline does not keep the process running
+    future = concurrent.futures.Future()
+
+    def run() -> None:
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+class Job:
+    def __init__(self, target: str, backend: str, run: Callable[[], int], deadline: float | None) -> None:
+        self.target = target
+        self.backend = backend
+        self.run = run
+        self.deadline = deadline
+        # futures of the jobs this one replaced, too
+        self.futures = [concurrent.futures.Future()]
+
+    def remaining(self) -> float | None:
+        return None if self.deadline is None else max(0, self.deadline - time.monotonic())
+
+    def set_result(self, result: int) -> None:
+        for future in self.futures:
+            future.set_result(result)
+
+    def set_exception(self, exception: Exception) -> None:
+        for future in self.futures:
+            future.set_exception(exception)
+
+class Dispatcher:
+    """
+    Queue of the actions switching rooms (targets). Actions of the same
+    backend run at most `limits[backend]` (default: `default_limit`) at once,
+    those of a target one after another. A job queued for a target is
+    replaced by a newer one, whose result both get. Failing jobs (a result
+    other than 0) are run again up to `retries` times with exponential
+    backoff, unless replaced meanwhile or past their deadline. Jobs not
+    started within `deadline_seconds` of being queued fail with
+    DeadlineExceeded. Jobs run in daemon threads: one stuck in its action
+    does not keep the process running.
+    """
+
+    def __init__(self, limits: dict[str, int], default_limit: int = 4, deadline_seconds: float | None = None,
+                 retries: int = 2, backoff_seconds: float = 2) -> None:
+        self.limits = limits
+        self.default_limit = default_limit
+        self.deadline_seconds = deadline_seconds
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self.lock = threading.Lock()
+        # jobs not started yet, by target
+        self.queued = {}
+        self.target_locks = {}
+        self.semaphores = {}
+
+    def submit(self, target: str, backend: str, run: Callable[[], int]) -> concurrent.futures.Future:
+        deadline = None if self.deadline_seconds is None else time.monotonic() + self.deadline_seconds
+        job = Job(target, backend, run, deadline)
+        with self.lock:
+            replaced = self.queued.get(target)
+            if replaced is not None:
+                job.futures += replaced.futures
+            self.queued[target] = job
+            target_lock = self.target_locks.setdefault(target, threading.Lock())
+            semaphore = self.semaphores.setdefault(
+                backend, threading.BoundedSemaphore(self.limits.get(backend, self.default_limit)))
+        start_daemon(self.dispatch, job, target_lock, semaphore)
+        return job.futures[0]
+
+    def dispatch(self, job: Job, target_lock: threading.Lock, semaphore: threading.BoundedSemaphore) -> None:
+        try:
+            if not self.wait(job, target_lock):
+                return
+            try:
+                if not self.wait(job, semaphore):
+                    return
+                try:
+                    with self.lock:
+                        # started: a newer job for the target is queued anew
+                        replaced = self.queued.get(job.target) is not job
+                        if not replaced:
+                            del self.queued[job.target]
+                    if not replaced:
+                        job.set_result(self.run(job))
+                finally:
+                    semaphore.release()
+            finally:
+                target_lock.release()
+        except Exception as e:
+            job.set_exception(e)
+
+    def wait(self, job: Job, lock) -> bool:
+        # Acquires `lock` until the deadline of the job, False if the job was replaced meanwhile
+        remaining = job.remaining()
+        acquired = lock.acquire() if remaining is None else remaining > 0 and lock.acquire(timeout=remaining)
+        with self.lock:
+            if self.queued.get(job.target) is not job:
+                if acquired:
+                    lock.release()
+                return False
+            if not acquired:
+                del self.queued[job.target]
+                raise DeadlineExceeded('Not started within %s seconds' % self.deadline_seconds)
+        return True
+
+    def run(self, job: Job) -> int:
+        result = job.run()
+        for attempt in range(self.retries):
+            if result == 0:
+                break
+            delay = self.backoff_seconds * 2 ** attempt
+            remaining = job.remaining()
+            if remaining is not None and remaining < delay:
+                break
+            time.sleep(delay)
+            with self.lock:
+                if job.target in self.queued:
+                    # a newer state is queued: applied instead
+                    break
+            result = job.run()
+        return result
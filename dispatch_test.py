@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+from dispatch import DeadlineExceeded, Dispatcher
+
+def test_concurrency_limited_per_backend():
+    running = { 'tuya': 0, 'webhooks': 0 }
+    peak = dict(running)
+    lock = threading.Lock()
+
+    def action(backend: str):
+        def run() -> int:
+            with lock:
+                running[backend] += 1
+                peak[backend] = max(peak[backend], running[backend])
+            time.sleep(0.05)
+            with lock:
+                running[backend] -= 1
+            return 0
+        return run
+
+    dispatcher = Dispatcher({ 'tuya': 2 }, default_limit=4)
+    futures = [dispatcher.submit('room %i' % i, backend, action(backend))
+               for i in range(8) for backend in ['tuya', 'webhooks']]
+    assert [future.result(timeout=5) for future in futures] == [0] * 16
+    assert peak == { 'tuya': 2, 'webhooks': 4 }
+
+def test_queued_state_is_replaced():
+    applied = []
+    release = threading.Event()
+
+    def switch(state: str):
+        def run() -> int:
+            if state == 'busy':
+                release.wait(5)
+            applied.append(state)
+            return 0
+        return run
+
+    dispatcher = Dispatcher({}, default_limit=1)
+    busy = dispatcher.submit('other room', 'tuya', switch('busy'))
+    time.sleep(0.05)
+    # waiting for the backend: the newer state replaces the older one
+    on = dispatcher.submit('room', 'tuya', switch('on'))
+    off = dispatcher.submit('room', 'tuya', switch('off'))
+    release.set()
+    assert (busy.result(timeout=5), on.result(timeout=5), off.result(timeout=5)) == (0, 0, 0)
+    assert applied == ['busy', 'off']
+
+def test_retries_and_deadline():
+    attempts = []
+
+    def flaky() -> int:
+        attempts.append(time.monotonic())
+        return 0 if len(attempts) == 3 else 1
+
+    dispatcher = Dispatcher({}, default_limit=1, deadline_seconds=1, retries=2, backoff_seconds=0.01)
+    assert dispatcher.submit('room', 'tuya', flaky).result(timeout=5) == 0
+    assert len(attempts) == 3
+
+    # no slot within the deadline
+    dispatcher.deadline_seconds = 0.1
+    slow = dispatcher.submit('other room', 'tuya', lambda: time.sleep(0.3) or 0)
+    with pytest.raises(DeadlineExceeded):
+        dispatcher.submit('room', 'tuya', lambda: 0).result(timeout=5)
+    assert slow.result(timeout=5) == 0
+
+def test_process_exits_with_job_stuck():
+    # a hanging action does not keep the process running
+    script = textwrap.dedent('''
+        import threading
+        from dispatch import Dispatcher
+        Dispatcher({}).submit('room', 'tuya', lambda: threading.Event().wait())
+        ''')
+    subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10,
+                   check=True)
@@ -0,0 +1,250 @@
+import datetime
+import functools
+import io
+import re
+import zoneinfo
+
+import dateutil.rrule
+import dateutil.tz
+import vobject
+
+# Only these properties of VEVENTs are kept, all other properties and components are skipped
+TEXT_PROPERTIES = {'summary', 'description', 'uid'}
+DATE_PROPERTIES = {'dtstart', 'dtend', 'recurrence-id'}
+DATE_LIST_PROPERTIES = {'exdate', 'rdate'}
+RULE_PROPERTIES = {'rrule', 'exrule'}
+PROPERTIES = TEXT_PROPERTIES | DATE_PROPERTIES | DATE_LIST_PROPERTIES | RULE_PROPERTIES | {'duration', 'sequence'}
+
+VTIMEZONE = re.compile(r'^BEGIN:VTIMEZONE$.*?^END:VTIMEZONE$', re.MULTILINE | re.DOTALL)
+TZID = re.compile(r'^TZID[^:]*:(.*)$', re.MULTILINE)
+ESCAPED = re.compile(r'\\(.)')
+UNESCAPED = { 'n': '\n', 'N': '\n' }
+DURATION = re.compile(r'([-+])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+class Property:
+    __slots__ = ('name', 'params', 'value', 'raw')
+
+    def __init__(self, name: str, params: dict[str, str] | None = None, value=None, raw: str | None = None) -> None:
+        self.name = name
+        self.params = params or {}
+        self.value = value
+        self.raw = raw
+
+    def serialize(self) -> str:
+        values = self.value if isinstance(self.value, list) else [self.value]
+        if values and isinstance(values[0], datetime.date):
+            # written in UTC, so that no VTIMEZONE is needed
+            params = ';VALUE=DATE' if not isinstance(values[0], datetime.datetime) else ''
+            return '%s%s:%s' % (self.name.upper(), params, ','.join(format_date(value) for value in values))
+        if self.raw is not None:
+            return self.raw
+        value = str(self.value)
+        if self.name in TEXT_PROPERTIES:
+            value = value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+        return '%s:%s' % (self.name.upper(), value)
+
+class Component:
+    """
+    The subset of vobject.base.Component used by this project: properties are
+    read as attributes (vevent.dtstart.value, vcalendar.vevent_list) and
+    listed in contents, keyed by lowercase name.
+    """
+
+    __slots__ = ('name', 'contents')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.contents = {}
+
+    def __getattr__(self, name: str):
+        if name.endswith('_list'):
+            return self.contents.get(name[:-5].replace('_', '-'), [])
+        try:
+            return self.contents[name.replace('_', '-')][0]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def add(self, obj: 'str | Component'):
+        if isinstance(obj, str):
+            obj = Property(obj.lower())
+        self.contents.setdefault(obj.name.lower(), []).append(obj)
+        return obj
+
+    def duplicate(self, original: 'Component') -> 'Component':
+        # called like vobject's: vevent.duplicate(vevent)
+        copy = Component(original.name)
+        for (name, values) in original.contents.items():
+            copy.contents[name] = [
+                Property(value.name, dict(value.params), list(value.value) if isinstance(value.value, list)
+                         else value.value, value.raw) if isinstance(value, Property) else self.duplicate(value)
+                for value in values]
+        return copy
+
+    def serialize(self) -> str:
+        lines = ['BEGIN:' + self.name]
+        for values in self.contents.values():
+            for value in values:
+                lines.append(value.serialize().rstrip('\r\n'))
+        lines.append('END:' + self.name)
+        return '\r\n'.join(lines) + '\r\n'
+
+    def getrruleset(self, addRDate: bool = False) -> dateutil.rrule.rruleset:
+        dtstart = self.dtstart.value
+        rruleset = dateutil.rrule.rruleset()
+        for (name, add) in [('rrule', rruleset.rrule), ('exrule', rruleset.exrule)]:
+            for prop in self.contents.get(name, []):
+                add(dateutil.rrule.rrulestr(fix_until(prop.value, dtstart), dtstart=dtstart))
+        for (name, add) in [('rdate', rruleset.rdate), ('exdate', rruleset.exdate)]:
+            if name == 'rdate' and not addRDate:
+                continue
+            for prop in self.contents.get(name, []):
+                for value in prop.value:
+                    add(like(value, dtstart))
+        return rruleset
+
+def iCalendar() -> Component:
+    calendar = Component('VCALENDAR')
+    calendar.add('version').raw = 'VERSION:2.0'
+    calendar.add('prodid').raw = 'PRODID:-//caldav-trigger//ical_parser//EN'
+    return calendar
+
+def parse(data: str) -> Component:
+    """
+    Parses the VEVENTs of an iCalendar object, keeping only the properties
+    listed in PROPERTIES, into Components shaped like those of vobject.readOne.
+    Times with a TZID are resolved through the IANA time zone database, or
+    the VTIMEZONE of that TZID if it is not known there.
+    """
+    calendar = Component('VCALENDAR')
+    data = data.replace('\r\n', '\n').replace('\n ', '').replace('\n\t', '')
+    vtimezones = None
+    vevent = None
+    depth = 0
+    for line in data.split('\n'):
+        if line.startswith('BEGIN:'):
+            depth += 1
+            if depth == 2 and line[6:].upper() == 'VEVENT':
+                vevent = Component('VEVENT')
+            continue
+        if line.startswith('END:'):
+            depth -= 1
+            if depth == 1 and vevent is not None:
+                calendar.contents.setdefault('vevent', []).append(vevent)
+                vevent = None
+            continue
+        if depth != 2 or vevent is None:
+            # VTIMEZONE, VALARM and other components
+            continue
+
+        colon = line.find(':')
+        if colon < 0:
+            continue
+        semicolon = line.find(';', 0, colon)
+        name = line[:colon if semicolon < 0 else semicolon].lower()
+        if name not in PROPERTIES:
+            continue
+        params = {}
+        if semicolon >= 0:
+            if '"' in line[semicolon:colon]:
+                colon = quoted_colon(line, semicolon)
+            for param in line[semicolon + 1:colon].split(';'):
+                (key, _, value) = param.partition('=')
+                params[key.upper()] = value.strip('"')
+        value = line[colon + 1:]
+
+        if name in TEXT_PROPERTIES:
+            if '\\' in value:
+                value = ESCAPED.sub(lambda match: UNESCAPED.get(match.group(1), match.group(1)), value)
+        elif name in DATE_PROPERTIES or name in DATE_LIST_PROPERTIES:
+            tzinfo = None
+            if 'TZID' in params:
+                if vtimezones is None:
+                    vtimezones = { TZID.search(text).group(1): text for text in VTIMEZONE.findall(data) }
+                tzinfo = timezone(params['TZID'], vtimezones.get(params['TZID']))
+            if params.get('VALUE') == 'PERIOD':
+                value = [parse_date(period.partition('/')[0], tzinfo) for period in value.split(',')]
+            else:
+                value = [parse_date(item, tzinfo) for item in value.split(',')]
+            if name in DATE_PROPERTIES:
+                value = value[0]
+        elif name == 'duration':
+            value = parse_duration(value)
+        elif name == 'sequence':
+            value = int(value)
+        vevent.contents.setdefault(name, []).append(Property(name, params, value, line))
+    return calendar
+
+PARSERS = {
+    # name -> (parse iCalendar data, new empty VCALENDAR)
+    'vobject': (vobject.readOne, vobject.iCalendar),
+    'fast': (parse, iCalendar),
+}
+
+def quoted_colon(line: str, start: int) -> int:
+    # the colon after the parameters, skipping colons in quoted parameter values
+    quoted = False
+    for i in range(start, len(line)):
+        if line[i] == '"':
+            quoted = not quoted
+        elif line[i] == ':' and not quoted:
+            return i
+    return len(line)
+
+def parse_date(value: str, tzinfo: datetime.tzinfo | None) -> datetime.date:
+    if len(value) == 8:
+        return datetime.date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+    if value.endswith('Z'):
+        tzinfo = datetime.timezone.utc
+    return datetime.datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                             int(value[9:11]), int(value[11:13]), int(value[13:15]), tzinfo=tzinfo)
+
+def parse_duration(value: str) -> datetime.timedelta:
+    match = DURATION.match(value)
+    if match is None:
+        raise ValueError('Invalid duration: %s' % value)
+    (sign, weeks, days, hours, minutes, seconds) = match.groups()
+    duration = datetime.timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0),
+                                  minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == '-' else duration
+
+def format_date(value: datetime.date) -> str:
+    if not isinstance(value, datetime.datetime):
+        return value.strftime('%Y%m%d')
+    if value.tzinfo is None:
+        return value.strftime('%Y%m%dT%H%M%S')
+    return value.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+@functools.lru_cache(maxsize=256)
+def timezone(tzid: str, vtimezone: str | None) -> datetime.tzinfo | None:
+    # Time zone of a TZID, None (floating time) if unknown
+    try:
+        return zoneinfo.ZoneInfo(tzid)
+    except (ValueError, zoneinfo.ZoneInfoNotFoundError):
+        pass
+    if vtimezone is not None:
+        try:
+            return dateutil.tz.tzical(io.StringIO(vtimezone)).get(tzid)
+        except ValueError:
+            pass
+    return None
+
+def like(value: datetime.date, dtstart: datetime.datetime) -> datetime.datetime:
+    # value as a datetime comparable to dtstart
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, dtstart.timetz())
+    if dtstart.tzinfo is None and value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    elif dtstart.tzinfo is not None and value.tzinfo is None:
+        value = value.replace(tzinfo=dtstart.tzinfo)
+    return value
+
+def fix_until(rule: str, dtstart: datetime.datetime) -> str:
+    # dateutil requires UNTIL in UTC for a DTSTART with time zone, and floating otherwise
+    match = re.search(r'UNTIL=([0-9TZ]+)', rule, re.IGNORECASE)
+    if match is None:
+        return rule
+    until = parse_date(match.group(1).upper(), None)
+    if not isinstance(until, datetime.datetime):
+        until = datetime.datetime.combine(until, datetime.time(23, 59, 59))
+    until = like(until, dtstart)
+    return rule[:match.start(1)] + format_date(until) + rule[match.end(1):]
@@ -0,0 +1,94 @@
+import datetime
+
+import vobject
+
+import ical_parser
+from logic import HeatNeededIndicator
+from recurrence import RecurrenceExpander
+
+VTIMEZONE = '''BEGIN:VTIMEZONE
+TZID:W. Europe Standard Time
+BEGIN:STANDARD
+DTSTART:16010101T030000
+TZOFFSETFROM:+0200
+TZOFFSETTO:+0100
+RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10
+END:STANDARD
+BEGIN:DAYLIGHT
+DTSTART:16010101T020000
+TZOFFSETFROM:+0100
+TZOFFSETTO:+0200
+RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3
+END:DAYLIGHT
+END:VTIMEZONE
+'''
+
+def make_ics(vevents: list[str], vtimezone: str = '') -> str:
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//test//test//EN'] + vtimezone.splitlines()
+    for (i, vevent) in enumerate(vevents):
+        lines += ['BEGIN:VEVENT', 'UID:%i' % i, 'DTSTAMP:19800101T000000Z'] + vevent.split('\n') + ['END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
+
+CALENDAR = make_ics([
+    'DTSTART:19800101T120000Z\nDTEND:19800101T140000Z\nSUMMARY:Folded\n  summary\n'
+    'DESCRIPTION:Line\\nnext\\, with\\; escapes !cold!\nLOCATION:skipped',
+    'DTSTART;TZID=Europe/Berlin:19800701T120000\nDTEND;TZID=Europe/Berlin:19800701T133000\nSUMMARY:Olson',
+    'DTSTART;TZID="W. Europe Standard Time":19800701T120000\nDTEND;TZID="W. Europe Standard Time":19800701T130000\n'
+    'SUMMARY:Windows\nBEGIN:VALARM\nACTION:DISPLAY\nDESCRIPTION:Alarm\nTRIGGER:-PT15M\nEND:VALARM',
+    'DTSTART;VALUE=DATE:19800102\nDTEND;VALUE=DATE:19800103\nSUMMARY:Whole day',
+    'DTSTART:19800103T080000\nDTEND:19800103T090000\nSUMMARY:Floating'], VTIMEZONE)
+DURATION = make_ics(['DTSTART:19800101T120000Z\nDURATION:-P1W2DT1H30M\nSUMMARY:Duration'])
+
+SERIES = make_ics([
+    'DTSTART;TZID=Europe/Berlin:19800102T100000\nDTEND;TZID=Europe/Berlin:19800102T110000\n'
+    'RRULE:FREQ=DAILY;UNTIL=19800401T000000\nEXDATE;TZID=Europe/Berlin:19800105T100000,19800106T100000\n'
+    'RDATE;TZID=Europe/Berlin:19800110T180000\nSUMMARY:Series',
+    'RECURRENCE-ID;TZID=Europe/Berlin:19800108T100000\nDTSTART;TZID=Europe/Berlin:19800108T150000\n'
+    'DTEND;TZID=Europe/Berlin:19800108T160000\nSUMMARY:Moved'])
+
+def properties(vobj) -> list[tuple]:
+    result = []
+    for vevent in vobj.vevent_list:
+        values = []
+        for name in ['summary', 'description', 'dtstart', 'dtend', 'duration', 'recurrence_id']:
+            try:
+                value = getattr(vevent, name).value
+            except AttributeError:
+                value = None
+            if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+                # the same instant, whatever tzinfo implementation
+                value = value.astimezone(datetime.timezone.utc)
+            values.append(value)
+        result.append(tuple(values))
+    return result
+
+def test_same_values_as_vobject():
+    fast = ical_parser.parse(CALENDAR)
+    assert properties(fast) == properties(vobject.readOne(CALENDAR))
+    assert properties(ical_parser.parse(DURATION)) == properties(vobject.readOne(DURATION))
+    assert [vevent.summary.value for vevent in fast.vevent_list][0] == 'Folded summary'
+    assert 'location' not in fast.vevent_list[0].contents and 'valarm' not in fast.vevent_list[2].contents
+
+def test_same_instances_as_vobject():
+    start = datetime.datetime(1980, 1, 1, tzinfo=datetime.timezone.utc)
+    instances = {}
+    for parser in ical_parser.PARSERS:
+        vevents = RecurrenceExpander(parser=parser).expand('series', SERIES, start, start + datetime.timedelta(days=12))
+        instances[parser] = sorted((vevent.summary.value, vevent.dtstart.value, vevent.dtend.value)
+                                   for vevent in vevents)
+    assert len(instances['fast']) == 10
+    assert instances['fast'] == instances['vobject']
+
+def test_events_from_fast_parser(mocker):
+    calendar = mocker.Mock()
+    expander = RecurrenceExpander(parser='fast')
+    resource = expander.parse('calendar', CALENDAR)
+    objects = [expander.make_event(calendar, 'https://caldav.example.com/calendar.ics', resource.vobj)]
+    indicator = HeatNeededIndicator(preheat_minutes=0, cooloff_minutes=0, no_heat_tag='!cold!')
+    events = indicator.filter_events(objects, None)
+    assert [event.summary for event in events] == ['Olson', 'Windows', 'Floating']
+
+    # serialized for caldav, times in UTC
+    reparsed = vobject.readOne(objects[0].data)
+    assert properties(reparsed) == properties(resource.vobj)
@@ -7,6 +7,10 @@ import json
 import os
 import dotenv
 import sys
+import textwrap
+from typing import Mapping
+
+from actions import Action
 
 EXIT_OK = 0
 EXIT_AUTHENTICATION_FAILED = 1
@@ -17,38 +21,81 @@ EXIT_LIST_SCENES_FAILED = 5
 EXIT_SCENE_MISSING = 6
 EXIT_TRIGGER_SCENE_FAILED = 7
 
-def main() -> int:
-    dotenv.load_dotenv()
+class IotTuyaAction(Action):
+    def __init__(self, env: Mapping[str, str]) -> None:
+        self.env = env
+        self.openapi = None
+        self.uid = None
+
+    def connect(self) -> int:
+        for key in [ 'endpoint_url',
+                     'access_id',
+                     'access_secret',
+                     'username',
+                     'password',
+                     'country_code',
+                     'schema' ]:
+            if not self.env.get('iot_tuya_' + key):
+                print( f"Please specify missing {'iot_tuya_' + key} in your .env file.",
+                      file=sys.stderr)
+                return EXIT_AUTHENTICATION_FAILED
+
+        # Init
+        # TUYA_LOGGER.setLevel(logging.DEBUG)
+        openapi = TuyaOpenAPI(
+            self.env.get('iot_tuya_endpoint_url'),
+            self.env.get('iot_tuya_access_id'),
+            self.env.get('iot_tuya_access_secret'))
+        response = openapi.connect(
+            self.env.get('iot_tuya_username'),
+            self.env.get('iot_tuya_password'),
+            self.env.get('iot_tuya_country_code'),
+            self.env.get('iot_tuya_schema'))
 
-    for key in [ 'endpoint_url',
-                 'access_id',
-                 'access_secret',
-                 'username',
-                 'password',
-                 'country_code',
-                 'schema' ]:
-        if not os.environ.get('iot_tuya_' + key):
-            print( f"Please specify missing {'iot_tuya_' + key} in your .env file.",
-                  file=sys.stderr)
+        if not response['success']:
+            print('Authentication failed: %s' % response['msg'], file=sys.stderr)
             return EXIT_AUTHENTICATION_FAILED
 
-    # Init
-    # TUYA_LOGGER.setLevel(logging.DEBUG)
-    openapi = TuyaOpenAPI(
-        os.environ.get('iot_tuya_endpoint_url'),
-        os.environ.get('iot_tuya_access_id'),
-        os.environ.get('iot_tuya_access_secret'))
-    response = openapi.connect(
-        os.environ.get('iot_tuya_username'),
-        os.environ.get('iot_tuya_password'),
-        os.environ.get('iot_tuya_country_code'),
-        os.environ.get('iot_tuya_schema'))
+        self.openapi = openapi
+        self.uid = response['result']['uid']
+        return EXIT_OK
 
-    if not response['success']:
-        print('Authentication failed: %s' % response['msg'], file=sys.stderr)
-        return EXIT_AUTHENTICATION_FAILED
+    def set_state(self, on: bool) -> int:
+        # connects once, the access token is refreshed by TuyaOpenAPI
+        if self.openapi is None and (result := self.connect()) != EXIT_OK:
+            return result
 
-    uid = response['result']['uid']
+        home_id = self.env.get('iot_tuya_home')
+        if not home_id:
+            print('Set iot_tuya_home in .env first, in order to trigger scenes!', file=sys.stderr)
+            return EXIT_HOME_MISSING
+
+        scene_variable = 'iot_tuya_scene_on' if on else 'iot_tuya_scene_off'
+        scene_id = self.env.get(scene_variable)
+        if not scene_id:
+            print('Set %s in .env first!' % scene_variable, file=sys.stderr)
+            return EXIT_SCENE_MISSING
+
+        response = self.openapi.post('/v1.0/homes/{home_id}/scenes/{scene_id}/trigger'.format(home_id = home_id, scene_id = scene_id))
+        if not response['success']:
+            print('Error triggering scene: %s' % response['msg'], file=sys.stderr)
+            # authenticate again with the next switch
+            self.openapi = None
+            return EXIT_TRIGGER_SCENE_FAILED
+        print('iot.tuya trigger succeeded.')
+        return EXIT_OK
+
+def create_action(env: Mapping[str, str], wrapper: textwrap.TextWrapper) -> Action:
+    return IotTuyaAction(env)
+
+def main() -> int:
+    dotenv.load_dotenv()
+
+    client = IotTuyaAction(os.environ)
+    if (result := client.connect()) != EXIT_OK:
+        return result
+    openapi = client.openapi
+    uid = client.uid
 
     try:
         cmd = sys.argv[1]
@@ -70,9 +117,8 @@ def main() -> int:
             print('%s: %s' % (home['name'], home['home_id']))
         return EXIT_OK
 
-    home_id = os.environ.get('iot_tuya_home')
-
     if cmd == 'scenes':
+        home_id = os.environ.get('iot_tuya_home')
         if not home_id:
             print('Set iot_tuya_home in .env first, in order to list scenes!', file=sys.stderr)
             return EXIT_HOME_MISSING
@@ -85,27 +131,7 @@ def main() -> int:
             print('%s: %s' % (scene['name'], scene['scene_id']))
         return EXIT_OK
 
-    if not home_id:
-        print('Set iot_tuya_home in .env first, in order to trigger scenes!', file=sys.stderr)
-        return EXIT_HOME_MISSING
-
-    if cmd == 'on':
-        scene_id = os.environ.get('iot_tuya_scene_on')
-        if not scene_id:
-            print('Set iot_tuya_scene_on in .env first!', file=sys.stderr)
-            return EXIT_SCENE_MISSING
-    elif cmd == 'off':
-        scene_id = os.environ.get('iot_tuya_scene_off')
-        if not scene_id:
-            print('Set iot_tuya_scene_off in .env first!', file=sys.stderr)
-            return EXIT_SCENE_MISSING
-
-    response = openapi.post('/v1.0/homes/{home_id}/scenes/{scene_id}/trigger'.format(home_id = home_id, scene_id = scene_id))
-    if not response['success']:
-        print('Error triggering scene: %s' % response['msg'], file=sys.stderr)
-        return EXIT_TRIGGER_SCENE_FAILED
-    print('iot.tuya trigger succeeded.')
-    return EXIT_OK
+    return client.set_state(cmd == 'on')
 
 if __name__ == '__main__':
     sys.exit(main())
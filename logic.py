@@ -1,9 +1,18 @@
-import vobject
+from __future__ import annotations
+
+import array
+import bisect
+import sys
 import datetime
 import time
 import textwrap
-import caldav
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable
+
+if TYPE_CHECKING:
+    # only annotations: the heating logic runs on snapshots without loading them
+    import caldav
+    import vobject
 
 @dataclass
 class Event:
@@ -26,6 +35,71 @@ class Event:
             description = None
         return Event(vevent.summary.value, description, vevent.dtstart.value.astimezone(), vevent.dtend.value.astimezone())
 
+class EventStore:
+    """
+    Events in columns: start and end as unix time in arrays of doubles,
+    interned summaries and descriptions, and a bitmask per event of which of
+    `tags` its description contains. Costs a few dozen bytes per event,
+    repeated summaries stored once; Event objects are only created by
+    event() and events(), e.g. to serialize them.
+    """
+
+    __slots__ = ('tags', 'start', 'end', 'summaries', 'descriptions', 'tag_bits')
+
+    def __init__(self, tags: Iterable[str] = ()) -> None:
+        self.tags = tuple(tags)
+        self.start = array.array('d')
+        self.end = array.array('d')
+        self.summaries = []
+        self.descriptions = []
+        self.tag_bits = array.array('L')
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def __repr__(self) -> str:
+        return 'EventStore(%s)' % ', '.join(repr(event) for event in self.events())
+
+    def mask(self, *tags: str | None) -> int:
+        # Bits of the given tags, tags not in the store (or None) have none
+        return sum(1 << self.tags.index(tag) for tag in tags if tag in self.tags)
+
+    def append(self, summary: str, description: str | None, start: float, end: float) -> None:
+        self.start.append(start)
+        self.end.append(end)
+        self.summaries.append(sys.intern(summary))
+        self.descriptions.append(None if description is None else sys.intern(description))
+        self.tag_bits.append(0 if description is None else
+                             sum(1 << i for (i, tag) in enumerate(self.tags) if tag in description))
+
+    def indices(self, exclude: int = 0) -> list[int]:
+        # Events without any of the tag bits in `exclude`
+        if not exclude:
+            return list(range(len(self)))
+        return [i for (i, bits) in enumerate(self.tag_bits) if not bits & exclude]
+
+    def needed_at(self, now: float, preheat_seconds: float, cooloff_seconds: float,
+                  exclude: int = 0) -> tuple[int, ...]:
+        # Events needing heating at `now`: from preheat before their start until cooloff before their end
+        return tuple(i for (i, (start, end, bits)) in enumerate(zip(self.start, self.end, self.tag_bits))
+                     if start - preheat_seconds <= now < end - cooloff_seconds and not bits & exclude)
+
+    def intervals(self, preheat_seconds: float, cooloff_seconds: float, exclude: int = 0) -> list[tuple[float, float]]:
+        # Non-empty heating intervals of the events, as unix time
+        intervals = []
+        for (start, end, bits) in zip(self.start, self.end, self.tag_bits):
+            if not bits & exclude and start - preheat_seconds < end - cooloff_seconds:
+                intervals.append((start - preheat_seconds, end - cooloff_seconds))
+        return intervals
+
+    def event(self, i: int) -> Event:
+        return Event(self.summaries[i], self.descriptions[i],
+                     datetime.datetime.fromtimestamp(self.start[i]).astimezone(),
+                     datetime.datetime.fromtimestamp(self.end[i]).astimezone())
+
+    def events(self, indices: Iterable[int] | None = None) -> list[Event]:
+        return [self.event(i) for i in (range(len(self)) if indices is None else indices)]
+
 class HeatNeededIndicator:
     preheat_minutes = 0
     cooloff_minutes = 0
@@ -45,52 +119,177 @@ class HeatNeededIndicator:
     def set_wrapper(self, wrapper: textwrap.TextWrapper) -> None:
         self.wrapper = wrapper
 
-    def get_next_events(self, calendar: caldav.Calendar, now: datetime.datetime) -> list[Event]:
-        events = []
-        cooloff_timestamp = now + datetime.timedelta(minutes=self.cooloff_minutes,microseconds=1)
-        preheat_timestamp = now + datetime.timedelta(minutes=self.preheat_minutes,microseconds=1)
+    def margins(self, preheat_minutes: int | None = None, cooloff_minutes: int | None = None) -> tuple[int, int]:
+        # Per-call preheat/cooloff, defaulting to the ones of the indicator
+        return (self.preheat_minutes if preheat_minutes is None else preheat_minutes,
+                self.cooloff_minutes if cooloff_minutes is None else cooloff_minutes)
+
+    def search_window(self, now: datetime.datetime, until: datetime.datetime | None = None,
+                      preheat_minutes: int | None = None, cooloff_minutes: int | None = None
+                      ) -> tuple[datetime.datetime, datetime.datetime, datetime.datetime | None]:
+        # Time range to search events in and - if needed - the time events have to end after
+        (preheat_minutes, cooloff_minutes) = self.margins(preheat_minutes, cooloff_minutes)
+        cooloff_timestamp = now + datetime.timedelta(minutes=cooloff_minutes,microseconds=1)
+        # events starting up to now + preheat: CalDAV time ranges have whole seconds, the end is exclusive
+        preheat_timestamp = ((now if until is None else until) + datetime.timedelta(minutes=preheat_minutes)
+                             ).replace(microsecond=0) + datetime.timedelta(seconds=1)
 
         begin_search_window = now
         end_search_window = preheat_timestamp
 
-        if self.cooloff_minutes < self.preheat_minutes:
+        if cooloff_minutes < preheat_minutes:
             # can use shortcut to only search from cooloff_timestamp
             begin_search_window = cooloff_timestamp
             cooloff_timestamp = None
 
-        for event in calendar.date_search(start=begin_search_window, end=end_search_window):
-            vobj = event.vobject_instance
-            vevent = vobj.vevent_list[-1] # assume that the last entry (if multiple) is the override of a recurrent event - if that proves false, need to filter on recurrence-id, ...
-            try:
-                summary = vevent.summary.value
-            except: # Missing summary
-                if self.wrapper is not None:
-                    print(self.wrapper.fill("Skipping unnamed event!"))
-                continue
-            if isinstance(vevent.dtstart.value, datetime.date) or isinstance(vevent.dtend.value, datetime.date):
-                if self.wrapper is not None:
-                    print(self.wrapper.fill("Skipping whole-day event: %s" % summary))
-                continue
-            try:
-                if self.no_heat_tag is not None and vevent.description.value.find(self.no_heat_tag) >= 0:
+        return begin_search_window, end_search_window, cooloff_timestamp
+
+    def get_event_store(self, calendar: caldav.Calendar, now: datetime.datetime,
+                        until: datetime.datetime | None = None,
+                        preheat_minutes: int | None = None, cooloff_minutes: int | None = None) -> EventStore:
+        # Same as get_next_events, including events tagged with no_heat_tag
+        (begin_search_window, end_search_window, cooloff_timestamp) = self.search_window(
+            now, until, preheat_minutes, cooloff_minutes)
+        return self.collect_events(calendar.date_search(start=begin_search_window, end=end_search_window),
+                                   cooloff_timestamp, begin_search_window, end_search_window)
+
+    async def get_event_store_async(self, calendar, now: datetime.datetime,
+                                    until: datetime.datetime | None = None,
+                                    preheat_minutes: int | None = None, cooloff_minutes: int | None = None
+                                    ) -> EventStore:
+        # Same as get_event_store, for a calendar with a coroutine date_search such as AsyncCalendar
+        (begin_search_window, end_search_window, cooloff_timestamp) = self.search_window(
+            now, until, preheat_minutes, cooloff_minutes)
+        return self.collect_events(await calendar.date_search(start=begin_search_window, end=end_search_window),
+                                   cooloff_timestamp, begin_search_window, end_search_window)
+
+    def get_next_events(self, calendar: caldav.Calendar, now: datetime.datetime,
+                        until: datetime.datetime | None = None,
+                        preheat_minutes: int | None = None, cooloff_minutes: int | None = None) -> list[Event]:
+        # Events needing heating at `now` or - if `until` is given - at any time up to `until`
+        return self.heating_events(self.get_event_store(calendar, now, until, preheat_minutes, cooloff_minutes))
+
+    async def get_next_events_async(self, calendar, now: datetime.datetime,
+                                    until: datetime.datetime | None = None,
+                                    preheat_minutes: int | None = None, cooloff_minutes: int | None = None) -> list[Event]:
+        # Same as get_next_events, for a calendar with a coroutine date_search such as AsyncCalendar
+        return self.heating_events(await self.get_event_store_async(calendar, now, until,
+                                                                    preheat_minutes, cooloff_minutes))
+
+    def filter_events(self, calendar_objects: list[caldav.CalendarObjectResource],
+                      cooloff_timestamp: datetime.datetime | None, start: datetime.datetime | None = None,
+                      end: datetime.datetime | None = None) -> list[Event]:
+        return self.heating_events(self.collect_events(calendar_objects, cooloff_timestamp, start, end))
+
+    def heating_events(self, store: EventStore) -> list[Event]:
+        # The events of the store not tagged with no_heat_tag
+        return store.events(store.indices(exclude=store.mask(self.no_heat_tag)))
+
+    def collect_events(self, calendar_objects: list[caldav.CalendarObjectResource],
+                       cooloff_timestamp: datetime.datetime | None, start: datetime.datetime | None = None,
+                       end: datetime.datetime | None = None) -> EventStore:
+        # Events overlapping the search window `start`...`end`, if given
+        store = EventStore([] if self.no_heat_tag is None else [self.no_heat_tag])
+        for event in calendar_objects:
+            # one VEVENT per instance if expanded: overrides and occurrences of recurring events
+            for vevent in event.vobject_instance.vevent_list:
+                if 'recurrence-id' not in vevent.contents and ('rrule' in vevent.contents or 'rdate' in vevent.contents):
+                    # master of a recurring event that has not been expanded
+                    continue
+                try:
+                    summary = vevent.summary.value
+                except: # Missing summary
                     if self.wrapper is not None:
-                        print(self.wrapper.fill("Found event %s with %s in description:\n%s" %
-                            (summary, self.no_heat_tag, vevent.description.value)))
+                        print(self.wrapper.fill("Skipping unnamed event!"))
+                    continue
+                if not isinstance(vevent.dtstart.value, datetime.datetime) or not isinstance(vevent.dtend.value, datetime.datetime):
+                    if self.wrapper is not None:
+                        print(self.wrapper.fill("Skipping whole-day event: %s" % summary))
+                    continue
+                (event_start, event_end) = (vevent.dtstart.value.timestamp(), vevent.dtend.value.timestamp())
+                if ((start is not None and event_end <= start.timestamp())
+                        or (end is not None and event_start >= end.timestamp())):
+                    # an override returned along with its recurring event, moved out of the window
+                    continue
+                try:
+                    description = vevent.description.value
+                except:
+                    # no description in event: fine!
+                    description = None
+                no_heat = self.no_heat_tag is not None and description is not None and self.no_heat_tag in description
+                if no_heat and self.wrapper is not None:
+                    print(self.wrapper.fill("Found event %s with %s in description:\n%s" %
+                        (summary, self.no_heat_tag, description)))
+                if cooloff_timestamp is not None and vevent.dtend.value <= cooloff_timestamp:
+                    # cooloff already has begun:
                     continue
-            except:
-                # no description in event: fine!
-                pass
-            if cooloff_timestamp is not None and vevent.dtend.value <= cooloff_timestamp:
-                # cooloff already has begun:
-                continue
 
-            if self.wrapper is not None:
-                print(self.wrapper.fill("Found event that needs heating: %s" % summary))
+                if not no_heat and self.wrapper is not None:
+                    print(self.wrapper.fill("Found event that needs heating: %s" % summary))
 
-            events.append(Event.from_vobject(vevent))
+                store.append(summary, description, event_start, event_end)
 
-        return events
+        return store
 
     def is_needed(self, calendar: caldav.Calendar, now: datetime.datetime) -> bool:
         return len(self.get_next_events(calendar, now)) > 0
 
+    def heating_intervals(self, store: EventStore) -> list[tuple[float, float]]:
+        # Heating for an event is needed from preheat before its start until cooloff before its end
+        return store.intervals(self.preheat_minutes * 60, self.cooloff_minutes * 60,
+                               exclude=store.mask(self.no_heat_tag))
+
+    def get_timeline(self, calendar: caldav.Calendar, start: datetime.datetime,
+                     end: datetime.datetime) -> 'HeatingTimeline':
+        store = self.get_event_store(calendar, start, end)
+        return HeatingTimeline(self.heating_intervals(store), start, end)
+
+class HeatingTimeline:
+    """
+    Sorted, merged heating intervals for the time from `start` until `end`,
+    answering queries by bisection without any further calendar access.
+    Intervals are kept as unix time in arrays.
+    """
+
+    def __init__(self, intervals: list[tuple[float, float]],
+                 start: datetime.datetime, end: datetime.datetime) -> None:
+        self.start = start
+        self.end = end
+        self.heat_on = array.array('d')
+        self.heat_off = array.array('d')
+        for (heat_on, heat_off) in sorted(intervals):
+            if self.heat_off and heat_on <= self.heat_off[-1]:
+                self.heat_off[-1] = max(self.heat_off[-1], heat_off)
+            else:
+                self.heat_on.append(heat_on)
+                self.heat_off.append(heat_off)
+
+    def __repr__(self) -> str:
+        return 'HeatingTimeline(%s)' % ', '.join('%s - %s' % (self.to_datetime(heat_on), self.to_datetime(heat_off))
+                                                 for (heat_on, heat_off) in zip(self.heat_on, self.heat_off))
+
+    def __len__(self) -> int:
+        return len(self.heat_on)
+
+    def to_datetime(self, timestamp: float) -> datetime.datetime:
+        return datetime.datetime.fromtimestamp(timestamp, self.start.tzinfo)
+
+    def covers(self, now: datetime.datetime) -> bool:
+        return self.start <= now <= self.end
+
+    def is_needed(self, now: datetime.datetime) -> bool:
+        now = now.timestamp()
+        i = bisect.bisect_right(self.heat_on, now) - 1
+        return i >= 0 and now < self.heat_off[i]
+
+    def next_transition(self, now: datetime.datetime) -> datetime.datetime | None:
+        # None if there is no transition until the end of the timeline
+        now = now.timestamp()
+        i = bisect.bisect_right(self.heat_on, now) - 1
+        if i >= 0 and now < self.heat_off[i]:
+            transition = self.heat_off[i]
+        elif i + 1 < len(self.heat_on):
+            transition = self.heat_on[i + 1]
+        else:
+            return None
+        return self.to_datetime(transition) if transition <= self.end.timestamp() else None
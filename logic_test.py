@@ -189,3 +189,90 @@ def test_is_needed_overlapping_events(mocker):
         ]
 
     data_drive_test_is_needed(mocker, indicator, test_events, test_data)
+
+def test_timeline(mocker):
+    indicator = HeatNeededIndicator(preheat_minutes=60, cooloff_minutes=30, no_heat_tag='!cold!')
+
+    test_events = [
+        # ( start,                   end,                     summary,                description or None )
+          ( make_datetime(12, 0, 0), make_datetime(14, 0, 0), 'Test event noon',      None )
+        , ( make_datetime(14, 0, 0), make_datetime(14,30, 0), 'Test cold event',      'This event is !cold!. Yay.' )
+        , ( make_datetime(16,15, 0), make_datetime(18, 0, 0), 'Test event afternoon', None )
+        , ( make_datetime(17, 0, 0), make_datetime(19, 0, 0), 'Test event overlap',   None )
+        , ( make_datetime(20, 0, 0), make_datetime(20, 0, 0), 'Borderline event',     None )
+        ]
+
+    mock_calendar = mocker.create_autospec(caldav.Calendar, instance = True)
+    mock_calendar.date_search.side_effect = make_date_search(test_events)
+
+    timeline = indicator.get_timeline(mock_calendar, make_datetime(0, 0, 0), make_datetime(23, 0, 0))
+    assert len(timeline) == 3
+
+    for minute in range(0, 23 * 60, 5):
+        now = make_datetime(minute // 60, minute % 60)
+        assert timeline.is_needed(now) == indicator.is_needed(mock_calendar, now), str(now)
+
+    test_data = [
+        # ( now,                         expected_transition )
+          ( make_datetime(10, 0, 0,  0), make_datetime(11, 0, 0) )
+        , ( make_datetime(11, 0, 0,  0), make_datetime(13,30, 0) )
+        , ( make_datetime(13,30, 0,  0), make_datetime(15,15, 0) )
+        , ( make_datetime(17,29,59,999), make_datetime(18,30, 0) )
+        , ( make_datetime(19,10, 0,  0), make_datetime(19,30, 0) )
+        , ( make_datetime(19,30, 0,  0), None )
+        ]
+
+    for (now, expected_transition) in test_data:
+        assert timeline.next_transition(now) == expected_transition, str(now)
+
+def test_event_store():
+    indicator = HeatNeededIndicator(preheat_minutes=60, cooloff_minutes=30, no_heat_tag='!cold!')
+    calendar_objects = [
+        make_event(make_datetime(12, 0), make_datetime(14, 0), 'Weekly meeting'),
+        make_event(make_datetime(14, 0), make_datetime(14, 30), 'Weekly meeting', 'This event is !cold!. Yay.'),
+        make_event(make_datetime(16, 0), make_datetime(17, 0), 'Weekly meeting'),
+        ]
+    store = indicator.collect_events(calendar_objects, None)
+
+    assert len(store) == 3
+    assert store.summaries[0] is store.summaries[2]
+    assert list(store.tag_bits) == [0, store.mask('!cold!'), 0]
+    assert store.indices(exclude=store.mask('!cold!')) == [0, 2]
+    assert store.needed_at(make_datetime(13, 45).timestamp(), 3600, 1800) == (1,)
+    assert store.needed_at(make_datetime(13, 45).timestamp(), 3600, 1800, exclude=store.mask('!cold!')) == ()
+    assert store.event(2) == Event('Weekly meeting', None, make_datetime(16, 0), make_datetime(17, 0))
+    assert indicator.heating_events(store) == indicator.filter_events(calendar_objects, None)
+    assert indicator.heating_intervals(store) == [(make_datetime(11, 0).timestamp(), make_datetime(13, 30).timestamp()),
+                                                  (make_datetime(15, 0).timestamp(), make_datetime(16, 30).timestamp())]
+
+def test_overrides_outside_window_are_skipped():
+    # a plain caldav.Calendar returns a recurring event with all its overrides
+    vobj = vobject.iCalendar()
+    master = vobj.add('vevent')
+    master.add('dtstart').value = make_datetime(12, 0)
+    master.add('dtend').value = make_datetime(13, 0)
+    master.add('summary').value = 'Daily meeting'
+    master.add('rrule').value = 'FREQ=DAILY'
+    for (recurrence_id, start, end) in [(make_datetime(12, 0), make_datetime(16, 0), make_datetime(17, 0)),
+                                        (make_datetime(12, 0) + datetime.timedelta(days=90),
+                                         make_datetime(8, 0) + datetime.timedelta(days=90),
+                                         make_datetime(9, 0) + datetime.timedelta(days=90))]:
+        override = vobj.add('vevent')
+        override.add('recurrence-id').value = recurrence_id
+        override.add('dtstart').value = start
+        override.add('dtend').value = end
+        override.add('summary').value = 'Moved meeting'
+    event = caldav.Event()
+    event.vobject_instance = vobj
+
+    indicator = HeatNeededIndicator(preheat_minutes=0, cooloff_minutes=0)
+    store = indicator.collect_events([event], None, make_datetime(10, 0), make_datetime(20, 0))
+    assert store.events(range(len(store))) == [
+        Event('Moved meeting', None, make_datetime(16, 0), make_datetime(17, 0))]
+
+def test_search_window_ends_after_whole_second():
+    # CalDAV time ranges have whole seconds: an event starting right at preheat is still found
+    indicator = HeatNeededIndicator(preheat_minutes=30, cooloff_minutes=60)
+    assert indicator.search_window(make_datetime(12, 0, 0, 500000))[:2] == (
+        make_datetime(12, 0, 0, 500000), make_datetime(12, 30, 1))
+    assert indicator.search_window(make_datetime(12, 0))[1] == make_datetime(12, 30, 1)
@@ -0,0 +1,35 @@
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+# Metrics of api_server.py and webhook-server.py, served by metrics_response under /metrics.
+# Label values used on hot paths are bound once below, such that recording costs a lock and an add.
+
+CALDAV_REPORT_SECONDS = Histogram(
+    'caldav_report_seconds', 'Time for a CalDAV REPORT request, until the response is read')
+EVENT_PARSE_SECONDS = Histogram(
+    'event_parse_seconds', 'Time to parse and expand the calendar data of one search',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+WINDOW_EVENTS = Histogram(
+    'event_window_events', 'Number of events in a fetched window of the event cache',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000))
+CACHE_REQUESTS = Counter(
+    'event_cache_requests', 'Requests to the event cache by result: answered right away (hit), after waiting '
+    'for a fetch (miss) or not covered by the window (uncovered)', ['result'])
+CACHE_HIT = CACHE_REQUESTS.labels('hit')
+CACHE_MISS = CACHE_REQUESTS.labels('miss')
+CACHE_UNCOVERED = CACHE_REQUESTS.labels('uncovered')
+CALDAV_CLIENT_RESETS = Counter(
+    'caldav_client_resets', 'CalDAV clients replaced after an error')
+REQUEST_SECONDS = Histogram(
+    'api_request_seconds', 'Time to answer a request, including authentication', ['endpoint'])
+
+TUYA_SECONDS = Histogram(
+    'tuya_call_seconds', 'Time for a Tuya call, also if the request timed out before', ['call'],
+    buckets=(.05, .1, .25, .5, .75, 1, 1.5, 2, 3, 5, 7.5, 10, 20, 30))
+TUYA_ACTIVATE_SECONDS = TUYA_SECONDS.labels('activate')
+TUYA_CONNECT_SECONDS = TUYA_SECONDS.labels('connect')
+TUYA_RECONNECTS = Counter(
+    'tuya_reconnects', 'Tuya clients connected again after reconnect interval')
+
+def metrics_response() -> Response:
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,160 @@
+import collections
+import datetime
+from typing import Callable, Hashable
+
+import caldav
+import vobject
+
+import ical_parser
+
+# Instance starts of a series are computed for whole buckets of this length, so polls with a
+# window moving along reuse them
+BUCKET = datetime.timedelta(days=7)
+EPOCH = datetime.datetime(1970, 1, 5, tzinfo=datetime.timezone.utc)
+MAX_BUCKETS = 256
+
+def aware(value: datetime.date) -> datetime.datetime:
+    # Whole-day dates start at local midnight, floating times are local time
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    return value if value.tzinfo is not None else value.astimezone()
+
+def vevent_end(vevent: vobject.base.Component) -> datetime.date:
+    try:
+        return vevent.dtend.value
+    except AttributeError:
+        pass
+    try:
+        return vevent.dtstart.value + vevent.duration.value
+    except AttributeError:
+        return vevent.dtstart.value
+
+def is_recurring(vevent: vobject.base.Component) -> bool:
+    return 'rrule' in vevent.contents or 'rdate' in vevent.contents
+
+def overlaps(vevent: vobject.base.Component, start: datetime.datetime, end: datetime.datetime | None) -> bool:
+    return (end is None or aware(vevent.dtstart.value) < end) and aware(vevent_end(vevent)) > start
+
+class ParsedResource:
+    """
+    The VEVENTs of one calendar resource: a single event, or the master of a
+    recurring event with its overrides (keyed by RECURRENCE-ID).
+    """
+
+    def __init__(self, vobj: vobject.base.Component) -> None:
+        self.vobj = vobj
+        self.master = None
+        self.overrides = {}
+        self.singles = []
+        for vevent in vobj.contents.get('vevent', []):
+            if 'recurrence-id' in vevent.contents:
+                self.overrides[aware(vevent.recurrence_id.value)] = vevent
+            elif self.master is None and is_recurring(vevent):
+                self.master = vevent
+            else:
+                self.singles.append(vevent)
+
+        self.rruleset = None
+        if self.master is not None and isinstance(self.master.dtstart.value, datetime.datetime):
+            # whole-day series are of no interest to heating
+            self.rruleset = self.master.getrruleset(addRDate=True)
+            self.duration = vevent_end(self.master) - self.master.dtstart.value
+            self.floating = self.master.dtstart.value.tzinfo is None
+        # bucket -> instance starts, instance start -> VEVENT
+        self.bucket_starts = {}
+        self.instances = {}
+
+    def vevents(self) -> list[vobject.base.Component]:
+        return self.vobj.contents.get('vevent', [])
+
+    def instance_starts(self, start: datetime.datetime, end: datetime.datetime) -> list[datetime.datetime]:
+        buckets = range((start - EPOCH) // BUCKET, (end - EPOCH) // BUCKET + 1)
+        missing = [bucket for bucket in buckets if bucket not in self.bucket_starts]
+        if missing:
+            if len(self.bucket_starts) + len(missing) > MAX_BUCKETS:
+                self.bucket_starts.clear()
+                self.instances.clear()
+                missing = list(buckets)
+            # one pass over the rule for all missing buckets: each pass iterates from DTSTART
+            (search_start, search_end) = (EPOCH + missing[0] * BUCKET, EPOCH + (missing[-1] + 1) * BUCKET)
+            if self.floating:
+                search_start = search_start.astimezone().replace(tzinfo=None)
+                search_end = search_end.astimezone().replace(tzinfo=None)
+            starts = { bucket: [] for bucket in missing }
+            for instance_start in self.rruleset.between(search_start, search_end, inc=True):
+                bucket = (aware(instance_start) - EPOCH) // BUCKET
+                if bucket in starts and instance_start < search_end:
+                    starts[bucket].append(instance_start)
+            self.bucket_starts.update(starts)
+        result = []
+        for bucket in buckets:
+            result.extend(instance_start for instance_start in self.bucket_starts[bucket]
+                          if start <= aware(instance_start) < end)
+        return result
+
+    def instance(self, instance_start: datetime.datetime) -> vobject.base.Component:
+        if instance_start not in self.instances:
+            instance = self.master.duplicate(self.master)
+            for name in ['rrule', 'rdate', 'exdate', 'exrule', 'dtend', 'duration']:
+                instance.contents.pop(name, None)
+            instance.dtstart.value = instance_start
+            instance.add('dtend').value = instance_start + self.duration
+            instance.add('recurrence-id').value = instance_start
+            self.instances[instance_start] = instance
+        return self.instances[instance_start]
+
+    def expand(self, start: datetime.datetime, end: datetime.datetime | None) -> list[vobject.base.Component]:
+        # VEVENTs of the instances overlapping start...end, with overrides applied
+        result = [vevent for vevent in self.singles if overlaps(vevent, start, end)]
+        result += [vevent for vevent in self.overrides.values() if overlaps(vevent, start, end)]
+        if self.rruleset is None or end is None:
+            return result
+        for instance_start in self.instance_starts(start - self.duration, end):
+            if aware(instance_start) in self.overrides:
+                continue
+            if aware(instance_start) + self.duration > start:
+                result.append(self.instance(instance_start))
+        return result
+
+class RecurrenceExpander:
+    """
+    Parses calendar resources and expands recurring events locally, memoized by
+    a key identifying the resource version such as (href, ETag): a series is
+    parsed once, and its instances are computed once per week, however often
+    it is searched. Holds the `max_entries` most recently used resources.
+    `parser` is a key of ical_parser.PARSERS.
+    """
+
+    def __init__(self, max_entries: int = 1024, parser: str = 'vobject') -> None:
+        self.max_entries = max_entries
+        self.resources = collections.OrderedDict()
+        (self.read, self.new_calendar) = ical_parser.PARSERS[parser]
+
+    def parse(self, key: Hashable, data: str | Callable[[], str]) -> ParsedResource:
+        if key in self.resources:
+            self.resources.move_to_end(key)
+            return self.resources[key]
+        resource = ParsedResource(self.read(data() if callable(data) else data))
+        self.resources[key] = resource
+        if len(self.resources) > self.max_entries:
+            self.resources.popitem(last=False)
+        return resource
+
+    def expand(self, key: Hashable, data: str | Callable[[], str], start: datetime.datetime,
+               end: datetime.datetime | None) -> list[vobject.base.Component]:
+        return self.parse(key, data).expand(start, end)
+
+    def make_events(self, calendar: caldav.Calendar, href: str, vevents: list[vobject.base.Component]
+                    ) -> list[caldav.Event]:
+        # One event per instance, as returned by caldav for an expanded search
+        events = []
+        for vevent in vevents:
+            vobj = self.new_calendar()
+            vobj.add(vevent)
+            events.append(self.make_event(calendar, href, vobj))
+        return events
+
+    def make_event(self, calendar: caldav.Calendar, href: str, vobj: vobject.base.Component) -> caldav.Event:
+        event = caldav.Event(calendar.client, url=href, parent=calendar)
+        event.vobject_instance = vobj
+        return event
@@ -0,0 +1,81 @@
+import datetime
+
+import caldav
+
+from logic import HeatNeededIndicator
+from recurrence import RecurrenceExpander
+
+def make_ics(uid: str, vevents: list[str]) -> str:
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//test//test//EN']
+    for vevent in vevents:
+        lines += ['BEGIN:VEVENT', 'UID:' + uid, 'DTSTAMP:19800101T000000Z'] + vevent.split('\n') + ['END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(lines) + '\r\n'
+
+WEEKLY = make_ics('weekly', [
+    'DTSTART:19800102T100000Z\nDTEND:19800102T110000Z\nRRULE:FREQ=WEEKLY\nEXDATE:19800116T100000Z\n'
+    'SUMMARY:Weekly event',
+    'RECURRENCE-ID:19800109T100000Z\nDTSTART:19800109T150000Z\nDTEND:19800109T160000Z\nSUMMARY:Moved instance'])
+FLOATING = make_ics('floating', [
+    'DTSTART:19800102T100000\nDTEND:19800102T110000\nRRULE:FREQ=DAILY\nSUMMARY:Floating event'])
+
+def make_datetime(day: int, hour: int) -> datetime.datetime:
+    return datetime.datetime(1980, 1, day, hour, tzinfo=datetime.timezone.utc)
+
+def test_overrides_and_exceptions():
+    expander = RecurrenceExpander()
+    vevents = expander.expand('weekly', WEEKLY, make_datetime(1, 0), make_datetime(31, 0))
+    assert sorted((vevent.summary.value, vevent.dtstart.value) for vevent in vevents) == [
+        ('Moved instance', make_datetime(9, 15)),
+        ('Weekly event', make_datetime(2, 10)),
+        ('Weekly event', make_datetime(23, 10)),
+        ('Weekly event', make_datetime(30, 10))]
+
+    # an instance that began before the search window but is still ongoing
+    vevents = expander.expand('weekly', WEEKLY, make_datetime(23, 10) + datetime.timedelta(minutes=30),
+                              make_datetime(23, 12))
+    assert [vevent.dtend.value for vevent in vevents] == [make_datetime(23, 11)]
+
+def test_floating_times_are_local():
+    expander = RecurrenceExpander()
+    start = datetime.datetime(1980, 1, 5, 9).astimezone()
+    vevents = expander.expand('floating', FLOATING, start, start + datetime.timedelta(hours=2))
+    assert [vevent.dtstart.value for vevent in vevents] == [datetime.datetime(1980, 1, 5, 10)]
+
+def test_expansion_is_memoized():
+    expander = RecurrenceExpander(max_entries=1)
+    resource = expander.parse(('weekly', 'etag-1'), WEEKLY)
+    assert expander.parse(('weekly', 'etag-1'), lambda: 1 / 0) is resource
+
+    first = expander.expand(('weekly', 'etag-1'), WEEKLY, make_datetime(20, 0), make_datetime(24, 0))
+    buckets = dict(resource.bucket_starts)
+    second = expander.expand(('weekly', 'etag-1'), WEEKLY, make_datetime(20, 0), make_datetime(24, 0))
+    assert first == second and first[0] is second[0]
+    assert resource.bucket_starts == buckets
+
+    # a new ETag is a new version of the resource, the old one is evicted
+    assert expander.parse(('weekly', 'etag-2'), WEEKLY) is not resource
+    assert list(expander.resources) == [('weekly', 'etag-2')]
+
+def test_every_instance_is_an_event(mocker):
+    calendar = mocker.Mock()
+    expander = RecurrenceExpander()
+    vevents = expander.expand('weekly', WEEKLY, make_datetime(1, 0), make_datetime(12, 0))
+    objects = expander.make_events(calendar, 'https://caldav.example.com/weekly.ics', vevents)
+    assert all(isinstance(obj, caldav.Event) for obj in objects)
+
+    indicator = HeatNeededIndicator(preheat_minutes=0, cooloff_minutes=0)
+    events = indicator.filter_events(objects, None)
+    assert sorted((event.summary, event.dtstart) for event in events) == [
+        ('Moved instance', make_datetime(9, 15)),
+        ('Weekly event', make_datetime(2, 10))]
+
+def test_buckets_filled_in_one_pass(mocker):
+    expander = RecurrenceExpander()
+    resource = expander.parse('weekly', WEEKLY)
+    between = mocker.spy(resource.rruleset, 'between')
+    expander.expand('weekly', WEEKLY, make_datetime(20, 0), make_datetime(24, 0))
+    vevents = expander.expand('weekly', WEEKLY, make_datetime(1, 0), make_datetime(31, 0))
+    assert between.call_count == 2
+    assert sorted(vevent.dtstart.value for vevent in vevents) == [
+        make_datetime(2, 10), make_datetime(9, 15), make_datetime(23, 10), make_datetime(30, 10)]
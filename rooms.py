@@ -0,0 +1,37 @@
+import json
+import os
+from dataclasses import dataclass, field
+
+from logic import HeatNeededIndicator
+
+@dataclass
+class Room:
+    name: str
+    calendar_id: str
+    indicator: HeatNeededIndicator
+    action: str
+    action_env: dict[str, str] = field(default_factory=dict)
+
+def load_rooms() -> list[Room]:
+    # Rooms from the JSON object in `rooms`, falling back to the single room configured by
+    # calendar_id. Settings missing for a room default to the top-level ones.
+    preheat_minutes = os.getenv('preheat_minutes')
+    cooloff_minutes = os.getenv('cooloff_minutes')
+    no_heat_tag = os.getenv('no_heat_tag')
+    action = os.getenv('action')
+
+    rooms_json = os.getenv('rooms')
+    if not rooms_json:
+        calendar_id = os.getenv('calendar_id')
+        indicator = HeatNeededIndicator(int(preheat_minutes), int(cooloff_minutes), no_heat_tag)
+        return [ Room(calendar_id, calendar_id, indicator, action) ]
+
+    rooms = []
+    for name, definition in json.loads(rooms_json).items():
+        indicator = HeatNeededIndicator(
+            int(definition.get('preheat_minutes', preheat_minutes)),
+            int(definition.get('cooloff_minutes', cooloff_minutes)),
+            definition.get('no_heat_tag', no_heat_tag))
+        action_env = { key: str(value) for key, value in definition.get('action_env', {}).items() }
+        rooms.append(Room(name, definition['calendar_id'], indicator, definition.get('action', action), action_env))
+    return rooms
@@ -0,0 +1,27 @@
+from rooms import load_rooms
+
+def test_single_room_from_top_level_settings(monkeypatch):
+    monkeypatch.delenv('rooms', raising=False)
+    for (key, value) in { 'calendar_id': 'room-1', 'preheat_minutes': '60', 'cooloff_minutes': '15',
+                          'no_heat_tag': '!cold!', 'action': 'webhooks.py' }.items():
+        monkeypatch.setenv(key, value)
+    [room] = load_rooms()
+    assert (room.name, room.calendar_id, room.action, room.action_env) == ('room-1', 'room-1', 'webhooks.py', {})
+    indicator = room.indicator
+    assert (indicator.preheat_minutes, indicator.cooloff_minutes, indicator.no_heat_tag) == (60, 15, '!cold!')
+
+def test_rooms_default_to_top_level_settings(monkeypatch):
+    monkeypatch.delenv('no_heat_tag', raising=False)
+    for (key, value) in { 'preheat_minutes': '60', 'cooloff_minutes': '15', 'action': 'webhooks.py',
+                          'rooms': '{"hall": {"calendar_id": "hall-1", "preheat_minutes": 120, '
+                                   '"action_env": {"webhooks_heat_on_action": "hall_on", "port": 8080}}, '
+                                   '"office": {"calendar_id": "office-1", "no_heat_tag": "!cold!", '
+                                   '"action": "tuya-qr-sharing.py"}}' }.items():
+        monkeypatch.setenv(key, value)
+    (hall, office) = load_rooms()
+    assert (hall.name, hall.calendar_id, hall.action) == ('hall', 'hall-1', 'webhooks.py')
+    assert hall.action_env == { 'webhooks_heat_on_action': 'hall_on', 'port': '8080' }
+    assert (hall.indicator.preheat_minutes, hall.indicator.cooloff_minutes, hall.indicator.no_heat_tag) == (120, 15, None)
+    assert (office.name, office.calendar_id, office.action, office.action_env) == (
+        'office', 'office-1', 'tuya-qr-sharing.py', {})
+    assert (office.indicator.preheat_minutes, office.indicator.no_heat_tag) == (60, '!cold!')
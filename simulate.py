@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import datetime
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import caldav
+import dotenv
+import numpy as np
+
+from caldav_filters import FilteringCalendar, candidate_filters
+from logic import EventStore, HeatNeededIndicator
+from recurrence import ParsedResource, RecurrenceExpander
+from rooms import load_rooms
+
+@dataclass
+class Result:
+    preheat_minutes: int
+    cooloff_minutes: int
+    heating_seconds: float
+    transitions: int
+    # occupied time without heating
+    uncovered_seconds: float
+
+def union_seconds(on: np.ndarray, off: np.ndarray, start: float, end: float) -> tuple[np.ndarray, np.ndarray]:
+    # For each row of intervals [on, off): the length of their union within start...end and the
+    # number of separate intervals it consists of
+    on = np.clip(on, start, end)
+    off = np.clip(off, start, end)
+    off = np.where(off > on, off, -np.inf)
+    order = np.argsort(on, axis=1, kind='stable')
+    on = np.take_along_axis(on, order, axis=1)
+    off = np.take_along_axis(off, order, axis=1)
+    # covered[:, i]: end of the union of the first i + 1 intervals
+    covered = np.maximum.accumulate(off, axis=1)
+    previous = np.concatenate([np.full((on.shape[0], 1), -np.inf), covered[:, :-1]], axis=1)
+    seconds = np.maximum(covered - np.maximum(on, previous), 0).sum(axis=1)
+    intervals = ((off > -np.inf) & (on > previous)).sum(axis=1)
+    return seconds, intervals
+
+def simulate(store: EventStore, exclude: int, preheat_minutes: list[int], cooloff_minutes: list[int],
+             start: datetime.datetime, end: datetime.datetime) -> list[Result]:
+    # Heating from start until end for each combination of preheat_minutes and cooloff_minutes,
+    # all evaluated at once on arrays of (setting, event)
+    indices = store.indices(exclude)
+    event_start = np.frombuffer(store.start, dtype=np.float64)[indices]
+    event_end = np.frombuffer(store.end, dtype=np.float64)[indices]
+    (preheat, cooloff) = np.meshgrid(np.array(preheat_minutes, dtype=np.float64) * 60,
+                                     np.array(cooloff_minutes, dtype=np.float64) * 60, indexing='ij')
+    (preheat, cooloff) = (preheat.reshape(-1, 1), cooloff.reshape(-1, 1))
+    (start, end) = (start.timestamp(), end.timestamp())
+
+    heat_on = event_start - preheat
+    heat_off = event_end - cooloff
+    (heating, intervals) = union_seconds(heat_on, heat_off, start, end)
+    # heating switched on before start or off after end is no transition within the time range
+    transitions = (2 * intervals - ((heat_on <= start) & (heat_off > start)).any(axis=1)
+                   - ((heat_on < end) & (heat_off >= end)).any(axis=1))
+
+    occupied = np.broadcast_to(event_start, heat_on.shape)
+    vacated = np.broadcast_to(event_end, heat_off.shape)
+    (heating_or_occupied, _) = union_seconds(np.concatenate([heat_on, occupied], axis=1),
+                                             np.concatenate([heat_off, vacated], axis=1), start, end)
+    uncovered = heating_or_occupied - heating
+
+    return [Result(int(p // 60), int(c // 60), float(h), int(t), float(u)) for (p, c, h, t, u) in
+            zip(preheat.ravel(), cooloff.ravel(), heating, transitions, uncovered)]
+
+def load_ics(paths: list[str], indicator: HeatNeededIndicator, start: datetime.datetime, end: datetime.datetime,
+             parser: str) -> EventStore:
+    # Events of ICS exports, recurring events expanded from start until end
+    expander = RecurrenceExpander(parser=parser)
+    objects = []
+    for path in paths:
+        calendar = caldav.Calendar(url=Path(path).resolve().as_uri())
+        vobj = expander.read(Path(path).read_text(encoding='utf-8'))
+        # an export holds all events in one VCALENDAR: one resource per UID
+        by_uid = {}
+        for vevent in vobj.contents.get('vevent', []):
+            uid = vevent.uid.value if 'uid' in vevent.contents else id(vevent)
+            by_uid.setdefault(uid, expander.new_calendar()).add(vevent)
+        for (uid, resource) in by_uid.items():
+            objects += expander.make_events(calendar, '%s#%s' % (calendar.url, uid),
+                                            ParsedResource(resource).expand(start, end))
+    return indicator.collect_events(objects, None)
+
+def load_calendar(calendar_id: str, indicator: HeatNeededIndicator, start: datetime.datetime,
+                  end: datetime.datetime, parser: str) -> EventStore:
+    with caldav.DAVClient(url=os.getenv('caldav_url'), username=os.getenv('caldav_user'),
+                          password=os.getenv('caldav_password'),
+                          timeout=float(os.getenv('caldav_timeout', 0)) or None) as client:
+        calendar = client.principal().calendar(cal_id=calendar_id)
+        calendar = FilteringCalendar(calendar, candidate_filters(indicator.no_heat_tag), parser)
+        return indicator.collect_events(calendar.date_search(start=start, end=end), None, start, end)
+
+def minutes_range(value: str) -> list[int]:
+    # "30" or "first:last:step", last included
+    (first, _, rest) = value.partition(':')
+    if not rest:
+        return [int(first)]
+    (last, _, step) = rest.partition(':')
+    return list(range(int(first), int(last) + 1, int(step or 15)))
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Evaluate heating schedules for a grid of preheat and cooloff minutes over past bookings.')
+    parser.add_argument('--ics', nargs='+', metavar='FILE',
+                        help='read events from ICS exports instead of the CalDAV calendar configured in .env')
+    parser.add_argument('--room', help='room of the configured rooms to simulate (default: the first)')
+    parser.add_argument('--days', type=int, default=365, help='days up to --end to simulate (default: %(default)s)')
+    parser.add_argument('--end', type=datetime.datetime.fromisoformat, help='end of the simulation (default: now)')
+    parser.add_argument('--preheat', type=minutes_range, default='0:180:15',
+                        help='preheat minutes, first:last:step (default: %(default)s)')
+    parser.add_argument('--cooloff', type=minutes_range, default='0:60:15',
+                        help='cooloff minutes, first:last:step (default: %(default)s)')
+    args = parser.parse_args()
+
+    dotenv.load_dotenv()
+    if os.getenv('calendar_id') or os.getenv('rooms'):
+        rooms = load_rooms()
+        room = rooms[0] if args.room is None else next((room for room in rooms if room.name == args.room), None)
+        if room is None:
+            parser.error("unknown room %s, configured: %s" % (args.room, ', '.join(room.name for room in rooms)))
+        (calendar_id, indicator) = (room.calendar_id, room.indicator)
+    else:
+        (calendar_id, indicator) = (None, HeatNeededIndicator(0, 0, os.getenv('no_heat_tag')))
+    event_parser = os.getenv('ical_parser', 'vobject')
+
+    end = (args.end or datetime.datetime.now()).astimezone()
+    start = end - datetime.timedelta(days=args.days)
+    # events starting after the end are heated before it
+    search_end = end + datetime.timedelta(minutes=max(args.preheat))
+
+    loaded_at = time.perf_counter()
+    if args.ics:
+        store = load_ics(args.ics, indicator, start, search_end, event_parser)
+    else:
+        store = load_calendar(calendar_id, indicator, start, search_end, event_parser)
+    simulated_at = time.perf_counter()
+    results = simulate(store, store.mask(indicator.no_heat_tag), args.preheat, args.cooloff, start, end)
+    done_at = time.perf_counter()
+
+    print('%i events from %s until %s' % (len(store.indices(store.mask(indicator.no_heat_tag))),
+                                          start.isoformat(timespec='minutes'), end.isoformat(timespec='minutes')))
+    print('%8s %8s %12s %12s %12s' % ('preheat', 'cooloff', 'heating h', 'transitions', 'uncovered h'))
+    for result in results:
+        current = (result.preheat_minutes, result.cooloff_minutes) == (indicator.preheat_minutes,
+                                                                         indicator.cooloff_minutes)
+        print('%8i %8i %12.1f %12i %12.1f%s' % (
+            result.preheat_minutes, result.cooloff_minutes, result.heating_seconds / 3600, result.transitions,
+            result.uncovered_seconds / 3600, '  (current)' if current and calendar_id else ''))
+    print('loaded in %.2f s, %i settings simulated in %.3f s' % (
+        simulated_at - loaded_at, len(results), done_at - simulated_at))
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,72 @@
+import datetime
+import random
+
+import pytest
+
+from logic import EventStore, HeatNeededIndicator, HeatingTimeline
+from simulate import load_ics, main, simulate
+
+START = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+END = START + datetime.timedelta(days=7)
+
+def replay(store: EventStore, indicator: HeatNeededIndicator) -> tuple[float, int, float]:
+    # heating seconds, transitions and uncovered seconds from the timeline of caldav-trigger.py
+    timeline = HeatingTimeline(indicator.heating_intervals(store), START, END)
+    (start, end) = (START.timestamp(), END.timestamp())
+    heating = [(max(on, start), min(off, end)) for (on, off) in zip(timeline.heat_on, timeline.heat_off)
+               if on < end and off > start]
+    transitions = 2 * len(heating) - (timeline.is_needed(START)) - (timeline.is_needed(END - datetime.timedelta(seconds=1)))
+    occupied = HeatingTimeline(list(zip(store.start, store.end)), START, END)
+    uncovered = 0
+    for (on, off) in zip(occupied.heat_on, occupied.heat_off):
+        (on, off) = (max(on, start), min(off, end))
+        if on < off:
+            uncovered += off - on - sum(max(0, min(off, h_off) - max(on, h_on)) for (h_on, h_off) in heating)
+    return (sum(off - on for (on, off) in heating), transitions, uncovered)
+
+def test_same_as_timeline():
+    rng = random.Random(0)
+    store = EventStore()
+    for _ in range(60):
+        start = START.timestamp() + rng.randrange(-86400, 8 * 86400, 900)
+        store.append('Event', None, start, start + rng.choice([900, 1800, 3600, 7200]))
+
+    preheat = [0, 15, 60, 180]
+    cooloff = [0, 15, 30, 60]
+    results = simulate(store, 0, preheat, cooloff, START, END)
+    assert len(results) == 16
+    for result in results:
+        indicator = HeatNeededIndicator(result.preheat_minutes, result.cooloff_minutes)
+        (heating, transitions, uncovered) = replay(store, indicator)
+        assert result.heating_seconds == pytest.approx(heating)
+        assert result.transitions == transitions
+        assert result.uncovered_seconds == pytest.approx(uncovered)
+
+def test_load_ics(tmp_path):
+    ics = tmp_path / 'export.ics'
+    ics.write_text('\r\n'.join([
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//test//test//EN',
+        'BEGIN:VEVENT', 'UID:weekly', 'DTSTART:20231227T100000Z', 'DTEND:20231227T110000Z', 'RRULE:FREQ=WEEKLY',
+        'SUMMARY:Weekly', 'END:VEVENT',
+        'BEGIN:VEVENT', 'UID:daily', 'DTSTART:20240101T080000Z', 'DTEND:20240101T090000Z', 'RRULE:FREQ=DAILY',
+        'SUMMARY:Daily', 'END:VEVENT',
+        'BEGIN:VEVENT', 'UID:daily', 'RECURRENCE-ID:20240102T080000Z', 'DTSTART:20240102T080000Z',
+        'DTEND:20240102T090000Z', 'DESCRIPTION:!cold!', 'SUMMARY:Daily', 'END:VEVENT',
+        'END:VCALENDAR', '']))
+    indicator = HeatNeededIndicator(60, 0, '!cold!')
+
+    for parser in ['vobject', 'fast']:
+        store = load_ics([str(ics)], indicator, START, END, parser)
+        assert sorted(store.summaries) == ['Daily'] * 7 + ['Weekly']
+        assert len(store.indices(store.mask('!cold!'))) == 7
+        [result] = simulate(store, store.mask('!cold!'), [60], [0], START, END)
+        assert result.heating_seconds == 7 * 2 * 3600
+        assert result.uncovered_seconds == 0
+
+def test_unknown_room(monkeypatch, capsys):
+    monkeypatch.setenv('rooms', '{"Hall": {"calendar_id": "hall", "preheat_minutes": 60, "cooloff_minutes": 0}}')
+    monkeypatch.setattr('sys.argv', ['simulate.py', '--room', 'Hal'])
+    with pytest.raises(SystemExit) as exit:
+        main()
+    assert exit.value.code == 2
+    assert 'unknown room Hal, configured: Hall' in capsys.readouterr().err
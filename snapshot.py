@@ -0,0 +1,130 @@
+import contextlib
+import datetime
+import sqlite3
+from dataclasses import dataclass
+from typing import Iterator
+
+from logic import EventStore, HeatNeededIndicator, HeatingTimeline
+
+# no_heat_tag is '' for none
+SCHEMA_VERSION = 1
+SCHEMA = '''
+DROP TABLE IF EXISTS snapshots;
+DROP TABLE IF EXISTS events;
+CREATE TABLE snapshots (
+    calendar TEXT NOT NULL,
+    no_heat_tag TEXT NOT NULL,
+    url TEXT,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (calendar, no_heat_tag)
+);
+CREATE TABLE events (
+    calendar TEXT NOT NULL,
+    no_heat_tag TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    summary TEXT NOT NULL,
+    description TEXT
+);
+CREATE INDEX events_calendar ON events (calendar, no_heat_tag, start);
+PRAGMA user_version = %i;
+''' % SCHEMA_VERSION
+
+@dataclass
+class Snapshot:
+    """The events of a calendar overlapping `start`...`end`, as fetched at `fetched_at`."""
+    store: EventStore
+    start: datetime.datetime
+    end: datetime.datetime
+    fetched_at: datetime.datetime
+    url: str | None = None
+
+    def age(self, now: datetime.datetime) -> datetime.timedelta:
+        return now - self.fetched_at
+
+    def covers(self, now: datetime.datetime, preheat_minutes: int) -> bool:
+        # Whether it holds all events deciding heating at `now`
+        return self.start <= now and now + datetime.timedelta(minutes=preheat_minutes) <= self.end
+
+    def timeline(self, indicator: HeatNeededIndicator, now: datetime.datetime) -> HeatingTimeline:
+        # Heating from now on, as far as no event after the end of the snapshot could change it
+        return HeatingTimeline(indicator.heating_intervals(self.store), now,
+                               self.end - datetime.timedelta(minutes=indicator.preheat_minutes))
+
+class EventSnapshot:
+    """
+    SQLite file with the events last fetched from each calendar, shared by
+    caldav-trigger.py and api_server.py, so that heating can be decided
+    without the CalDAV server: right at startup and while it is unavailable.
+    Events are stored without preheat/cooloff applied, such that any room or
+    request can evaluate them with its own margins. They are kept per calendar
+    and no_heat_tag, as the events tagged with it may have been filtered out by
+    the server (see caldav_filters). Snapshots older than `max_age` are not
+    used; `horizon` is how far ahead events are saved.
+    """
+
+    def __init__(self, path: str, max_age: datetime.timedelta = datetime.timedelta(days=1),
+                 horizon: datetime.timedelta = datetime.timedelta(days=1)) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.horizon = horizon
+        with self.connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                # a snapshot of an earlier layout is dropped, the next fetch saves it again
+                db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        # One connection per use: connections cannot be shared between threads
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def save(self, calendar_id: str, no_heat_tag: str | None, snapshot: Snapshot) -> None:
+        # The events of the calendar as searched for a room or request with `no_heat_tag`
+        store = snapshot.store
+        key = (calendar_id, no_heat_tag or '')
+        with self.connect() as db:
+            db.execute('DELETE FROM events WHERE calendar = ? AND no_heat_tag = ?', key)
+            db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)',
+                           ((*key, event_start, event_end, summary, description) for
+                            (event_start, event_end, summary, description) in
+                            zip(store.start, store.end, store.summaries, store.descriptions)))
+            # the URL is kept when saved by an entry point that does not know it
+            db.execute('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (calendar, no_heat_tag) DO UPDATE '
+                       'SET url = COALESCE(excluded.url, url), start = excluded.start, end = excluded.end, '
+                       'fetched_at = excluded.fetched_at',
+                       (*key, snapshot.url, snapshot.start.timestamp(), snapshot.end.timestamp(),
+                        snapshot.fetched_at.timestamp()))
+
+    def load(self, calendar_id: str, no_heat_tag: str | None) -> Snapshot | None:
+        # The last snapshot of the calendar for `no_heat_tag`, its events tagged with it (see EventStore)
+        key = (calendar_id, no_heat_tag or '')
+        with self.connect() as db:
+            row = db.execute('SELECT url, start, end, fetched_at FROM snapshots WHERE calendar = ? AND no_heat_tag = ?',
+                             key).fetchone()
+            if row is None:
+                return None
+            store = EventStore([] if no_heat_tag is None else [no_heat_tag])
+            for (event_start, event_end, summary, description) in db.execute(
+                    'SELECT start, end, summary, description FROM events WHERE calendar = ? AND no_heat_tag = ? '
+                    'ORDER BY start', key):
+                store.append(summary, description, event_start, event_end)
+        (url, start, end, fetched_at) = row
+        return Snapshot(store, datetime.datetime.fromtimestamp(start).astimezone(),
+                        datetime.datetime.fromtimestamp(end).astimezone(),
+                        datetime.datetime.fromtimestamp(fetched_at).astimezone(), url)
+
+    def load_fresh(self, calendar_id: str, no_heat_tag: str | None, now: datetime.datetime,
+                   preheat_minutes: int = 0) -> Snapshot | None:
+        # The last snapshot, if not older than max_age and covering `now`
+        snapshot = self.load(calendar_id, no_heat_tag)
+        if snapshot is None or snapshot.age(now) > self.max_age or not snapshot.covers(now, preheat_minutes):
+            return None
+        return snapshot
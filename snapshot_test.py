@@ -0,0 +1,63 @@
+import datetime
+
+from logic import EventStore, HeatNeededIndicator, HeatingTimeline
+from snapshot import EventSnapshot, Snapshot
+
+NOW = datetime.datetime(2024, 1, 1, 12, tzinfo=datetime.timezone.utc)
+
+def make_snapshot(url: str | None = None) -> Snapshot:
+    store = EventStore(['!cold!'])
+    for (hour, description) in [(-1, None), (2, 'Event !cold!'), (5, None), (30, None)]:
+        start = NOW.timestamp() + hour * 3600
+        store.append('Event at %i' % hour, description, start, start + 3600)
+    return Snapshot(store, NOW, NOW + datetime.timedelta(days=1), NOW, url)
+
+def test_save_and_load(tmp_path):
+    snapshot = EventSnapshot(str(tmp_path / 'snapshot.sqlite'))
+    assert snapshot.load('room', '!cold!') is None
+    snapshot.save('room', '!cold!', make_snapshot('https://caldav.example.com/room/'))
+    # the URL is kept when saved without one
+    snapshot.save('room', '!cold!', make_snapshot())
+
+    # shared with other processes through the file
+    saved = EventSnapshot(snapshot.path).load('room', '!cold!')
+    assert saved.url == 'https://caldav.example.com/room/'
+    assert (saved.start, saved.end, saved.fetched_at) == (NOW, NOW + datetime.timedelta(days=1), NOW)
+    assert saved.store.summaries == ['Event at -1', 'Event at 2', 'Event at 5', 'Event at 30']
+    assert saved.store.indices(saved.store.mask('!cold!')) == [0, 2, 3]
+    assert snapshot.load('other room', '!cold!') is None
+
+def test_load_fresh(tmp_path):
+    snapshot = EventSnapshot(str(tmp_path / 'snapshot.sqlite'), max_age=datetime.timedelta(hours=6))
+    snapshot.save('room', '!cold!', make_snapshot())
+    assert snapshot.load_fresh('room', '!cold!', NOW + datetime.timedelta(hours=6)) is not None
+    assert snapshot.load_fresh('room', '!cold!', NOW + datetime.timedelta(hours=7)) is None
+    # events starting after the end of the snapshot are unknown
+    assert snapshot.load_fresh('room', '!cold!', NOW + datetime.timedelta(hours=5), preheat_minutes=20 * 60) is None
+    assert snapshot.load_fresh('room', '!cold!', NOW - datetime.timedelta(hours=1)) is None
+
+def test_timeline_as_fetched(tmp_path):
+    snapshot = EventSnapshot(str(tmp_path / 'snapshot.sqlite'))
+    snapshot.save('room', '!cold!', make_snapshot())
+    indicator = HeatNeededIndicator(preheat_minutes=60, cooloff_minutes=15, no_heat_tag='!cold!')
+    now = NOW + datetime.timedelta(hours=3)
+    timeline = snapshot.load('room', indicator.no_heat_tag).timeline(indicator, now)
+
+    store = make_snapshot().store
+    expected = HeatingTimeline(indicator.heating_intervals(store), now, NOW + datetime.timedelta(hours=23))
+    assert list(timeline.heat_on) == list(expected.heat_on) and list(timeline.heat_off) == list(expected.heat_off)
+    assert timeline.next_transition(now) == NOW + datetime.timedelta(hours=4)
+    # the event at 30 hours may be preceded by events not in the snapshot
+    assert timeline.next_transition(NOW + datetime.timedelta(hours=6)) is None
+
+def test_kept_per_no_heat_tag(tmp_path):
+    # events tagged with no_heat_tag may be missing, as filtered by the server
+    snapshot = EventSnapshot(str(tmp_path / 'snapshot.sqlite'))
+    snapshot.save('room', '!cold!', make_snapshot())
+    assert snapshot.load('room', None) is None
+    assert snapshot.load('room', '!warm!') is None
+    unfiltered = make_snapshot()
+    unfiltered.store.append('Event at 3', None, NOW.timestamp() + 3 * 3600, NOW.timestamp() + 4 * 3600)
+    snapshot.save('room', None, unfiltered)
+    assert len(snapshot.load('room', None).store) == 5
+    assert len(snapshot.load('room', '!cold!').store) == 4
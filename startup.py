@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Start-up of caldav-trigger.py up to its first CalDAV request in milliseconds: run from cron every few
+# minutes, it should not take longer to start than to check. About 270 ms when no room is switched, such
+# that no action is loaded; 330 ms when caldav was imported along with the script, 430 ms with
+# tuya-qr-sharing.py loaded at start as well.
+TARGET_MS = 300
+
+# Imports an entry point like `python <script>` would, without running its main(), then the modules given
+# after it: those the script imports on its way to its first request
+LOADER = ("import importlib.util, sys; "
+          "spec = importlib.util.spec_from_file_location('startup_profile', sys.argv[1]); "
+          "spec.loader.exec_module(importlib.util.module_from_spec(spec)); "
+          "[importlib.import_module(name) for name in sys.argv[2:]]")
+
+def import_times(report: str) -> list[tuple[str, int, int]]:
+    # (module, self microseconds, cumulative microseconds) of the modules imported directly by the script,
+    # from the output of python -X importtime
+    times = []
+    for line in report.splitlines():
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        (self_us, cumulative_us, name) = line[len('import time:'):].split('|')
+        # nested imports are indented by two more spaces
+        if len(name) - len(name.lstrip()) == 1:
+            times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+def start(path: str, imports: tuple[str, ...] = (), importtime: bool = False) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *(['-X', 'importtime'] if importtime else []), '-c', LOADER, path,
+                           *imports],
+                          cwd=os.path.dirname(os.path.abspath(path)), stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True)
+
+def profile(path: str, target_ms: float, imports: tuple[str, ...] = (), runs: int = 5, top: int = 12) -> int:
+    # Prints the slowest imports of the script and its start-up time (the fastest of `runs` fresh
+    # interpreters) including `imports`, returns 1 if above `target_ms`
+    result = start(path, imports, importtime=True)
+    if result.returncode != 0:
+        errors = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+        print("Cannot import %s:\n%s" % (path, '\n'.join(errors)), file=sys.stderr)
+        return 1
+    times = import_times(result.stderr)
+    print("Slowest imports of %s (ms):" % os.path.basename(path))
+    print("%10s %10s  %s" % ('self', 'cumulative', 'module'))
+    for (name, self_us, cumulative_us) in sorted(times, key=lambda entry: entry[2], reverse=True)[:top]:
+        print("%10.1f %10.1f  %s" % (self_us / 1000, cumulative_us / 1000, name))
+    print("%10s %10.1f  all %i imports" % ('', sum(entry[2] for entry in times) / 1000, len(times)))
+
+    elapsed = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        start(path, imports)
+        elapsed.append(time.perf_counter() - started)
+    startup_ms = min(elapsed) * 1000
+    print("Start-up%s: %.0f ms (target: %.0f ms)" % (" with %s" % ', '.join(imports) if imports else '',
+                                                   startup_ms, target_ms))
+    return 0 if startup_ms <= target_ms else 1
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Report the start-up time of entry points by import.')
+    parser.add_argument('scripts', nargs='+', help='scripts to import, e.g. caldav-trigger.py')
+    parser.add_argument('--target-ms', type=float, default=TARGET_MS,
+                        help='fail if a script takes longer to start (default: %(default)s)')
+    parser.add_argument('--imports', nargs='*', default=[],
+                        help='modules imported by the scripts before their first request, e.g. caldav')
+    args = parser.parse_args()
+    return max(profile(script, args.target_ms, tuple(args.imports)) for script in args.scripts)
+
+if __name__ == '__main__':
+    sys.exit(main())
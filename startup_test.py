@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+from startup import LOADER, import_times
+
+def test_import_times_of_direct_imports():
+    report = ('import time: self [us] | cumulative | imported package\n'
+              'import time:        66 |         66 |     _codecs\n'
+              'import time:       426 |        492 |   codecs\n'
+              'import time:       891 |       2025 | encodings\n'
+              'import time:       271 |       4144 | dotenv\n')
+    assert import_times(report) == [('encodings', 891, 2025), ('dotenv', 271, 4144)]
+
+def test_trigger_starts_without_caldav():
+    # caldav and vobject are only imported to access the server
+    result = subprocess.run([sys.executable, '-c', LOADER + '; print(*sorted(sys.modules))', 'caldav-trigger.py'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True,
+                            check=True)
+    modules = result.stdout.split()
+    assert 'logic' in modules
+    assert not {'caldav', 'vobject', 'requests'} & set(modules)
+
+def test_trigger_imports_caldav_to_connect():
+    # --profile-startup measures up to the first CalDAV request
+    result = subprocess.run([sys.executable, '-c', LOADER + '; print(*sorted(sys.modules))', 'caldav-trigger.py',
+                             'caldav', 'requests'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True,
+                            check=True)
+    assert {'caldav', 'vobject', 'requests'} <= set(result.stdout.split())
+
+def test_webhook_server_starts_without_tuya():
+    # the Tuya client is only imported to activate a scene
+    result = subprocess.run([sys.executable, '-c', LOADER + '; print(*sorted(sys.modules))', 'webhook-server.py'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True,
+                            check=True)
+    modules = result.stdout.split()
+    assert 'fastapi' in modules
+    assert not {'tuya-qr-sharing', 'tuya_sharing'} & set(modules)
@@ -0,0 +1,75 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+class StateStore:
+    """
+    Small JSON document of named records in a file, shared between threads and
+    processes: updates are done under a lock file and written atomically. The
+    records are kept in memory and only parsed again once the file was replaced
+    or modified, so reading them costs a stat call.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        # (inode, mtime, size) of the file and its records
+        self.loaded = (None, {})
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        with self.lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self) -> dict[str, Any]:
+        # The records as last written, not to be modified by the caller
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return {}
+        signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        (loaded_signature, records) = self.loaded
+        if signature != loaded_signature:
+            try:
+                with open(self.path) as file:
+                    records = json.load(file)
+            except (OSError, ValueError):
+                return {}
+            self.loaded = (signature, records)
+        return records
+
+    def write(self, records: dict[str, Any]) -> None:
+        (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                           prefix=os.path.basename(self.path) + '.')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(records, file, indent=2)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        stat = os.stat(self.path)
+        self.loaded = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), records)
+
+    def get(self, key: str) -> Any:
+        return self.read().get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        with self.locked():
+            records = dict(self.read())
+            records[key] = value
+            self.write(records)
+
+    def delete(self, key: str) -> None:
+        with self.locked():
+            records = dict(self.read())
+            if records.pop(key, None) is not None:
+                self.write(records)
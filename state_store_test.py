@@ -0,0 +1,33 @@
+import threading
+
+from state_store import StateStore
+
+def test_set_and_get(tmp_path):
+    path = str(tmp_path / 'state.json')
+    store = StateStore(path)
+    assert store.get('room') is None
+    store.set('room', { 'heating': True })
+    assert StateStore(path).get('room') == { 'heating': True }
+
+def test_concurrent_updates_are_kept(tmp_path):
+    path = str(tmp_path / 'state.json')
+    stores = [StateStore(path) for _ in range(4)]
+    threads = [threading.Thread(target=lambda store=store, i=i: [store.set('room%i-%i' % (i, j), j) for j in range(10)])
+               for (i, store) in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(StateStore(path).read()) == 40
+
+def test_changes_by_other_processes_are_read(tmp_path):
+    path = str(tmp_path / 'state.json')
+    (reader, writer) = (StateStore(path), StateStore(path))
+    writer.set('token', 'first')
+    assert reader.get('token') == 'first'
+    # unchanged file: records are not parsed again
+    assert reader.read() is reader.read()
+    writer.set('token', 'second')
+    assert reader.get('token') == 'second'
+    writer.delete('token')
+    assert reader.get('token') is None
@@ -0,0 +1,128 @@
+import asyncio
+import datetime
+import json
+import logging
+
+from api_cache import EventWindow, EventWindowCache
+from logic import HeatingTimeline
+
+logger = logging.getLogger('uvicorn.error')
+
+class Subscription(asyncio.Queue):
+    """Server-sent events for one subscriber of `key`, holding only the latest one."""
+
+    def __init__(self, key: tuple[int, int]) -> None:
+        super().__init__(maxsize=1)
+        self.key = key
+
+class Evaluation:
+    """Heating for one preheat/cooloff pair, as last sent to its subscribers."""
+
+    def __init__(self, preheat_minutes: int, cooloff_minutes: int) -> None:
+        self.preheat_minutes = preheat_minutes
+        self.cooloff_minutes = cooloff_minutes
+        self.subscribers = set()
+        # the timeline is computed once per window
+        self.window = None
+        self.timeline = None
+        self.message = None
+
+    def update(self, window: EventWindow, no_heat_tag: str | None, now: datetime.datetime) -> bytes:
+        # The server-sent event for `now`, with the heating state, the next transition and the events
+        # needing heating as in /next-events
+        store = window.store
+        (preheat_seconds, cooloff_seconds) = (self.preheat_minutes * 60, self.cooloff_minutes * 60)
+        exclude = store.mask(no_heat_tag)
+        if window is not self.window:
+            self.window = window
+            self.timeline = HeatingTimeline(store.intervals(preheat_seconds, cooloff_seconds, exclude), window.start,
+                                            window.end - datetime.timedelta(minutes=self.preheat_minutes))
+        next_transition = self.timeline.next_transition(now)
+        indices = store.needed_at(now.timestamp(), preheat_seconds, cooloff_seconds, exclude)
+        return (b'event: state\ndata: {"heating":%s,"next_transition":%s,"events":%s}\n\n' % (
+            b'true' if self.timeline.is_needed(now) else b'false',
+            json.dumps(None if next_transition is None else next_transition.isoformat()).encode('utf-8'),
+            window.to_json(indices)))
+
+class TransitionHub:
+    """
+    Pushes the heating state of each preheat/cooloff pair to its subscribers
+    as server-sent events, whenever heating switches or the events needing
+    heating change. One task evaluates the window of `cache` for all pairs
+    and only wakes up at the next transition of any of them, every
+    `recheck_seconds` to pick up refreshed windows, or on wake(); subscribers
+    just wait on their queue. A subscriber reading slowly skips to the latest
+    state. Each pass gets the window once for all pairs, fetching it if the
+    cache is disabled.
+    """
+
+    def __init__(self, cache: EventWindowCache, no_heat_tag: str | None, recheck_seconds: float) -> None:
+        self.cache = cache
+        self.no_heat_tag = no_heat_tag
+        self.recheck_seconds = recheck_seconds
+        self.evaluations = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def subscribe(self, preheat_minutes: int, cooloff_minutes: int) -> Subscription:
+        key = (preheat_minutes, cooloff_minutes)
+        evaluation = self.evaluations.get(key)
+        if evaluation is None:
+            evaluation = self.evaluations[key] = Evaluation(preheat_minutes, cooloff_minutes)
+            self.wake()
+        subscription = Subscription(key)
+        if evaluation.message is not None:
+            subscription.put_nowait(evaluation.message)
+        evaluation.subscribers.add(subscription)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        evaluation = self.evaluations.get(subscription.key)
+        if evaluation is not None:
+            evaluation.subscribers.discard(subscription)
+            if not evaluation.subscribers:
+                del self.evaluations[subscription.key]
+                if not self.evaluations:
+                    # lets the task end
+                    self.wake()
+
+    def wake(self) -> None:
+        # Evaluate right away, e.g. after the cache was invalidated
+        self.wakeup.set()
+
+    async def run(self) -> None:
+        while self.evaluations:
+            self.wakeup.clear()
+            now = datetime.datetime.now().astimezone()
+            wake_up = now + datetime.timedelta(seconds=self.recheck_seconds)
+            try:
+                # one window for all pairs, also if the cache does not keep it (ttl_seconds=0)
+                window = await self.cache.get(now, 0)
+            except Exception as e:
+                # the last states stay, until the next check
+                logger.warning("Evaluating transitions failed: %s", e)
+                window = None
+            for evaluation in list(self.evaluations.values()):
+                if window is None or not window.covers(now, evaluation.preheat_minutes):
+                    continue
+                message = evaluation.update(window, self.no_heat_tag, now)
+                if message != evaluation.message:
+                    evaluation.message = message
+                    self.publish(evaluation)
+                next_transition = evaluation.timeline.next_transition(now)
+                if next_transition is not None and next_transition < wake_up:
+                    wake_up = next_transition
+            try:
+                await asyncio.wait_for(self.wakeup.wait(),
+                                       max(0, (wake_up - datetime.datetime.now().astimezone()).total_seconds()))
+            except asyncio.TimeoutError:
+                pass
+
+    def publish(self, evaluation: Evaluation) -> None:
+        for subscription in evaluation.subscribers:
+            if subscription.full():
+                # not read yet: replaced by the current state
+                subscription.get_nowait()
+            subscription.put_nowait(evaluation.message)
@@ -0,0 +1,72 @@
+import asyncio
+import datetime
+import json
+
+from api_cache import EventWindowCache
+from logic import EventStore
+from transitions import TransitionHub
+
+def parse(message: bytes) -> dict:
+    (event, data) = message.decode('utf-8').strip().split('\n')
+    assert event == 'event: state'
+    return json.loads(data.removeprefix('data: '))
+
+def test_transitions_pushed_to_subscribers():
+    fetches = []
+
+    async def fetch(start: datetime.datetime, end: datetime.datetime) -> EventStore:
+        fetches.append((start, end))
+        now = datetime.datetime.now().timestamp()
+        store = EventStore()
+        store.append('Soon', None, now + 0.3, now + 0.6)
+        store.append('Later', None, now + 3600, now + 7200)
+        return store
+
+    async def run():
+        cache = EventWindowCache(fetch, ttl_seconds=60, horizon_minutes=24 * 60)
+        hub = TransitionHub(cache, None, recheck_seconds=60)
+        subscriptions = [hub.subscribe(0, 0) for _ in range(3)]
+        other = hub.subscribe(5, 0)
+        assert len(hub.evaluations) == 2
+
+        states = [parse(await asyncio.wait_for(subscriptions[0].get(), 1)) for _ in range(3)]
+        assert [state['heating'] for state in states] == [False, True, False]
+        assert [event['summary'] for event in states[1]['events']] == ['Soon']
+        assert states[2]['next_transition'] is not None and states[2]['events'] == []
+        # the others were sent the same states, only the latest one kept if not read
+        assert parse(subscriptions[1].get_nowait()) == states[2]
+        assert parse(other.get_nowait())['heating'] is False
+        assert len(fetches) == 1
+
+        for subscription in subscriptions + [other]:
+            hub.unsubscribe(subscription)
+        assert hub.evaluations == {}
+        await asyncio.wait_for(hub.task, 1)
+
+    asyncio.run(run())
+
+def test_one_fetch_per_pass_without_cache():
+    fetches = []
+
+    async def fetch(start: datetime.datetime, end: datetime.datetime) -> EventStore:
+        fetches.append((start, end))
+        return EventStore()
+
+    async def run():
+        # with ttl_seconds=0 each get fetches: the pairs share the window of a pass
+        cache = EventWindowCache(fetch, ttl_seconds=0, horizon_minutes=24 * 60)
+        hub = TransitionHub(cache, None, recheck_seconds=60)
+        subscriptions = [hub.subscribe(preheat_minutes, 0) for preheat_minutes in [0, 30, 60, 90]]
+        for subscription in subscriptions:
+            assert parse(await asyncio.wait_for(subscription.get(), 1))['heating'] is False
+        assert len(fetches) == 1
+
+        hub.wake()
+        await asyncio.sleep(0.05)
+        assert len(fetches) == 2
+
+        for subscription in subscriptions:
+            hub.unsubscribe(subscription)
+        await asyncio.wait_for(hub.task, 1)
+
+    asyncio.run(run())
@@ -9,10 +9,15 @@ import os
 from time import sleep
 import dotenv
 import sys
-from typing import Any
-import pyqrcode
+import textwrap
+import threading
+import time
+from typing import Any, Callable, Mapping
 from tuya_sharing import CustomerDevice, LoginControl, Manager, SharingDeviceListener, SharingTokenListener, logger
 
+from actions import Action
+from state_store import StateStore
+
 EXIT_OK                    = 0
 EXIT_SYNTAX_ERROR          = 1
 EXIT_AUTHENTICATION_FAILED = 2
@@ -64,34 +69,65 @@ class DeviceListener(SharingDeviceListener):
         pass
 
 class TuyaQrSharing:
-    def __init__(self, dotenv_file: str) -> None:
+    def __init__(self, dotenv_file: str, env: Mapping[str, str] | None = None) -> None:
         self.dotenv_file = dotenv_file
-        self.user_code = os.environ.get('tuya_qr_sharing_user_code')
-        self.username = os.environ.get('tuya_qr_sharing_username')
-        self.terminal_id = os.environ.get('tuya_qr_sharing_terminal_id')
-        self.endpoint = os.environ.get('tuya_qr_sharing_endpoint')
-
-        self.home_id = os.environ.get('tuya_qr_sharing_home')
-
-        try:
-            self.token_info = json.loads(os.environ.get('tuya_qr_sharing_token_info'))
-        except TypeError:
-            self.token_info = None
+        self.env = os.environ if env is None else env
+        self.user_code = self.env.get('tuya_qr_sharing_user_code')
+        self.username = self.env.get('tuya_qr_sharing_username')
+        self.terminal_id = self.env.get('tuya_qr_sharing_terminal_id')
+        self.endpoint = self.env.get('tuya_qr_sharing_endpoint')
+
+        self.home_id = self.env.get('tuya_qr_sharing_home')
+
+        # The token is refreshed regularly, so it is kept apart from .env, shared by all
+        # processes using this account.
+        self.tokens = StateStore(self.data_file('tuya_qr_sharing_token_file', '.tuya-qr-sharing-token.json'))
+        self.token_info = self.tokens.get('token_info')
+        if self.token_info is None and (legacy_token_info := self.env.get('tuya_qr_sharing_token_info')):
+            # logged in before the token file existed
+            self.token_info = json.loads(legacy_token_info)
+            self.set_token_info(self.token_info)
+            dotenv.unset_key(self.dotenv_file, 'tuya_qr_sharing_token_info')
+
+        # homes and scenes listed before, such that listing them does not query Tuya each time
+        self.cache = StateStore(self.data_file('tuya_qr_sharing_cache_file', '.tuya-qr-sharing-cache.json'))
+        self.cache_ttl_seconds = float(self.env.get('tuya_qr_sharing_cache_ttl_seconds', 86400))
+
+    def data_file(self, variable: str, default: str) -> str:
+        # relative to the .env file
+        path = self.env.get(variable, default)
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(self.dotenv_file or '.env')), path)
+        return path
 
     def set_token_info(self, token_info: dict[str, Any]) -> None:
         self.token_info = token_info
-        dotenv.set_key(self.dotenv_file, 'tuya_qr_sharing_token_info', json.dumps(token_info))
+        self.tokens.set('token_info', token_info)
 
     def reload_token_info(self) -> None:
-        dotenv_values = dotenv.dotenv_values(self.dotenv_file)
-        new_token_info = json.loads(dotenv_values['tuya_qr_sharing_token_info'])
-        if new_token_info != self.token_info:
+        # cheap unless the token file changed, e.g. the token was refreshed by another process
+        new_token_info = self.tokens.get('token_info')
+        if new_token_info is not None and new_token_info != self.token_info:
             print('Token info changed, reconnecting...')
             self.token_info = new_token_info
             self.connect()
 
+    def cached(self, key: str, fetch: Callable[[], list[dict[str, Any]]]) -> list[dict[str, Any]]:
+        entry = self.cache.get(key)
+        if entry is not None and time.time() - entry['fetched_at'] < self.cache_ttl_seconds:
+            return entry['items']
+        items = fetch()
+        if items:
+            self.cache.set(key, { 'fetched_at': time.time(), 'items': items })
+        return items
+
+    def clear_cache(self) -> None:
+        with self.cache.locked():
+            self.cache.write({})
+
     def logout(self):
-        dotenv.unset_key(self.dotenv_file, 'tuya_qr_sharing_token_info')
+        self.clear_cache()
+        self.tokens.delete('token_info')
         dotenv.unset_key(self.dotenv_file, 'tuya_qr_sharing_username')
         dotenv.unset_key(self.dotenv_file, 'tuya_qr_sharing_terminal_id')
         dotenv.unset_key(self.dotenv_file, 'tuya_qr_sharing_endpoint')
@@ -115,6 +151,8 @@ class TuyaQrSharing:
             return EXIT_AUTHENTICATION_FAILED
 
         qr_code = response["result"]["qrcode"]
+        # only needed to log in, not to switch
+        import pyqrcode
 
         while True:
             print ('Please scan this in Smart-Life and authorize access:')
@@ -139,15 +177,18 @@ class TuyaQrSharing:
             terminal_id = info.get('terminal_id')
             endpoint = info.get('endpoint')
             dotenv.set_key(self.dotenv_file, 'tuya_qr_sharing_username', username)
-            dotenv.set_key(self.dotenv_file, 'tuya_qr_sharing_token_info', json.dumps(self.token_info))
+            self.set_token_info(self.token_info)
             dotenv.set_key(self.dotenv_file, 'tuya_qr_sharing_terminal_id', terminal_id)
             dotenv.set_key(self.dotenv_file, 'tuya_qr_sharing_endpoint', endpoint)
+            self.clear_cache()
             break
 
         print('You are logged in.')
         return EXIT_OK
 
     def connect(self):
+        # Only sets up the API client: the access token is checked, and refreshed if needed, with
+        # the first request. Homes and devices are fetched by the commands needing them.
         if not self.token_info:
             print('Please log in first!', file = sys.stderr);
             return EXIT_AUTHENTICATION_FAILED
@@ -162,6 +203,9 @@ class TuyaQrSharing:
             self.token_listener
         )
 
+        return EXIT_OK
+
+    def load_devices(self):
         try:
             self.tuya_sharing_manager.update_device_cache()
         except Exception as e:
@@ -172,21 +216,45 @@ class TuyaQrSharing:
 
         return EXIT_OK
 
+    def get_homes(self) -> list[dict[str, Any]]:
+        return self.cached('homes', lambda: [
+            { 'id': home.id, 'name': home.name }
+            for home in sorted(self.tuya_sharing_manager.home_repository.query_homes(),
+                               key = operator.attrgetter('name')) ])
+
+    def get_scenes(self, home_id: str) -> list[dict[str, Any]]:
+        return self.cached('scenes/%s' % home_id, lambda: [
+            { 'scene_id': scene.scene_id, 'name': scene.name }
+            for scene in sorted(self.tuya_sharing_manager.scene_repository.query_scenes([home_id]),
+                                key = operator.attrgetter('name')) ])
+
     def homes(self):
+        try:
+            homes = self.get_homes()
+        except Exception as e:
+            print('Cannot access Tuya/Smartlife (%s)' % (e.args), file=sys.stderr)
+            return EXIT_AUTHENTICATION_FAILED
+
         print('Homes:')
-        for home in self.tuya_sharing_manager.user_homes:
-            print('%10s: %s' % (home.id, home.name))
+        for home in homes:
+            print('%10s: %s' % (home['id'], home['name']))
         return EXIT_OK
 
     def scenes(self):
-        for home in self.tuya_sharing_manager.user_homes:
-            print('Scenes in home %s (%s):' % (home.name, home.id));
-            for scene in sorted(self.tuya_sharing_manager.scene_repository.query_scenes([home.id]),
-                   key = operator.attrgetter('name')):
-                print('    %s: %s' % (scene.scene_id, scene.name));
+        try:
+            for home in self.get_homes():
+                print('Scenes in home %s (%s):' % (home['name'], home['id']));
+                for scene in self.get_scenes(home['id']):
+                    print('    %s: %s' % (scene['scene_id'], scene['name']));
+        except Exception as e:
+            print('Cannot access Tuya/Smartlife (%s)' % (e.args), file=sys.stderr)
+            return EXIT_AUTHENTICATION_FAILED
         return EXIT_OK
 
     def devices(self):
+        if (result := self.load_devices()) != EXIT_OK:
+            return result
+
         print('Devices:')
         for device in self.tuya_sharing_manager.device_map.values():
             print (f'  {device.id}: {device.name} ({device.product_name})')
@@ -233,6 +301,9 @@ class TuyaQrSharing:
         return EXIT_OK
 
     def monitor(self):
+        if (result := self.load_devices()) != EXIT_OK:
+            return result
+
         for device in self.tuya_sharing_manager.device_map.values():
             device.set_up = True
             # device.support_local = False
@@ -259,7 +330,7 @@ class TuyaQrSharing:
             print('Set tuya_qr_sharing_home in .env first, in order to trigger scenes!', file=sys.stderr)
             return EXIT_HOME_MISSING
 
-        if not (scene_id := os.environ.get(variable)):
+        if not (scene_id := self.env.get(variable)):
             print(f'Set {variable} in .env first!', file=sys.stderr)
             return EXIT_SCENE_MISSING
 
@@ -271,6 +342,51 @@ class TuyaQrSharing:
     def off(self):
         return self.activate_from_env('tuya_qr_sharing_scene_off')
 
+class TuyaQrSharingAction(Action):
+    # rooms sharing one login share one client, such that a refreshed token is used by all of them
+    clients: dict[tuple[str, str | None], TuyaQrSharing] = {}
+    clients_lock = threading.Lock()
+
+    def __init__(self, env: Mapping[str, str]) -> None:
+        self.env = env
+        self.dotenv_file = dotenv.find_dotenv(usecwd=True) or dotenv.find_dotenv()
+
+    def get_client(self) -> TuyaQrSharing | int:
+        key = (self.dotenv_file, self.env.get('tuya_qr_sharing_user_code'))
+        with self.clients_lock:
+            if (client := self.clients.get(key)) is None:
+                client = TuyaQrSharing(self.dotenv_file, self.env)
+                if (result := client.connect()) != EXIT_OK:
+                    return result
+                self.clients[key] = client
+        return client
+
+    def set_state(self, on: bool) -> int:
+        # connects once, tokens are refreshed by the Manager
+        if isinstance(client := self.get_client(), int):
+            return client
+
+        # scenes are configured per room
+        home_id = self.env.get('tuya_qr_sharing_home')
+        if not home_id:
+            print('Set tuya_qr_sharing_home in .env first, in order to trigger scenes!', file=sys.stderr)
+            return EXIT_HOME_MISSING
+
+        variable = 'tuya_qr_sharing_scene_on' if on else 'tuya_qr_sharing_scene_off'
+        if not (scene_id := self.env.get(variable)):
+            print(f'Set {variable} in .env first!', file=sys.stderr)
+            return EXIT_SCENE_MISSING
+
+        if (result := client.activate(home_id, scene_id)) != EXIT_OK:
+            # connect again with the next switch
+            with self.clients_lock:
+                for key in [ key for key, value in self.clients.items() if value is client ]:
+                    del self.clients[key]
+        return result
+
+def create_action(env: Mapping[str, str], wrapper: textwrap.TextWrapper) -> Action:
+    return TuyaQrSharingAction(env)
+
 def main() -> int:
 
     logger.setLevel(LOGGER.getEffectiveLevel())
@@ -285,7 +401,7 @@ def main() -> int:
 
     cmds = [ 'login', 'logout', 'homes', 'scenes', 'on', 'off', 'monitor', 'activate', 'devices', 'query' ]
     if not cmd in cmds:
-        print('Syntax: tuya-qr-sharing.py (%s)' % '|'.join(cmds), file=sys.stderr)
+        print('Syntax: tuya-qr-sharing.py (%s) [--refresh]' % '|'.join(cmds), file=sys.stderr)
         return EXIT_SYNTAX_ERROR;
 
     client = TuyaQrSharing(dotenv_file)
@@ -299,6 +415,9 @@ def main() -> int:
     if (result := client.connect()) != EXIT_OK:
         return result
 
+    if '--refresh' in sys.argv[2:]:
+        client.clear_cache()
+
     if cmd == 'homes':
         return client.homes()
 
@@ -3,17 +3,21 @@
 
 
 from functools import cache
+import asyncio
+import concurrent.futures
 import json
 import logging
 import os
-from typing import Annotated
+from typing import Annotated, Any
 from fastapi import Depends, FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
 import uvicorn
 import dotenv
 import importlib
 import datetime
 
-tuya_qr_sharing = importlib.import_module("tuya-qr-sharing")
+from metrics import TUYA_ACTIVATE_SECONDS, TUYA_CONNECT_SECONDS, TUYA_RECONNECTS, metrics_response
 
 app = FastAPI()
 logger = logging.getLogger('uvicorn.error')
@@ -21,6 +25,12 @@ logger = logging.getLogger('uvicorn.error')
 dotenv_file = dotenv.find_dotenv(usecwd=True) or dotenv.find_dotenv()
 dotenv.load_dotenv(dotenv_file)
 
+# Triggering a scene is a blocking Tuya request: run it in a bounded pool of threads, such that
+# a slow response only delays its own request
+activation_pool = concurrent.futures.ThreadPoolExecutor(
+  max_workers=int(os.getenv("webhook_server_workers", "4")), thread_name_prefix="activate")
+activation_timeout = float(os.getenv("webhook_server_activation_timeout", "10"))
+
 @cache
 def get_config():
   logger.info(f"Configuration read from {dotenv_file}")
@@ -48,10 +58,29 @@ def get_config():
     logger.info("Configuration saved.")
   return { k: v for k, v in scenes.items() if k not in skip }
 
+@cache
+def get_metrics_key():
+  # like the key of a scene, generated and saved if missing
+  key = os.getenv("webhook_server_metrics_key")
+  if not key:
+    key = os.urandom(32).hex()
+    dotenv.set_key(dotenv_file, "webhook_server_metrics_key", key)
+    logger.info("Metrics key saved.")
+  return key
+
+# tuya-qr-sharing.py and its Tuya client are imported for the first activation: the server starts
+# and answers /metrics without
+@cache
+def load_tuya_qr_sharing():
+  return importlib.import_module("tuya-qr-sharing")
+
 @cache
 def make_client():
+  tuya_qr_sharing = load_tuya_qr_sharing()
   client = tuya_qr_sharing.TuyaQrSharing(dotenv_file)
-  if (result := client.connect()) != tuya_qr_sharing.EXIT_OK:
+  with TUYA_CONNECT_SECONDS.time():
+    result = client.connect()
+  if result != tuya_qr_sharing.EXIT_OK:
     raise HTTPException(status_code=500, detail="Failed to connect to Tuya")
   return client
 
@@ -59,6 +88,7 @@ def get_client():
   now = datetime.datetime.now()
   if get_client.reconnect_dt and get_client.reconnect_dt <= now:
     make_client.cache_clear()
+    TUYA_RECONNECTS.inc()
 
   get_client.reconnect_dt = now + datetime.timedelta(seconds=get_client.reconnect_s)
 
@@ -70,10 +100,20 @@ get_client.reconnect_dt = None
 get_client.reconnect_s = 3600
 
 ConfigDep = Annotated[dict, Depends(get_config)]
-ClientDep = Annotated[tuya_qr_sharing.TuyaQrSharing, Depends(get_client)]
+MetricsKeyDep = Annotated[str, Depends(get_metrics_key)]
+# a tuya_qr_sharing.TuyaQrSharing
+ClientDep = Annotated[Any, Depends(get_client)]
 
-@app.get("/activate/{scene_id}")
-async def activate(scene_id: str, key: str, config: ConfigDep, client: ClientDep):
+class Activation(BaseModel):
+  scene_id: str
+  key: str
+
+def timed_activate(client: Any, home_id: str, scene_id: str) -> int:
+  # timed in the worker thread, such that calls outliving activation_timeout are recorded as well
+  with TUYA_ACTIVATE_SECONDS.time():
+    return client.activate(home_id, scene_id)
+
+async def activate_scene(scene_id: str, key: str, config: dict, client: Any) -> dict:
   if scene_id not in config:
     raise HTTPException(status_code=404, detail="Scene not found")
 
@@ -82,11 +122,45 @@ async def activate(scene_id: str, key: str, config: ConfigDep, client: ClientDep
   if key != scene['key']:
     raise HTTPException(status_code=401, detail="Invalid key")
 
-  if (result := client.activate(scene['home_id'], scene['scene_id'])) != tuya_qr_sharing.EXIT_OK:
+  # the thread cannot be interrupted: on timeout it stays busy until Tuya answers
+  loop = asyncio.get_running_loop()
+  try:
+    result = await asyncio.wait_for(
+      loop.run_in_executor(activation_pool, timed_activate, client, scene['home_id'], scene['scene_id']),
+      activation_timeout)
+  except asyncio.TimeoutError:
+    raise HTTPException(status_code=504, detail=f"Activating scene {scene_id} timed out")
+
+  if result != load_tuya_qr_sharing().EXIT_OK:
     raise HTTPException(status_code=500, detail=f"Failed to activate scene {scene_id} ({result})")
 
   return {"message": f"Scene {scene_id} activated successfully"}
 
+@app.get("/activate/{scene_id}")
+async def activate(scene_id: str, key: str, config: ConfigDep, client: ClientDep):
+  return await activate_scene(scene_id, key, config, client)
+
+@app.post("/activate")
+async def activate_batch(activations: list[Activation], config: ConfigDep, client: ClientDep):
+  # All scenes are triggered in parallel; the result of each is reported by its name
+  async def activate_one(activation: Activation) -> dict:
+    try:
+      return {"status": 200, **await activate_scene(activation.scene_id, activation.key, config, client)}
+    except HTTPException as e:
+      return {"status": e.status_code, "message": e.detail}
+
+  unique = {activation.scene_id: activation for activation in activations}
+  results = await asyncio.gather(*[activate_one(activation) for activation in unique.values()])
+  content = dict(zip(unique, results))
+  all_ok = all(result["status"] == 200 for result in results)
+  return JSONResponse(content, status_code=200 if all_ok else 207)
+
+@app.get("/metrics")
+async def metrics(key: str, metrics_key: MetricsKeyDep):
+  if key != metrics_key:
+    raise HTTPException(status_code=401, detail="Invalid key")
+  return metrics_response()
+
 if __name__ == "__main__":
   bind_host = os.getenv("webhook_server_host", "::")
   bind_port = int(os.getenv("webhook_server_port", "8000"))
@@ -0,0 +1,80 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+pytest.importorskip('tuya_sharing')
+
+from actions import load_module
+
+server = load_module(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webhook-server.py'))
+
+SCENES = { name: { 'home_id': 'home', 'scene_id': 'tuya-%s' % name, 'key': 'key-%s' % name }
+           for name in ['hall', 'office', 'kitchen', 'cellar'] }
+
+class StubClient:
+    def __init__(self, seconds: float = 0) -> None:
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.activated = []
+
+    def activate(self, home_id: str, scene_id: str) -> int:
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            self.activated.append(scene_id)
+        time.sleep(self.seconds)
+        with self.lock:
+            self.running -= 1
+        return server.load_tuya_qr_sharing().EXIT_OK
+
+@pytest.fixture
+def stub(monkeypatch):
+    def make(seconds: float = 0, workers: int = 4, timeout: float = 10) -> tuple[TestClient, StubClient]:
+        client = StubClient(seconds)
+        monkeypatch.setattr(server, 'activation_pool', concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+        monkeypatch.setattr(server, 'activation_timeout', timeout)
+        server.app.dependency_overrides = { server.get_config: lambda: SCENES, server.get_client: lambda: client,
+                                            server.get_metrics_key: lambda: 'key-metrics' }
+        return (TestClient(server.app), client)
+
+    yield make
+    server.app.dependency_overrides = {}
+
+def test_activations_bounded_by_pool(stub):
+    (test_client, client) = stub(seconds=0.1, workers=2)
+    response = test_client.post('/activate', json=[{ 'scene_id': name, 'key': scene['key'] }
+                                                   for (name, scene) in SCENES.items()])
+    assert response.status_code == 200
+    assert { name: result['status'] for (name, result) in response.json().items() } == dict.fromkeys(SCENES, 200)
+    assert client.peak == 2
+
+def test_activation_timeout(stub):
+    (test_client, client) = stub(seconds=0.5, timeout=0.05)
+    response = test_client.get('/activate/hall', params={ 'key': 'key-hall' })
+    assert response.status_code == 504
+    assert client.activated == ['tuya-hall']
+
+def test_batch_reports_each_scene_once(stub):
+    (test_client, client) = stub()
+    response = test_client.post('/activate', json=[
+        { 'scene_id': 'hall', 'key': 'wrong' },
+        { 'scene_id': 'office', 'key': 'wrong' },
+        { 'scene_id': 'hall', 'key': 'key-hall' },
+        { 'scene_id': 'attic', 'key': 'key-attic' }])
+    assert response.status_code == 207
+    assert { name: result['status'] for (name, result) in response.json().items() } == {
+        'hall': 200, 'office': 401, 'attic': 404 }
+    assert client.activated == ['tuya-hall']
+
+def test_metrics_need_key(stub):
+    (test_client, _) = stub()
+    assert test_client.get('/metrics', params={ 'key': 'wrong' }).status_code == 401
+    response = test_client.get('/metrics', params={ 'key': 'key-metrics' })
+    assert response.status_code == 200
+    assert 'tuya_call_seconds' in response.text
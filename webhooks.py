@@ -1,29 +1,116 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import concurrent.futures
+import json
 import os
 import sys
 import textwrap
+import time
+import urllib.parse
+from dataclasses import dataclass
+from typing import Mapping
 
 import dotenv
 import requests
+from urllib3.util.retry import Retry
+
+from actions import Action
+from dispatch import start_daemon
 
 EXIT_OK                = 0
 EXIT_WEBREQUEST_FAILED = 1
 EXIT_SYNTAX_ERROR      = 2
 
+# seconds to wait for a connection or reply, unless webhooks_timeout or webhooks_deadline is set
+DEFAULT_TIMEOUT = 60
+
 def float_or_none(value):
     return None if value is None else float(value)
 
+@dataclass
+class Target:
+    name: str
+    url: str
+
+def load_targets(env: Mapping[str, str]) -> dict[bool, list[Target]]:
+    # Targets for on and off: the lists of webhooks_targets, or the single webhooks_url.
+    # URLs may contain {key} and {action} like webhooks_url.
+    definitions = json.loads(env['webhooks_targets']) if env.get('webhooks_targets') else {
+        state: [env['webhooks_url']] if env.get('webhooks_url') else [] for state in ['on', 'off'] }
+    targets = {}
+    for (on, state) in [(True, 'on'), (False, 'off')]:
+        action = env.get('webhooks_heat_on_action') if on else env.get('webhooks_heat_off_action')
+        targets[on] = []
+        for definition in definitions.get(state, []):
+            if isinstance(definition, str):
+                definition = { 'url': definition }
+            url = str.format(definition['url'], key=env.get('webhooks_key'), action=action)
+            # named by host by default: the URL may contain the key
+            targets[on].append(Target(definition.get('name') or urllib.parse.urlsplit(url).hostname, url))
+    return targets
+
+class WebhooksAction(Action):
+    """
+    Requests the web-hook targets of a state all at once over a pooled
+    keep-alive session, retrying failed requests with backoff, and reports
+    the status and latency of each. Targets still busy after
+    webhooks_deadline seconds are reported as failed; their requests run in
+    daemon threads, such that they do not keep the process running.
+    """
+
+    def __init__(self, env: Mapping[str, str], wrapper: textwrap.TextWrapper) -> None:
+        self.targets = load_targets(env)
+        self.webhooks_deadline = float_or_none(env.get('webhooks_deadline'))
+        self.webhooks_timeout = float(env.get('webhooks_timeout') or self.webhooks_deadline or DEFAULT_TIMEOUT)
+        self.wrapper = wrapper
+        workers = max(1, *(len(targets) for targets in self.targets.values()))
+        # keeps the connections to the web-hook servers alive between requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers, max_retries=Retry(
+            total=int(env.get('webhooks_retries', 2)), backoff_factor=float(env.get('webhooks_backoff', 0.5)),
+            status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, target: Target) -> tuple[int, float]:
+        # Status and seconds until answered, including retries
+        started = time.monotonic()
+        response = self.session.get(target.url, timeout=self.webhooks_timeout)
+        return (response.status_code, time.monotonic() - started)
+
+    def set_state(self, on: bool) -> int:
+        targets = self.targets[on]
+        if not targets:
+            return EXIT_OK
+
+        futures = { start_daemon(self.request, target): target for target in targets }
+        (done, not_done) = concurrent.futures.wait(futures, timeout=self.webhooks_deadline)
+        result = EXIT_OK
+        for (future, target) in futures.items():
+            if future in not_done:
+                # the request keeps its thread until answered or timed out, but not the process
+                print(self.wrapper.fill("Webhook %s: deadline exceeded" % target.name))
+                result = EXIT_WEBREQUEST_FAILED
+                continue
+            try:
+                (status_code, seconds) = future.result()
+            except requests.RequestException as e:
+                # the message may contain the URL
+                print(self.wrapper.fill("Webhook %s failed (%s)" % (target.name, type(e).__name__)))
+                result = EXIT_WEBREQUEST_FAILED
+                continue
+            print(self.wrapper.fill("Webhook %s request result: %i in %.3f s" % (target.name, status_code, seconds)))
+            if not 200 <= status_code < 300:
+                result = EXIT_WEBREQUEST_FAILED
+        return result
+
+def create_action(env: Mapping[str, str], wrapper: textwrap.TextWrapper) -> Action:
+    return WebhooksAction(env, wrapper)
+
 def main() -> int:
     dotenv.load_dotenv()
 
-    webhooks_url = os.getenv('webhooks_url')
-    webhooks_key = os.getenv('webhooks_key')
-    webhooks_heat_on_action = os.getenv('webhooks_heat_on_action')
-    webhooks_heat_off_action = os.getenv('webhooks_heat_off_action')
-    webhooks_timeout = float_or_none(os.getenv('webhooks_timeout'))
-
     try:
         need_heating = sys.argv[1]
     except IndexError:
@@ -37,16 +124,7 @@ def main() -> int:
 
     wrapper = textwrap.TextWrapper(initial_indent=' ' * 0, width=80, subsequent_indent=' ' * 4)
 
-    if webhooks_url:
-        webhooks_action_url = str.format(
-            webhooks_url
-            , key=webhooks_key
-            , action=webhooks_heat_on_action if need_heating else webhooks_heat_off_action)
-        request = requests.get(webhooks_action_url, timeout=webhooks_timeout)
-        print(wrapper.fill("Webhook request result: %i" % request.status_code))
-        return EXIT_OK if request.status_code == 200 else EXIT_WEBREQUEST_FAILED
-
-    return EXIT_OK
+    return WebhooksAction(os.environ, wrapper).set_state(need_heating)
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,84 @@
+import http.server
+import os
+import socket
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+from webhooks import EXIT_OK, EXIT_WEBREQUEST_FAILED, WebhooksAction, load_targets
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.requests.append(self.path)
+        if self.path.startswith('/slow'):
+            time.sleep(0.5)
+        status = 503 if self.path.startswith('/flaky') and self.requests.count(self.path) == 1 else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    Handler.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%i' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+def test_single_url():
+    targets = load_targets({ 'webhooks_url': 'https://maker.example.com/trigger/{action}/with/key/{key}',
+                             'webhooks_key': 'secret', 'webhooks_heat_on_action': 'heating_on',
+                             'webhooks_heat_off_action': 'heating_off' })
+    assert [(target.name, target.url) for target in targets[True]] == [
+        ('maker.example.com', 'https://maker.example.com/trigger/heating_on/with/key/secret')]
+    assert targets[False][0].url.endswith('/heating_off/with/key/secret')
+
+def test_targets_requested_at_once(server, capsys):
+    env = { 'webhooks_targets': '{"on": ["%s/valves", {"name": "board", "url": "%s/flaky"}, "%s/slow"], '
+                                '"off": ["%s/valves?{action}"]}' % (server, server, server, server),
+            'webhooks_heat_off_action': 'heating_off', 'webhooks_backoff': '0', 'webhooks_deadline': '2' }
+    action = WebhooksAction(env, textwrap.TextWrapper(width=200))
+    started = time.monotonic()
+    assert action.set_state(True) == EXIT_OK
+    # concurrently, the flaky target retried
+    assert time.monotonic() - started < 1
+    assert sorted(Handler.requests) == ['/flaky', '/flaky', '/slow', '/valves']
+    lines = capsys.readouterr().out.splitlines()
+    assert [line.split(' request result: ')[0] for line in lines] == [
+        'Webhook 127.0.0.1', 'Webhook board', 'Webhook 127.0.0.1']
+    assert all(' 200 in ' in line for line in lines)
+
+    assert action.set_state(False) == EXIT_OK
+    assert Handler.requests[-1] == '/valves?heating_off'
+
+def test_deadline(server, capsys):
+    env = { 'webhooks_targets': '{"on": [{"name": "slow", "url": "%s/slow"}]}' % server, 'webhooks_deadline': '0.1' }
+    assert WebhooksAction(env, textwrap.TextWrapper(width=200)).set_state(True) == EXIT_WEBREQUEST_FAILED
+    assert capsys.readouterr().out == 'Webhook slow: deadline exceeded\n'
+    # no targets for off
+    assert WebhooksAction(env, textwrap.TextWrapper()).set_state(False) == EXIT_OK
+
+def test_hung_target_does_not_keep_process(tmp_path):
+    # accepts connections, but never answers
+    with socket.create_server(('127.0.0.1', 0)) as hung:
+        env = dict(os.environ, webhooks_url='http://127.0.0.1:%i/' % hung.getsockname()[1],
+                   webhooks_timeout='60', webhooks_deadline='0.2')
+        result = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webhooks.py'),
+                                 'on'], cwd=tmp_path, env=env, stdout=subprocess.PIPE, text=True, timeout=10)
+    assert result.returncode == EXIT_WEBREQUEST_FAILED
+    assert result.stdout == 'Webhook 127.0.0.1: deadline exceeded\n'
+
+def test_timeout_defaults_to_deadline():
+    assert WebhooksAction({ 'webhooks_deadline': '30' }, textwrap.TextWrapper()).webhooks_timeout == 30
+    assert WebhooksAction({}, textwrap.TextWrapper()).webhooks_timeout == 60